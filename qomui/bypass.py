@@ -52,20 +52,18 @@ def create_cgroup(user, group, interface, gw=None,  gw_6=None, default_int=None,
             rt_tables.write("11 bypass_qomui\n")
         logging.debug("Bypass: Created new routing table")
 
-    firewall.batch_rule(cgroup_iptables)
-    if gw_6 != "None" and default_int == interface:
-        firewall.batch_rule_6(cgroup_iptables)
-
-    else:
+    cgroup_iptables_6 = list(cgroup_iptables)
+    if gw_6 == "None" or default_int != interface:
         logging.debug("Blocking ipv6 via bypass_qomui")
-        cgroup_iptables.pop(1)
-        cgroup_iptables.insert(1, ["-t", "nat", "-A", "POSTROUTING", "-m", "cgroup",
-                                   "--cgroup", "0x00110011", "-o", "{}".format(interface), "-j", "MASQUERADE"])
-        cgroup_iptables.pop(2)
-        cgroup_iptables.insert(2, ["-I", "OUTPUT", "1", "-m", "cgroup", "--cgroup", "0x00110011", "-j", "DROP"])
-        cgroup_iptables.pop(3)
-        cgroup_iptables.insert(3, ["-I", "INPUT", "1", "-m", "cgroup", "--cgroup", "0x00110011", "-j", "DROP"])
-        firewall.batch_rule_6(cgroup_iptables)
+        cgroup_iptables_6.pop(1)
+        cgroup_iptables_6.insert(1, ["-t", "nat", "-A", "POSTROUTING", "-m", "cgroup",
+                                     "--cgroup", "0x00110011", "-o", "{}".format(interface), "-j", "MASQUERADE"])
+        cgroup_iptables_6.pop(2)
+        cgroup_iptables_6.insert(2, ["-I", "OUTPUT", "1", "-m", "cgroup", "--cgroup", "0x00110011", "-j", "DROP"])
+        cgroup_iptables_6.pop(3)
+        cgroup_iptables_6.insert(3, ["-I", "INPUT", "1", "-m", "cgroup", "--cgroup", "0x00110011", "-j", "DROP"])
+
+    firewall.batch_rules(cgroup_iptables, cgroup_iptables_6)
 
     try:
         check_call(["ip", "rule", "add", "fwmark", "11", "table", "bypass_qomui"])
@@ -128,8 +126,7 @@ def delete_cgroup(interface):
     except CalledProcessError:
         pass
 
-    firewall.batch_rule(cgroup_iptables_del)
-    firewall.batch_rule_6(cgroup_iptables_del)
+    firewall.batch_rules(cgroup_iptables_del, cgroup_iptables_del)
 
     try:
         os.rmdir(cgroup_path)
@@ -151,7 +148,6 @@ def set_bypass_vpn(interface, interface_cmd, tun, tun_cmd):
                     "-o", interface, "-j", "MASQUERADE"
                     ]]
 
-    firewall.batch_rule(postroutes)
-    firewall.batch_rule_6(postroutes)
+    firewall.batch_rules(postroutes, postroutes)
 
 
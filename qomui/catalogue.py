@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+
+#substrings up to this length are indexed directly
+GRAM = 3
+
+
+def grams(text):
+    text = text.lower()
+    found = set()
+    for n in range(1, GRAM + 1):
+        for i in range(len(text) - n + 1):
+            found.add(text[i:i + n])
+    return found
+
+
+class ServerCatalogue(object):
+    """Secondary indexes over server_dict shared by gui and cli
+
+    Keys are kept in display order - rows maps each key to its position.
+    """
+
+    def __init__(self, server_dict=None):
+        self.server_dict = {}
+        self.rebuild(server_dict or {})
+
+    def rebuild(self, server_dict):
+        self.server_dict = server_dict
+        self.providers = {}
+        self.countries = {}
+        self.tunnels = {}
+        self.favourites = set()
+        self.values = {}
+        self.tokens = {}
+        self.search_text = {}
+        self.order = []
+        self.rows = {}
+        malformed = []
+
+        for key, val in server_dict.items():
+
+            try:
+                self.index(key, val)
+
+            except (KeyError, AttributeError):
+                malformed.append(key)
+                logging.error("Malformed server entry: {} {}".format(key, val))
+
+        self.order = sorted(self.search_text, key=lambda s: s.upper())
+        self.renumber()
+        return malformed
+
+    def index(self, key, val):
+        search = "{}{}".format(key, val["city"]).lower()
+        attrs = val["provider"], val["country"], val["tunnel"]
+        self.providers.setdefault(attrs[0], set()).add(key)
+        self.countries.setdefault(attrs[1], set()).add(key)
+        self.tunnels.setdefault(attrs[2], set()).add(key)
+
+        if val.get("favourite") == "on":
+            self.favourites.add(key)
+
+        for v in val.values():
+            if isinstance(v, str):
+                self.values.setdefault(v.lower(), set()).add(key)
+
+        for g in grams(search):
+            self.tokens.setdefault(g, set()).add(key)
+
+        self.search_text[key] = search
+
+    def unindex(self, key):
+        val = self.server_dict.get(key, {})
+        search = self.search_text.pop(key, None)
+        if search is None:
+            return
+
+        for index, attr in [(self.providers, "provider"), (self.countries, "country"), (self.tunnels, "tunnel")]:
+            self.discard(index, val.get(attr), key)
+
+        for v in val.values():
+            if isinstance(v, str):
+                self.discard(self.values, v.lower(), key)
+
+        for g in grams(search):
+            self.discard(self.tokens, g, key)
+
+        self.favourites.discard(key)
+
+    def discard(self, index, attr, key):
+        try:
+            index[attr].discard(key)
+            if len(index[attr]) == 0:
+                index.pop(attr)
+
+        except (KeyError, TypeError):
+            pass
+
+    def renumber(self, start=0):
+        for row, key in enumerate(self.order[start:], start):
+            self.rows[key] = row
+
+    def add(self, key, val, row=None):
+        self.unindex(key)
+        self.server_dict[key] = val
+        self.index(key, val)
+
+        if key in self.rows:
+            return self.rows[key]
+
+        if row is None:
+            row = len(self.order)
+
+        self.order.insert(row, key)
+        self.renumber(start=row)
+        return row
+
+    def remove(self, key):
+        self.unindex(key)
+        row = self.rows.pop(key, None)
+        if row is not None:
+            self.order.pop(row)
+            self.renumber(start=row)
+        return row
+
+    def rename(self, key, new_key, val):
+        row = self.rows.get(key)
+        self.unindex(key)
+        self.server_dict.pop(key, None)
+        self.server_dict[new_key] = val
+        self.index(new_key, val)
+
+        if row is None:
+            return self.add(new_key, val)
+
+        self.rows.pop(key)
+        self.order[row] = new_key
+        self.rows[new_key] = row
+        return row
+
+    def set_favourite(self, key, state):
+        if state:
+            self.favourites.add(key)
+        else:
+            self.favourites.discard(key)
+
+    def row(self, key):
+        return self.rows.get(key)
+
+    def ordered(self, keys):
+        return sorted(keys, key=lambda k: self.rows.get(k, len(self.order)))
+
+    def lookup(self, index, attrs):
+        if attrs is None:
+            return None
+
+        if isinstance(attrs, str):
+            attrs = [attrs]
+
+        found = set()
+        for a in attrs:
+            found |= index.get(a, set())
+        return found
+
+    def filter(self, provider=None, country=None, tunnel=None, favourite=False, text=None):
+        selected = [
+            self.lookup(self.providers, provider),
+            self.lookup(self.countries, country),
+            self.lookup(self.tunnels, tunnel)
+            ]
+
+        if favourite is True:
+            selected.append(self.favourites)
+
+        if text is not None:
+            selected.append(self.search(text))
+
+        selected = sorted([s for s in selected if s is not None], key=len)
+        if len(selected) == 0:
+            return set(self.rows)
+
+        return selected[0].intersection(*selected[1:])
+
+    def search(self, text):
+        text = text.lower()
+        if len(text) == 0:
+            return set(self.rows)
+
+        if len(text) <= GRAM:
+            return set(self.tokens.get(text, set()))
+
+        parts = [text[i:i + GRAM] for i in range(len(text) - GRAM + 1)]
+        candidates = sorted([self.tokens.get(p, set()) for p in parts], key=len)
+        candidates = candidates[0].intersection(*candidates[1:])
+        return set(k for k in candidates if text in self.search_text[k])
+
+    def match(self, terms):
+        selected = sorted([self.values.get(t.lower(), set()) for t in terms], key=len)
+        if len(selected) == 0:
+            return set(self.rows)
+
+        return selected[0].intersection(*selected[1:])
+
+    def profile(self, profile):
+        tunnel = profile["protocol"]
+        if tunnel == "All protocols":
+            tunnel = None
+
+        found = self.filter(provider=profile["providers"], country=profile["countries"], tunnel=tunnel)
+
+        if len(profile["filters"]) != 0:
+            matched = set()
+            for f in profile["filters"]:
+                if f != "":
+                    matched |= self.search(f)
+            found &= matched
+
+        return self.ordered(found)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import re
+
+#kept free of Qt and network imports as it is loaded by every worker process
+IPV4 = re.compile(r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}")
+
+
+def parse(path, auth_file):
+    """Normalise one OpenVPN/WireGuard config and extract its server entry
+
+    Hostnames are not resolved here. The line holding one is returned
+    as host = (line index, kind, hostname, port) so the caller can
+    resolve the whole batch at once and patch the line.
+    """
+    f = os.path.basename(path)
+    result = {
+        "file" : f,
+        "name" : os.path.splitext(f)[0],
+        "tunnel" : "OpenVPN",
+        "ip" : None,
+        "host" : None
+        }
+
+    try:
+        with open(path, "r") as conf_file:
+            modify = conf_file.readlines()
+
+    except (OSError, UnicodeDecodeError) as e:
+        result["error"] = str(e)
+        return result
+
+    remote = 0
+    protocol = "udp\n"
+    port = ""
+    protocol_found = 0
+
+    for index, line in enumerate(modify):
+        if line.startswith("remote "):
+            if remote == 0:
+                remote = 1
+
+                try:
+                    protocol = line.split(" ")[3]
+
+                except IndexError:
+                    #an earlier proto line still applies
+                    if protocol_found == 0:
+                        protocol = "udp\n"
+
+                port = line.split(" ")[2]
+                found = IPV4.search(line)
+
+                if found is not None:
+                    result["ip"] = found.group()
+
+                else:
+                    result["host"] = (index, "remote", line.split(" ")[1], port.strip())
+
+            else:
+                modify[index] = "#{}".format(line)
+
+        elif line.startswith("auth-user-pass"):
+            modify[index] = 'auth-user-pass {}\n'.format(auth_file)
+
+        elif line.startswith("verb "):
+            modify[index] = 'verb 3\n'
+
+        elif line.startswith("up ") or line.startswith("down "):
+            modify[index] = "#{}".format(line)
+
+        elif line.startswith("proto "):
+            protocol = line.split(" ")[1]
+            protocol_found = 1
+
+        #WireGuard
+        elif line.startswith("Endpoint ="):
+            result["tunnel"] = "WireGuard"
+            protocol_found = 1
+            ip_port = line.split(" = ")[1]
+            server, port = ip_port.rsplit(":", 1)
+            server = server.strip().strip("[]")
+            protocol = "UDP"
+            found = IPV4.search(line)
+
+            if found is not None:
+                result["ip"] = found.group()
+
+            elif ":" in server:
+                result["ip"] = server
+
+            else:
+                result["host"] = (index, "endpoint", server.strip(), port.strip())
+
+    if protocol_found == 0:
+        modify.insert(0, "proto {}".format(protocol.lower()))
+        if result["host"] is not None:
+            result["host"] = (result["host"][0] + 1,) + result["host"][1:]
+
+    result["lines"] = modify
+    result["port"] = port.upper().split("\n")[0]
+    result["protocol"] = protocol.upper().split("\n")[0]
+    return result
+
+
+def endpoint(ip, port):
+    #ipv6 addresses need brackets to be told apart from the port
+    if ":" in ip:
+        return "[{}]:{}".format(ip, port)
+    return "{}:{}".format(ip, port)
+
+
+def patch(result, ip):
+    index, kind, _, port = result["host"]
+    if kind == "remote":
+        result["lines"][index] = "remote {} {}\n".format(ip, port)
+    else:
+        result["lines"][index] = "Endpoint = {}\n".format(endpoint(ip, port))
+    result["ip"] = ip
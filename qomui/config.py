@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import os
-import json
+
+from qomui import persist
 
 ROOTDIR = "/usr/share/qomui"
 HOMEDIR = "{}/.qomui".format(os.path.expanduser("~"))
@@ -11,6 +12,7 @@ LOGDIR = "/usr/share/qomui/logs"
 OPATH = "/org/qomui/service"
 IFACE = "org.qomui.service"
 BUS_NAME = "org.qomui.service"
+CONFIG_FILE = "{}/config.json".format(ROOTDIR)
 
 default_settings = {
         "alt_dns1": "208.67.222.222",
@@ -24,22 +26,38 @@ default_settings = {
         "dns_off" : 0,
         "bypass": 0,
         "ping": 0,
+        "ping_limit": 64,
+        "ping_samples": 3,
+        "ping_mode": "auto",
+        "score_jitter": 1,
+        "score_loss": 500,
         "auto_update": 0,
         "block_lan": 0,
         "preserve_rules": 0,
         "fw_gui_only": 0,
+        "nftables": 0,
+        "resolvers": [],
+        "resolve_dig": 0,
         "log_level": "Info"
         }
 
 def load_config():
     global settings
 
-    try:
-        with open('{}/config.json'.format(ROOTDIR), 'r') as c:
-            settings = json.load(c)
-            for k,v in default_settings.items():
-                if k not in settings.keys():
-                    settings[k] = v
+    settings = persist.load_json(CONFIG_FILE)
+    if len(settings) == 0:
+        settings = default_settings
+
+    for k,v in default_settings.items():
+        if k not in settings.keys():
+            settings[k] = v
+
+#only re-read config.json if another process replaced it
+def reload_config():
+    if persist.get(CONFIG_FILE).changed() is True:
+        load_config()
+        return True
+    return False
 
-    except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
-        settings = default_settings
\ No newline at end of file
+def save_config(now=False):
+    persist.save_json(CONFIG_FILE, settings, now=now)
\ No newline at end of file
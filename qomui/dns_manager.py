@@ -91,6 +91,4 @@ def dns_request_exception(action, dns_1, dns_2, port):
         rules.append([action, 'INPUT', '-p', p,
                       '--sport', port, '-j', 'ACCEPT'])
 
-    for rule in rules:
-        firewall.add_rule(rule)
-        firewall.add_rule(rule, ipt="ip6")
+    firewall.batch_rules(rules, rules)
@@ -1,159 +1,815 @@
 import json
 import shlex
 import os
+import copy
+import difflib
 import logging
-from subprocess import check_call, check_output, CalledProcessError, Popen, PIPE
-from collections import Counter
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import check_call, check_output, CalledProcessError, Popen, PIPE, run
 
-from qomui import config
+from qomui import config, nftables, persist
 
 saved_rules = []
 saved_rules_6 = []
 devnull = open(os.devnull, 'w')
-ip6_available = True
+ip6_available = None
+engine = "iptables"
+ruleset = {"ip4": None, "ip6": None}
+#positional changes are computed from a snapshot, so only one writer per family
+locks = {"ip4": threading.RLock(), "ip6": threading.RLock()}
+ipset_available = None
+xtables_backend = None
+IPSETS = {"ip4": "qomui_allow4", "ip6": "qomui_allow6"}
+BUILTIN_CHAINS = ["INPUT", "OUTPUT", "FORWARD", "PREROUTING", "POSTROUTING"]
+IMPLICIT_MATCHES = ["tcp", "udp", "icmp", "icmp6"]
+ICMP_TYPES = {
+    "echo-reply": "0", "destination-unreachable": "3", "echo-request": "8",
+    "time-exceeded": "11", "parameter-problem": "12"
+    }
+ICMPV6_TYPES = {
+    "destination-unreachable": "1", "packet-too-big": "2", "time-exceeded": "3",
+    "parameter-problem": "4", "echo-request": "128", "echo-reply": "129",
+    "router-solicitation": "133", "router-advertisement": "134",
+    "neighbour-solicitation": "135", "neighbor-solicitation": "135",
+    "neighbour-advertisement": "136", "neighbor-advertisement": "136"
+    }
 
 
 def check_ipv6():
+    if ip6_available is None:
+        refresh_ipv6()
+
+    return ip6_available
+
+
+#only needs to be called again if network addresses have changed
+def refresh_ipv6():
+    global ip6_available
+    previous = ip6_available
+
     try:
         ipv6_info = open("/proc/net/if_inet6", "r").read()
         if ipv6_info:
-            return True
+            ip6_available = True
 
         else:
-            logging.info("ipv6 stack not available")
-            return False
+            ip6_available = False
 
     except (OSError, FileNotFoundError) as e:
         logging.debug("Unable to determine whether ipv6 is available")
-        return True
+        ip6_available = True
+
+    if ip6_available is False and previous is not False:
+        logging.info("ipv6 stack not available")
+
+    elif ip6_available is True and previous is False:
+        logging.info("ipv6 stack available again")
+
+    return ip6_available
+
+
+def set_engine(name):
+    global engine
+
+    if name == engine:
+        return
+
+    logging.info("firewall: switching from {} to {}".format(engine, name))
+
+    if engine == "nftables":
+        nftables.remove_table()
+
+    else:
+        #make sure qomui's iptables rules don't block traffic anymore
+        apply_rules(0, preserve=1)
+
+    engine = name
 
 
 def add_rule(rule, check=0, ipt="ip4"):
+    #the model is only read again once a failed rule or a restore dropped it
+    with locks[ipt]:
+        if ruleset[ipt] is None:
+            read_ruleset(ipt=ipt)
+
+        return set_rule(rule, check=check, ipt=ipt)
+
+
+def set_rule(rule, check=0, ipt="ip4"):
     if ipt == "ip4":
         ip_cmd = ["iptables", "--wait", ]
     else:
         ip_cmd = ["ip6tables", "--wait", ]
 
     if ipt == "ip4" or check == 1 or check_ipv6() is True:
-        # check if rule already exists and only set it otherwise
-        try:
-            if len(rule) > 3 or "-D" not in rule:
+        #the cached model replaces a call to iptables -C per rule
+        exists = rule_exists(rule, ipt=ipt)
+
+        if exists is None and ("-A" in rule or "-I" in rule):
+            try:
                 check = ["-C" if x == "-A" or x == "-I" else x for x in rule]
                 check_call(ip_cmd + check, stdout=devnull, stderr=devnull)
-                logging.debug("iptables: {} already exists".format(rule))
+                exists = True
 
-            else:
-                raise IndexError
+            except CalledProcessError:
+                exists = False
+
+        if exists is True and "-D" not in rule:
+            logging.debug("iptables: {} already exists".format(rule))
+            return True
+
+        elif exists is False and "-D" in rule:
+            logging.debug("iptables: {} does not exist".format(rule))
+            return True
+
+        try:
+            check_call(ip_cmd + rule, stdout=devnull, stderr=devnull)
+            logging.debug("iptables: applied {}".format(rule))
 
-        except (IndexError, CalledProcessError):
             try:
-                check_call(ip_cmd + rule, stdout=devnull, stderr=devnull)
-                logging.debug("iptables: applied {}".format(rule))
+                if ruleset[ipt] is not None:
+                    simulate(ruleset[ipt], [rule])
 
-            except CalledProcessError:
-                logging.warning("iptables: failed to apply {}".format(rule))
+            except ValueError:
+                ruleset[ipt] = None
+
+        except CalledProcessError:
+            logging.warning("iptables: failed to apply {}".format(rule))
+            ruleset[ipt] = None
+            return False
+
+    return True
+
+
+def rule_exists(rule, ipt="ip4"):
+    model = ruleset[ipt]
+    table, rule = split_table(rule)
+
+    if model is None or len(rule) < 2 or rule[0] not in ["-A", "-I", "-D"]:
+        return None
+
+    args = rule[2:]
+    if rule[0] == "-I" and len(args) != 0 and args[0].isdigit():
+        args = args[1:]
+
+    elif rule[0] == "-D" and len(args) == 1 and args[0].isdigit():
+        return None
+
+    try:
+        chain = model[table][rule[1]]
+    except KeyError:
+        return False
+
+    key = rule_key(args)
+    return any(rule_key(r) == key for r in chain["rules"])
 
 
 def apply_rules(opt, block_lan=0, preserve=0):
+    global engine
     fw_rules = get_config()
-    if opt != 2:
-        batch_rule(fw_rules["flush"])
-        batch_rule_6(fw_rules["flushv6"])
 
-    logging.info("iptables: flushed existing rules")
+    if engine == "nftables":
+
+        try:
+            nftables.apply_rules(fw_rules, opt, block_lan=block_lan)
+            if opt == 1:
+                logging.info("nftables: activated firewall")
+            elif opt == 0:
+                logging.info("nftables: deactivated firewall")
+            return True
+
+        except (ValueError, CalledProcessError, FileNotFoundError) as e:
+            logging.warning("nftables: {} - falling back to iptables".format(e))
+            nftables.remove_table()
+            engine = "iptables"
+
+    if ipset_available is None:
+        create_allowlist()
 
     if preserve == 1:
         save_existing_rules(fw_rules)
         save_existing_rules_6(fw_rules)
-        batch_rule(saved_rules)
-        batch_rule_6(saved_rules_6)
 
-    if opt == 1:
-        batch_rule(fw_rules["defaults"])
-        batch_rule_6(fw_rules["defaultsv6"])
+    rules, rules_6 = compile_rules(fw_rules, opt, block_lan=block_lan, preserve=preserve)
 
-        if block_lan == 0:
-            batch_rule(fw_rules["ipv4local"])
-            batch_rule_6(fw_rules["ipv6local"])
+    result = run_families(lambda r, ipt: apply_family(r, ipt=ipt, opt=opt), rules, rules_6)
+
+    if opt != 2:
+        logging.info("iptables: flushed existing rules")
 
-        batch_rule(fw_rules["ipv4rules"])
-        batch_rule_6(fw_rules["ipv6rules"])
+    if opt == 1:
         logging.info("iptables: activated firewall")
 
     elif opt == 0:
-        batch_rule(fw_rules["unsecure"])
-        batch_rule_6(fw_rules["unsecurev6"])
         logging.info("iptables: deactivated firewall")
 
+    return result
 
-def batch_rule(rules):
+
+def apply_family(rules, ipt="ip4", opt=1):
+    with locks[ipt]:
+        live = read_ruleset(ipt=ipt)
+
+        #record what is about to happen in case the service dies midway
+        if live is None:
+            logging.debug("iptables: transaction not journaled - active {} rules unknown".format(ipt))
+
+        else:
+            try:
+                desired = simulate(copy.deepcopy(live), rules)
+                journal_begin(ipt, opt, render_ruleset(live), render_ruleset(desired))
+
+            except (TypeError, ValueError, IndexError) as e:
+                logging.debug("iptables: transaction not journaled - {}".format(e))
+
+        #only commit the difference between the live and the desired ruleset
+        #and fall back to setting rules one by one if that is not possible
+        result = update_rules(rules, ipt=ipt, live=live)
+        if result is False:
+            logging.info("iptables: applying {} rules one by one".format(ipt))
+            result = add_rules(rules, ipt=ipt)
+
+        journal_end(ipt)
+        return result
+
+
+def check_backend():
+    global xtables_backend
+
+    if xtables_backend is None:
+        try:
+            version = check_output(["iptables", "--version"], stderr=devnull).decode("utf-8")
+            xtables_backend = "nf_tables" if "nf_tables" in version else "legacy"
+
+        except (CalledProcessError, FileNotFoundError):
+            xtables_backend = "legacy"
+
+        logging.debug("iptables: using {} backend".format(xtables_backend))
+
+    return xtables_backend
+
+
+def run_families(func, rules, rules_6):
+    families = [(rules, "ip4")]
+    if check_ipv6() is True:
+        families.append((rules_6, "ip6"))
+
+    #iptables-legacy and ip6tables-legacy share one xtables lock
+    #so committing both families at the same time only gains on nf_tables
+    if len(families) == 1 or check_backend() != "nf_tables":
+        return all([func(r, ipt=ipt) for r, ipt in families])
+
+    with ThreadPoolExecutor(max_workers=len(families)) as pool:
+        futures = [pool.submit(func, r, ipt=ipt) for r, ipt in families]
+        return all([f.result() for f in futures])
+
+
+def compile_rules(fw_rules, opt, block_lan=0, preserve=0):
+    rules = []
+    rules_6 = []
+
+    if opt != 2:
+        rules.extend(fw_rules["flush"])
+        rules_6.extend(fw_rules["flushv6"])
+
+    if preserve == 1:
+        rules.extend(saved_rules)
+        rules_6.extend(saved_rules_6)
+
+    if opt == 1:
+        rules.extend(fw_rules["defaults"])
+        rules_6.extend(fw_rules["defaultsv6"])
+
+        #whitelisted servers are matched by a single rule
+        if ipset_available is True:
+            rules.append(allowlist_rule())
+            rules_6.append(allowlist_rule(ipt="ip6"))
+
+        if block_lan == 0:
+            rules.extend(fw_rules["ipv4local"])
+            rules_6.extend(fw_rules["ipv6local"])
+
+        rules.extend(fw_rules["ipv4rules"])
+        rules_6.extend(fw_rules["ipv6rules"])
+
+    elif opt == 0:
+        rules.extend(fw_rules["unsecure"])
+        rules_6.extend(fw_rules["unsecurev6"])
+
+    return rules, rules_6
+
+
+def compile_restore(rules):
+    tables = {}
+
+    for rule in rules:
+        table, rule = split_table(rule)
+
+        if table not in tables:
+            tables[table] = {"chains": [], "commands": [], "deleted": set()}
+
+        #policies and new chains have to be declared in the table header
+        if len(rule) == 3 and rule[0] == "-P":
+            tables[table]["chains"].append(":{} {} [0:0]".format(rule[1], rule[2]))
+
+        #unless an earlier -X in the payload would delete the declared chain again
+        elif len(rule) == 2 and rule[0] == "-N" and not ({"", rule[1]} & tables[table]["deleted"]):
+            tables[table]["chains"].append(":{} - [0:0]".format(rule[1]))
+
+        elif len(rule) != 0:
+            if rule[0] == "-X":
+                tables[table]["deleted"].add(rule[1] if len(rule) > 1 else "")
+
+            tables[table]["commands"].append(" ".join(quote_arg(a) for a in rule))
+
+    payload = []
+    for table, content in tables.items():
+        payload.append("*{}".format(table))
+        payload.extend(content["chains"])
+        payload.extend(content["commands"])
+        payload.append("COMMIT")
+
+    return "\n".join(payload) + "\n"
+
+
+def quote_arg(arg):
+    if arg == "" or any(c.isspace() or c == '"' for c in arg):
+        return '"{}"'.format(arg.replace('"', '\\"'))
+
+    return arg
+
+
+def split_table(rule):
+    rule = list(rule)
+    table = "filter"
+
+    if "-t" in rule:
+        i = rule.index("-t")
+        table = rule[i + 1]
+        del rule[i:i + 2]
+
+    return table, rule
+
+
+def rule_key(args):
+    groups = []
+    negate = False
+
+    #group each option with its arguments so that ordering does not matter
+    for arg in args:
+        if arg == "!":
+            negate = True
+
+        elif len(groups) == 0 or arg.startswith("-") and len(arg) > 1 and not arg[1].isdigit():
+            groups.append((negate, arg, []))
+            negate = False
+
+        else:
+            groups[-1][2].append(arg)
+
+    normalized = []
+    for negate, opt, values in groups:
+        if opt in ["-m", "--match"] and values and values[0] in IMPLICIT_MATCHES:
+            continue
+
+        if opt in ["-s", "-d", "--source", "--destination"]:
+            values = [v.rsplit("/", 1)[0] if v.endswith(("/32", "/128")) else v for v in values]
+
+        elif opt == "--icmp-type":
+            values = [ICMP_TYPES.get(v, v) for v in values]
+
+        elif opt == "--icmpv6-type":
+            values = [ICMPV6_TYPES.get(v, v) for v in values]
+
+        normalized.append((negate, opt) + tuple(values))
+
+    return tuple(sorted(normalized))
+
+
+def parse_ruleset(dump):
+    model = {}
+    table = None
+
+    for line in dump.split("\n"):
+        line = line.strip()
+
+        if line == "" or line.startswith("#") or line == "COMMIT":
+            continue
+
+        elif line.startswith("*"):
+            table = line[1:]
+            model[table] = {}
+
+        elif line.startswith(":"):
+            name, policy = line[1:].split()[:2]
+            model[table][name] = {"policy": policy, "rules": []}
+
+        else:
+            rule = shlex.split(line)
+            if len(rule) >= 2 and rule[0] == "-A":
+                model[table].setdefault(rule[1], {"policy": None, "rules": []})
+                model[table][rule[1]]["rules"].append(rule[2:])
+
+    return model
+
+
+def read_ruleset(ipt="ip4"):
+    if ipt == "ip4":
+        save_cmd = ["iptables-save"]
+    else:
+        save_cmd = ["ip6tables-save"]
+
+    try:
+        ruleset[ipt] = parse_ruleset(check_output(save_cmd, stderr=devnull).decode("utf-8"))
+
+    except (CalledProcessError, FileNotFoundError, ValueError) as e:
+        logging.debug("{}: failed to read active rules - {}".format(save_cmd[0], e))
+        ruleset[ipt] = None
+
+    return ruleset[ipt]
+
+
+def simulate(model, rules):
     for rule in rules:
-        add_rule(rule)
+        table, rule = split_table(rule)
+        chains = model.setdefault(table, {})
+
+        if len(rule) == 0:
+            continue
+
+        cmd = rule[0]
+        name = rule[1] if len(rule) > 1 else None
+        if name is not None and cmd in ["-P", "-A", "-I", "-D"]:
+            chain = chains.setdefault(name, {"policy": None, "rules": []})
+
+        if cmd == "-F":
+            for n in [name] if name is not None else list(chains):
+                if n in chains:
+                    chains[n]["rules"] = []
+
+        elif cmd == "-X":
+            for n in [name] if name is not None else list(chains):
+                if n in chains and chains[n]["policy"] == "-":
+                    del chains[n]
+
+        elif cmd == "-N" and name is not None:
+            chains.setdefault(name, {"policy": "-", "rules": []})
+
+        elif cmd == "-P" and len(rule) == 3:
+            chain["policy"] = rule[2]
+
+        elif cmd == "-A" and name is not None:
+            chain["rules"].append(rule[2:])
+
+        elif cmd == "-I" and name is not None:
+            args = rule[2:]
+            pos = 0
+            if len(args) != 0 and args[0].isdigit():
+                pos = int(args[0]) - 1
+                args = args[1:]
+            chain["rules"].insert(pos, args)
+
+        elif cmd == "-D" and name is not None:
+            args = rule[2:]
+            if len(args) == 1 and args[0].isdigit():
+                del chain["rules"][int(args[0]) - 1]
+            else:
+                key = rule_key(args)
+                for i, r in enumerate(chain["rules"]):
+                    if rule_key(r) == key:
+                        del chain["rules"][i]
+                        break
+
+        elif cmd != "-Z":
+            raise ValueError("unsupported command {}".format(rule))
+
+    return model
+
+
+def diff_chain(name, old, new):
+    matcher = difflib.SequenceMatcher(None, [rule_key(r) for r in old], [rule_key(r) for r in new], autojunk=False)
+    commands = []
+
+    #working backwards keeps the rule numbers of earlier changes valid
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == "equal":
+            continue
+
+        for num in range(i2, i1, -1):
+            commands.append("-D {} {}".format(name, num))
+
+        for i, rule in enumerate(new[j1:j2]):
+            commands.append("-I {} {} {}".format(name, i1 + i + 1, " ".join(quote_arg(a) for a in rule)))
+
+    return commands
+
+
+def diff_rulesets(live, desired):
+    payload = []
+
+    for table, chains in desired.items():
+        current = live.get(table, {})
+        header = []
+        commands = []
+
+        for name, chain in chains.items():
+            old = current.get(name)
+
+            if old is None and chain["policy"] == "-":
+                header.append(":{} - [0:0]".format(name))
+
+            elif chain["policy"] not in [None, "-"]:
+                if old is None or old["policy"] != chain["policy"]:
+                    header.append(":{} {} [0:0]".format(name, chain["policy"]))
+
+            old_rules = old["rules"] if old is not None else []
+            commands.extend(diff_chain(name, old_rules, chain["rules"]))
+
+        #chains can only be deleted once no rule is referencing them anymore
+        for name, chain in current.items():
+            if name not in chains:
+                commands.extend(["-F {}".format(name), "-X {}".format(name)])
+
+        if len(header) != 0 or len(commands) != 0:
+            payload.append("*{}".format(table))
+            payload.extend(header + commands)
+            payload.append("COMMIT")
+
+    if len(payload) == 0:
+        return ""
+
+    return "\n".join(payload) + "\n"
+
+
+def render_ruleset(model):
+    payload = []
+
+    for table, chains in model.items():
+        payload.append("*{}".format(table))
+
+        #iptables-restore only accepts a policy for built-in chains
+        for name, chain in chains.items():
+            if name in BUILTIN_CHAINS:
+                payload.append(":{} {} [0:0]".format(name, chain["policy"] or "ACCEPT"))
+            else:
+                payload.append(":{} - [0:0]".format(name))
+
+        for name, chain in chains.items():
+            for rule in chain["rules"]:
+                payload.append("-A {} {}".format(name, " ".join(quote_arg(a) for a in rule)))
+
+        payload.append("COMMIT")
+
+    return "\n".join(payload) + "\n"
+
+
+def update_rules(rules, ipt="ip4", live=None):
+    if len(rules) == 0:
+        return True
+
+    with locks[ipt]:
+        if live is None:
+            live = read_ruleset(ipt=ipt)
+
+        if live is None:
+            logging.debug("iptables: active {} rules unknown - restoring all rules".format(ipt))
+            desired = None
+            payload = compile_restore(rules)
+
+        else:
+            try:
+                desired = simulate(copy.deepcopy(live), rules)
+                payload = diff_rulesets(live, desired)
+
+            except (TypeError, ValueError, IndexError) as e:
+                logging.debug("iptables: unable to compute difference - {}".format(e))
+                desired = None
+                payload = compile_restore(rules)
+
+        if payload == "":
+            logging.debug("iptables: active {} rules are up to date".format(ipt))
+            return True
+
+        if restore_rules(payload, ipt=ipt) is True:
+            ruleset[ipt] = desired
+            return True
+
+        ruleset[ipt] = None
+        return False
+
+
+def restore_rules(payload, ipt="ip4", noflush=True):
+    if ipt == "ip4":
+        restore_cmd = ["iptables-restore", "--wait"]
+    else:
+        restore_cmd = ["ip6tables-restore", "--wait"]
+
+    if noflush is True:
+        restore_cmd.append("--noflush")
+
+    try:
+        run(restore_cmd, input=payload.encode("utf-8"), stdout=devnull, stderr=PIPE, check=True)
+        logging.debug("{}: committed {} changes in one transaction".format(
+            restore_cmd[0], payload.count("\n-")))
+        return True
+
+    except CalledProcessError as e:
+        logging.warning("{}: transaction failed - {}".format(
+            restore_cmd[0], e.stderr.decode("utf-8").strip()))
+
+    except FileNotFoundError:
+        logging.warning("{} not found".format(restore_cmd[0]))
+
+    return False
+
+
+def batch_rule(rules):
+    return commit_rules(rules)
 
 
 def batch_rule_6(rules):
     if check_ipv6() is True:
+        return commit_rules(rules, ipt="ip6")
+
+    return True
+
+
+def batch_rules(rules, rules_6):
+    return run_families(commit_rules, rules, rules_6)
+
+
+def commit_rules(rules, ipt="ip4"):
+    if engine == "nftables":
+        rules = nftables.batch_rule(rules, ipt=ipt)
+
+    if len(rules) == 0:
+        return True
+
+    with locks[ipt]:
+        #skip rules that already exist or have already been deleted
+        live = read_ruleset(ipt=ipt)
+        pending = []
         for rule in rules:
-            add_rule(rule, check=1, ipt="ip6")
+            exists = rule_exists(rule, ipt=ipt)
+            if exists is True and "-D" not in rule:
+                logging.debug("iptables: {} already exists".format(rule))
+            elif exists is False and "-D" in rule:
+                logging.debug("iptables: {} does not exist".format(rule))
+            else:
+                pending.append(rule)
+
+        if update_rules(pending, ipt=ipt, live=live) is True:
+            return True
+
+        logging.info("iptables: applying {} rules one by one".format(ipt))
+        return add_rules(rules, ipt=ipt)
+
+
+def add_rules(rules, ipt="ip4"):
+    with locks[ipt]:
+        if ruleset[ipt] is None:
+            read_ruleset(ipt=ipt)
+
+        results = [set_rule(rule, check=1, ipt=ipt) for rule in rules]
+        return all(results)
 
 
 def save_existing_rules(fw_rules):
+    omit = fw_rules["ipv4rules"] + fw_rules["flush"] + fw_rules["ipv4local"] + [allowlist_rule()]
+    preserve_rules(["iptables", "-S"], omit, saved_rules)
+
+
+def save_existing_rules_6(fw_rules):
+    if check_ipv6() is True:
+        omit = fw_rules["ipv6rules"] + fw_rules["flushv6"] + fw_rules["ipv6local"] + [allowlist_rule(ipt="ip6")]
+        preserve_rules(["ip6tables", "-S"], omit, saved_rules_6)
+
+
+def preserve_rules(list_cmd, omit, saved):
+    omit = {rule_key(x) for x in omit}
+    known = {rule_key(x) for x in saved}
+
     try:
-        existing_rules = check_output(["iptables", "-S"]).decode("utf-8")
+        existing_rules = check_output(list_cmd).decode("utf-8")
         for line in existing_rules.split('\n'):
             rpl = line.replace("/32", "")
             rule = shlex.split(rpl)
             if len(rule) != 0:
-                match = 0
-                omit = fw_rules["ipv4rules"] + fw_rules["flush"] + fw_rules["ipv4local"]
-                for x in omit:
-                    if Counter(x) == Counter(rule):
-                        match = 1
-                if match == 0 and rule not in saved_rules:
-                    saved_rules.append(rule)
-                match = 0
+                key = rule_key(rule)
+                if key not in omit and key not in known:
+                    saved.append(rule)
+                    known.add(key)
 
     except (CalledProcessError, FileNotFoundError) as e:
-        logging.error("ip4tables: Could not read active rules - {}".format(e))
+        logging.error("{}: Could not read active rules - {}".format(list_cmd[0], e))
 
 
-def save_existing_rules_6(fw_rules):
-    if check_ipv6() is True:
-        try:
-            existing_rules = check_output(["ip6tables", "-S"]).decode("utf-8")
-            for line in existing_rules.split('\n'):
-                rpl = line.replace("/32", "")
-                rule = shlex.split(rpl)
-                if len(rule) != 0:
-                    match = 0
-                    omit = fw_rules["ipv6rules"] + \
-                        fw_rules["flushv6"] + fw_rules["ipv6local"]
-                    for x in omit:
-                        if Counter(x) == Counter(rule):
-                            match = 1
-                    if match == 0 and rule not in saved_rules_6:
-                        saved_rules_6.append(rule)
-                    match = 0
-
-        except (CalledProcessError, FileNotFoundError) as e:
-            logging.error(
-                "ip6tables: Could not read active rules - {}".format(e))
-
-
-def allow_dest_ip(ip, action):
+def allow_dest_ip(ip, action, timeout=None):
     rule = [action, 'OUTPUT', '-d', ip, '-j', 'ACCEPT']
 
     try:
         if len(ip.split(".")) == 4:
-            add_rule(rule)
+            ipt = "ip4"
 
         elif len(ip.split(":")) >= 4:
-            if check_ipv6() is True:
-                add_rule(rule, ipt="ip6")
+            ipt = "ip6"
+            if check_ipv6() is False:
+                return
+
+        else:
+            raise ValueError
+
+        if engine == "nftables":
+            nftables.allow_dest_ip(ip, action, ipt=ipt, timeout=timeout)
+
+        elif ipset_available is not True or update_allowlist(ip, action, ipt=ipt, timeout=timeout) is False:
+            add_rule(rule, ipt=ipt)
+
     except BaseException:
         logging.error("{} is not a valid ip address".format(ip))
 
 
+def allow_temporary(ips, timeout):
+    """Allow a batch of destinations for timeout seconds
+
+    Returns False if the entries would not expire on their own, which
+    is the case when falling back to single iptables rules.
+    """
+    families = {"ip4": [], "ip6": []}
+    for ip in ips:
+        if len(ip.split(".")) == 4:
+            families["ip4"].append(ip)
+        elif len(ip.split(":")) >= 4 and check_ipv6() is True:
+            families["ip6"].append(ip)
+
+    if engine == "nftables":
+        for ipt, batch in families.items():
+            if len(batch) != 0:
+                nftables.allow_dest_ips(batch, "-I", ipt=ipt, timeout=timeout)
+        return True
+
+    if ipset_available is not True:
+        return False
+
+    #one ipset restore instead of an ipset process per address
+    payload = "".join("add {} {} timeout {}\n".format(IPSETS[ipt], ip, int(timeout))
+                      for ipt, batch in families.items() for ip in batch)
+
+    try:
+        run(["ipset", "restore", "-exist"], input=payload.encode("utf-8"), stdout=devnull, stderr=PIPE, check=True)
+        logging.debug("ipset: allowed {} addresses for {} s".format(len(payload.splitlines()), timeout))
+        return True
+
+    except CalledProcessError as e:
+        logging.warning("ipset: failed to allow addresses - {}".format(e.stderr.decode("utf-8").strip()))
+
+    except FileNotFoundError:
+        logging.warning("ipset not found")
+
+    return False
+
+
+def create_allowlist():
+    global ipset_available
+
+    try:
+        for ipt, name in IPSETS.items():
+            family = "inet" if ipt == "ip4" else "inet6"
+            check_call(["ipset", "create", name, "hash:ip", "family", family, "timeout", "0", "-exist"],
+                       stdout=devnull, stderr=devnull)
+
+        logging.debug("ipset: created sets {}".format(", ".join(IPSETS.values())))
+        ipset_available = True
+
+    except (CalledProcessError, FileNotFoundError):
+        logging.info("ipset not available - whitelisting servers with single iptables rules")
+        ipset_available = False
+
+    return ipset_available
+
+
+def allowlist_rule(ipt="ip4"):
+    return ["-A", "OUTPUT", "-m", "set", "--match-set", IPSETS[ipt], "dst", "-j", "ACCEPT"]
+
+
+def update_allowlist(ip, action, ipt="ip4", timeout=None):
+    if action == "-I":
+        #a timeout of 0 means the entry is kept until it is deleted
+        cmd = ["ipset", "add", IPSETS[ipt], ip, "timeout", str(int(timeout or 0)), "-exist"]
+    else:
+        cmd = ["ipset", "del", IPSETS[ipt], ip, "-exist"]
+
+    try:
+        check_call(cmd, stdout=devnull, stderr=devnull)
+        logging.debug("ipset: {} {} in set {}".format(cmd[1], ip, IPSETS[ipt]))
+        return True
+
+    except (CalledProcessError, FileNotFoundError):
+        logging.warning("ipset: failed to {} {} in set {}".format(cmd[1], ip, IPSETS[ipt]))
+        return False
+
+
 def get_config():
     try:
         with open("{}/firewall.json".format(config.ROOTDIR), "r") as f:
@@ -194,48 +850,89 @@ def check_firewall_services():
     return detected_firewall
 
 
-def save_iptables():
+def journal_path(ipt="ip4"):
+    return "{}/firewall_journal_{}.json".format(config.ROOTDIR, ipt)
+
+
+def journal_begin(ipt, opt, snapshot, payload):
+    entry = {"intent": opt, "snapshot": snapshot, "payload": payload}
+    path = journal_path(ipt)
+
     try:
-        outfile = open("{}/iptables_before.rules".format(config.ROOTDIR), "w")
-        save = Popen(["iptables-save"], stdout=outfile, stderr=PIPE)
-        save.wait()
-        outfile.flush()
-        logging.debug("Saved iptables rules")
+        persist.write_json(path, entry)
 
-    except (CalledProcessError, FileNotFoundError):
-        logging.debug("Failed to save current iptables rules")
+    except OSError as e:
+        logging.debug("Failed to write firewall journal - {}".format(e))
 
-    if check_ipv6() is True:
+
+def journal_end(ipt):
+    try:
+        os.remove(journal_path(ipt))
+
+    except FileNotFoundError:
+        pass
+
+
+#complete or undo transactions that were interrupted by a crash
+def recover():
+    for ipt in ["ip4", "ip6"]:
 
         try:
-            outfile6 = open("{}/ip6tables_before.rules".format(config.ROOTDIR), "w")
-            save6 = Popen(["ip6tables-save"], stdout=outfile, stderr=PIPE)
-            save6.wait()
-            outfile6.flush()
-            logging.debug("Saved ip6tables rules")
+            with open(journal_path(ipt), "r") as j:
+                entry = json.load(j)
 
-        except (CalledProcessError, FileNotFoundError):
-            logging.debug("Failed to save current ip6tables rules")
+        except FileNotFoundError:
+            continue
 
+        except (OSError, json.decoder.JSONDecodeError) as e:
+            logging.warning("{}: discarding unreadable firewall journal - {}".format(ipt, e))
+            journal_end(ipt)
+            continue
 
-def restore_iptables():
-    try:
-        restore = Popen(
-            ["iptables-restore", "{}/iptables_before.rules".format(config.ROOTDIR)],
-            stderr=PIPE)
-        logging.debug("Restored previous iptables rules")
+        #never leave the system less protected than intended
+        if entry["intent"] == 1:
+            logging.warning("{}: replaying interrupted firewall transaction".format(ipt))
+            payload = entry["payload"]
+        else:
+            logging.warning("{}: rolling back interrupted firewall transaction".format(ipt))
+            payload = entry["snapshot"]
 
-    except (CalledProcessError, FileNotFoundError):
-        logging.debug("FileNotFoundError: Failed to restore iptables rules")
+        with locks[ipt]:
+            restore_rules(payload, ipt=ipt, noflush=False)
+            ruleset[ipt] = None
+            journal_end(ipt)
 
+
+def save_iptables():
+    families = [("iptables-save", "iptables_before.rules")]
     if check_ipv6() is True:
+        families.append(("ip6tables-save", "ip6tables_before.rules"))
+
+    for save_cmd, rules_file in families:
 
         try:
-            restore = Popen(["ip6tables-restore",
-                             "{}/ip6tables_before.rules".format(config.ROOTDIR)],
-                            stderr=PIPE)
-            logging.debug("Restored previous ip6tables rules")
+            with open("{}/{}".format(config.ROOTDIR, rules_file), "w") as outfile:
+                run([save_cmd], stdout=outfile, stderr=PIPE, check=True)
+            logging.debug("Saved {} rules".format(save_cmd[:-5]))
 
         except (CalledProcessError, FileNotFoundError):
-            logging.debug(
-                "FileNotFoundError: Failed to restore ip6tables rules")
+            logging.debug("Failed to save current {} rules".format(save_cmd[:-5]))
+
+
+def restore_iptables():
+    families = [("ip4", "iptables_before.rules")]
+    if check_ipv6() is True:
+        families.append(("ip6", "ip6tables_before.rules"))
+
+    for ipt, rules_file in families:
+
+        try:
+            with open("{}/{}".format(config.ROOTDIR, rules_file), "r") as infile, locks[ipt]:
+                restored = restore_rules(infile.read(), ipt=ipt, noflush=False)
+                ruleset[ipt] = None
+
+            if restored is True:
+                logging.debug("Restored previous {} rules".format(ipt))
+
+        except FileNotFoundError:
+            logging.debug("FileNotFoundError: Failed to restore {} rules".format(ipt))
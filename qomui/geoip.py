@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import csv
+import mmap
+import json
+import socket
+import struct
+import logging
+import threading
+from subprocess import CalledProcessError, check_output
+
+from qomui import config
+
+TABLE = "{}/geoip.table".format(config.ROOTDIR)
+COUNTRIES = "{}/countries.json".format(config.ROOTDIR)
+MAGIC = b"QGEO"
+HEADER = struct.Struct("!4sII")
+#start, end and country code - big endian so ranges sort as plain bytes
+RANGES = {4: struct.Struct("!4s4s2s"), 16: struct.Struct("!16s16s2s")}
+
+#legacy databases from geoip-database, the same ones geoiplookup reads
+GEOIP_DAT = ["/usr/share/GeoIP/GeoIP.dat", "/usr/share/GeoIP/GeoIPv6.dat"]
+COUNTRY_BEGIN = 16776960
+EDITIONS = {1: 32, 12: 128}
+GEOIP_CODES = (
+    "--", "AP", "EU", "AD", "AE", "AF", "AG", "AI", "AL", "AM", "CW", "AO", "AQ",
+    "AR", "AS", "AT", "AU", "AW", "AZ", "BA", "BB", "BD", "BE", "BF", "BG",
+    "BH", "BI", "BJ", "BM", "BN", "BO", "BR", "BS", "BT", "BV", "BW", "BY",
+    "BZ", "CA", "CC", "CD", "CF", "CG", "CH", "CI", "CK", "CL", "CM", "CN",
+    "CO", "CR", "CU", "CV", "CX", "CY", "CZ", "DE", "DJ", "DK", "DM", "DO",
+    "DZ", "EC", "EE", "EG", "EH", "ER", "ES", "ET", "FI", "FJ", "FK", "FM",
+    "FO", "FR", "SX", "GA", "GB", "GD", "GE", "GF", "GH", "GI", "GL", "GM",
+    "GN", "GP", "GQ", "GR", "GS", "GT", "GU", "GW", "GY", "HK", "HM", "HN",
+    "HR", "HT", "HU", "ID", "IE", "IL", "IN", "IO", "IQ", "IR", "IS", "IT",
+    "JM", "JO", "JP", "KE", "KG", "KH", "KI", "KM", "KN", "KP", "KR", "KW",
+    "KY", "KZ", "LA", "LB", "LC", "LI", "LK", "LR", "LS", "LT", "LU", "LV",
+    "LY", "MA", "MC", "MD", "MG", "MH", "MK", "ML", "MM", "MN", "MO", "MP",
+    "MQ", "MR", "MS", "MT", "MU", "MV", "MW", "MX", "MY", "MZ", "NA", "NC",
+    "NE", "NF", "NG", "NI", "NL", "NO", "NP", "NR", "NU", "NZ", "OM", "PA",
+    "PE", "PF", "PG", "PH", "PK", "PL", "PM", "PN", "PR", "PS", "PT", "PW",
+    "PY", "QA", "RE", "RO", "RU", "RW", "SA", "SB", "SC", "SD", "SE", "SG",
+    "SH", "SI", "SJ", "SK", "SL", "SM", "SN", "SO", "SR", "ST", "SV", "SY",
+    "SZ", "TC", "TD", "TF", "TG", "TH", "TJ", "TK", "TM", "TN", "TO", "TL",
+    "TR", "TT", "TV", "TW", "TZ", "UA", "UG", "UM", "US", "UY", "UZ", "VA",
+    "VC", "VE", "VG", "VI", "VN", "VU", "WF", "WS", "YE", "YT", "RS", "ZA",
+    "ZM", "ME", "ZW", "A1", "A2", "O1", "AX", "GG", "IM", "JE", "BL", "MF",
+    "BQ", "SS", "O1"
+    )
+
+countries = None
+table = None
+lock = threading.Lock()
+
+
+def country_name(cc):
+    global countries
+
+    if countries is None:
+        with lock:
+            if countries is None:
+                try:
+                    with open(COUNTRIES, "r") as c_json:
+                        countries = json.load(c_json)
+
+                except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
+                    logging.error("Could not load {}: {}".format(COUNTRIES, e))
+                    countries = {}
+
+    try:
+        return countries[cc.upper()]
+
+    except (KeyError, AttributeError):
+        return "Unknown"
+
+
+def pack(ip):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(family, ip)
+        except (OSError, ValueError, TypeError):
+            pass
+    return None
+
+
+class RangeTable(object):
+    """Sorted, non-overlapping ip ranges read straight from a mmap'd file
+
+    Layout: header (magic, number of ipv4 and ipv6 ranges) followed by
+    the ipv4 and then the ipv6 ranges.
+    """
+
+    def __init__(self, path=TABLE):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, n4, n6 = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError("{} is not a geoip table".format(path))
+
+        self.sections = {
+            4: (HEADER.size, n4),
+            16: (HEADER.size + n4 * RANGES[4].size, n6)
+            }
+
+    def record(self, width, i):
+        offset, _ = self.sections[width]
+        return RANGES[width].unpack_from(self.map, offset + i * RANGES[width].size)
+
+    def find(self, packed, lo=0):
+        """Return (country code or None, index to start the next, larger search from)"""
+        width = len(packed)
+        hi = self.sections[width][1]
+
+        #last range starting at or below packed
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record(width, mid)[0] <= packed:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == 0:
+            return None, 0
+
+        start, end, cc = self.record(width, lo - 1)
+        if packed <= end:
+            return cc.decode("ascii"), lo - 1
+        return None, lo - 1
+
+    def lookup_many(self, ips):
+        #sorted queries only ever move forward in the table
+        found = {}
+        packed = sorted((p, ip) for ip, p in ((ip, pack(ip)) for ip in set(ips)) if p is not None)
+        lo = {4: 0, 16: 0}
+
+        for p, ip in packed:
+            found[ip], lo[len(p)] = self.find(p, lo[len(p)])
+
+        return found
+
+    def close(self):
+        self.map.close()
+
+
+def available_sources():
+    return [s for s in GEOIP_DAT if os.path.exists(s)]
+
+
+def stale(sources):
+    if len(sources) == 0:
+        return False
+
+    try:
+        built = os.path.getmtime(TABLE)
+
+    except OSError:
+        return True
+
+    return any(os.path.getmtime(s) > built for s in sources)
+
+
+def load_table():
+    """Open the range table, (re)building it from geoip-database if needed
+
+    Building needs write access to ROOTDIR, so it happens in the service.
+    """
+    global table
+
+    with lock:
+        if table is None:
+            sources = available_sources()
+            if stale(sources):
+                try:
+                    n4, n6 = build(*sources)
+                    logging.info("Built {} with {} ipv4 and {} ipv6 ranges".format(TABLE, n4, n6))
+
+                except (OSError, ValueError, IndexError) as e:
+                    logging.debug("Could not build {}: {}".format(TABLE, e))
+
+            try:
+                table = RangeTable(TABLE)
+
+            except FileNotFoundError:
+                table = False
+
+            except (OSError, ValueError, struct.error) as e:
+                logging.error("Failed to load {}: {}".format(TABLE, e))
+                table = False
+
+    return table or None
+
+
+def geoiplookup(ip):
+    try:
+        country_check = check_output(["geoiplookup", "{}".format(ip)]).decode("utf-8")
+        cc = country_check.split(" ")[3].split(",")[0]
+        return cc if len(cc) == 2 else None
+
+    except (FileNotFoundError, CalledProcessError, IndexError):
+        return None
+
+
+def lookup_many(ips):
+    """Map each ip to its two letter country code, None if unknown"""
+    t = load_table()
+    if t is not None:
+        return t.lookup_many(ips)
+
+    return {ip: geoiplookup(ip) for ip in set(ips)}
+
+
+def countries_of(ips):
+    return {ip: country_name(cc) if cc is not None else "Unknown" for ip, cc in lookup_many(ips).items()}
+
+
+def read_csv(source, ranges):
+    """Add the ranges of a csv of start ip, end ip, ..., country code
+
+    Works with the dbip country lite csv and the legacy GeoIP country csv.
+    """
+    with open(source, "r", newline="") as f:
+        for row in csv.reader(f):
+            if len(row) < 3:
+                continue
+
+            start, end = pack(row[0].strip()), pack(row[1].strip())
+            cc = next((c.strip() for c in row[2:] if len(c.strip()) == 2 and c.strip().isalpha()), None)
+            if start is None or end is None or len(start) != len(end) or cc is None:
+                continue
+
+            ranges[len(start)].append((start, end, cc.upper().encode("ascii")))
+
+
+def dat_edition(data):
+    #the structure info is marked by three 0xff bytes near the end of the file
+    for i in range(20):
+        pos = len(data) - 3 - i
+        if pos >= 0 and data[pos:pos + 3] == b"\xff\xff\xff":
+            edition = data[pos + 3]
+            return edition - 105 if edition >= 106 else edition
+
+    return 1
+
+
+def read_dat(source, ranges):
+    """Add the ranges of a legacy GeoIP country database
+
+    The file is a binary trie - each node holds two 3 byte little endian
+    records for the next bit being 0 or 1, records from COUNTRY_BEGIN on
+    are leaves holding the index of a country code.
+    """
+    with open(source, "rb") as f:
+        data = f.read()
+
+    edition = dat_edition(data)
+    if edition not in EDITIONS:
+        raise ValueError("{} is not a GeoIP country database".format(source))
+
+    bits = EDITIONS[edition]
+    stack = [(0, 0, bits)]
+
+    while stack:
+        node, prefix, depth = stack.pop()
+        if node * 6 + 6 > len(data):
+            raise ValueError("{} is truncated".format(source))
+
+        for bit in (0, 1):
+            rec = int.from_bytes(data[node * 6 + bit * 3:node * 6 + bit * 3 + 3], "little")
+            start = prefix | (bit << (depth - 1))
+
+            if rec >= COUNTRY_BEGIN:
+                index = rec - COUNTRY_BEGIN
+                if 0 < index < len(GEOIP_CODES):
+                    end = start + (1 << (depth - 1)) - 1
+                    ranges[bits // 8].append((start.to_bytes(bits // 8, "big"), end.to_bytes(bits // 8, "big"),
+                                              GEOIP_CODES[index].encode("ascii")))
+
+            elif depth > 1:
+                stack.append((rec, start, depth - 1))
+
+
+def merge(ranges):
+    #adjacent ranges of one country become one, overlapping ones are dropped
+    merged = []
+    for start, end, cc in sorted(ranges):
+        if len(merged) != 0:
+            prev_start, prev_end, prev_cc = merged[-1]
+            if start <= prev_end:
+                continue
+
+            if cc == prev_cc and int.from_bytes(start, "big") == int.from_bytes(prev_end, "big") + 1:
+                merged[-1] = (prev_start, end, cc)
+                continue
+
+        merged.append((start, end, cc))
+
+    return merged
+
+
+def build(*sources, dest=TABLE):
+    """Build a table from legacy GeoIP databases (.dat) and country csv files"""
+    ranges = {4: [], 16: []}
+
+    for source in sources:
+        if source.endswith(".dat"):
+            read_dat(source, ranges)
+        else:
+            read_csv(source, ranges)
+
+    ranges = {width: merge(r) for width, r in ranges.items()}
+
+    with open("{}.tmp".format(dest), "wb") as t:
+        t.write(HEADER.pack(MAGIC, len(ranges[4]), len(ranges[16])))
+        for width in (4, 16):
+            for r in ranges[width]:
+                t.write(RANGES[width].pack(*r))
+
+    os.replace("{}.tmp".format(dest), dest)
+    os.chmod(dest, 0o644)
+    return len(ranges[4]), len(ranges[16])
+
+
+if __name__ == "__main__":
+    sources = sys.argv[1:] or available_sources()
+    if len(sources) == 0:
+        print("Usage: python3 -m qomui.geoip [GeoIP.dat or country csv]...")
+        sys.exit(1)
+
+    n4, n6 = build(*sources)
+    print("Wrote {} ipv4 and {} ipv6 ranges to {}".format(n4, n6, TABLE))
@@ -3,67 +3,528 @@
 
 from PyQt5 import QtCore
 from subprocess import CalledProcessError, check_output
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import re
+import os
+import json
+import errno
+import time
+import select
+import socket
+import heapq
+import struct
+import threading
+import statistics
 import logging
 
+from qomui import config, utils, persist
+
+TIMEOUT = 1.0
+SPACING = 0.25
+POLL = 0.2
+SO_BINDTODEVICE = 25
+TTL = 900
+BACKOFF_MAX = 21600
+SAVE_INTERVAL = 10
+#how long probe destinations stay open while the killswitch is active
+ALLOW_TIMEOUT = 900
+
+
+def summarize(samples, count):
+    rtts = [x for x in samples if x is not None]
+    loss = round(1 - len(rtts) / count, 3)
+
+    if len(rtts) == 0:
+        return {"rtt": None, "p90": None, "jitter": None, "loss": 1.0}
+
+    ordered = sorted(rtts)
+    p90 = ordered[min(len(ordered) - 1, int(0.9 * len(ordered)))]
+
+    #mean difference between consecutive samples
+    jitter = 0
+    if len(rtts) > 1:
+        jitter = sum(abs(a - b) for a, b in zip(rtts, rtts[1:])) / (len(rtts) - 1)
+
+    return {
+        "rtt": round(statistics.median(rtts), 3),
+        "p90": round(p90, 3),
+        "jitter": round(jitter, 3),
+        "loss": loss
+        }
+
+
+#lower is better - jitter and packet loss are weighted against the median
+def score(entry, weights):
+    if entry is None or entry.get("rtt") is None:
+        return 999.0
+
+    result = entry["rtt"]
+    result += weights.get("jitter", 0) * (entry.get("jitter") or 0)
+    result += weights.get("loss", 0) * (entry.get("loss") or 0)
+    return round(result, 3)
+
+
+def server_ip(server):
+    try:
+        return server["ip"]
+    except KeyError:
+        try:
+            return server["ip1"]
+        except KeyError:
+            return server["prim_ip"]
+
+
+class LatencyStore(object):
+    def __init__(self, path=None):
+        if path is None:
+            path = "{}/latency.json".format(config.HOMEDIR)
+        self.path = path
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as l:
+                self.entries = json.load(l)
+
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            self.entries = {}
+
+    def save(self):
+        try:
+            persist.write_json(self.path, self.entries)
+
+        except OSError as e:
+            logging.debug("Failed to save latency cache: {}".format(e))
+
+    def prune(self, keys):
+        for k in [k for k in self.entries if k not in keys]:
+            del self.entries[k]
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def update(self, key, stats, received=1):
+        entry = self.entries.setdefault(key, {"rtt": None, "samples": 0, "time": 0, "failures": 0})
+        entry.update(stats)
+        entry["time"] = time.time()
+        entry["samples"] += received
+
+        if stats["rtt"] is not None:
+            entry["failures"] = 0
+        else:
+            entry["failures"] += 1
+
+    #servers that keep failing are probed less and less often
+    def due(self, key, now=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return True
+
+        if now is None:
+            now = time.time()
+
+        interval = min(TTL * 2 ** entry["failures"], BACKOFF_MAX)
+        return now - entry["time"] >= interval
+
 
 class LatencyCheck(QtCore.QThread):
     lat_signal = QtCore.pyqtSignal(tuple)
     finished = QtCore.pyqtSignal()
 
-    def __init__(self, server_dict, interface):
+    def __init__(self, server_dict, interface, limit=64, store=None, samples=3, weights=None,
+                 protocol_dict=None, mode="auto"):
         QtCore.QThread.__init__(self)
         self.server_dict = server_dict
         self.interface = interface
+        self.limit = max(1, int(limit))
+        self.store = store
+        self.samples = max(1, int(samples))
+        self.weights = weights or {}
+        self.protocol_dict = protocol_dict or {}
+        self.mode = mode
+        self.retry = []
+        self.order = {}
+        self.priority = {}
+        self.reprioritise = False
+        self.cancelled = threading.Event()
+        self.last_save = time.time()
+
+    #may be called from the gui thread while the scan is running
+    def set_priority(self, keys):
+        priority = {}
+        for k in keys:
+            if k not in priority:
+                priority[k] = len(priority)
+
+        self.priority = priority
+        self.reprioritise = True
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def rank(self, key):
+        priority = self.priority
+        try:
+            return priority[key]
+        except KeyError:
+            return len(priority) + self.order.get(key, 0)
 
     def sort_by_latency(self, server):
+        latency = getattr(server[1], "latency", None)
+        if latency is not None:
+            return latency
+
         try:
             return float(server[1]["latency"])
         except KeyError:
             return 999
 
+    def get_ip(self, server):
+        return server_ip(server)
+
     def run(self):
         try:
-            for k, v in sorted(
+            targets = []
+            fallback = []
+            now = time.time()
+            if self.store is not None:
+                self.store.prune(self.server_dict)
+
+            for i, (k, v) in enumerate(sorted(
                     self.server_dict.items(),
-                    key=self.sort_by_latency):
-                try:
-                    ip = v["ip"]
-                except KeyError:
-                    try:
-                        ip = v["ip1"]
-                    except KeyError:
-                        ip = v["prim_ip"]
+                    key=self.sort_by_latency)):
+                self.order[k] = i
 
-                try:
-                    pinger = check_output(["ping",
-                                           "-c",
-                                           "1",
-                                           "-W",
-                                           "1",
-                                           "-I",
-                                           "{}".format(self.interface),
-                                           "{}".format(ip)]).decode("utf-8")
-                    latencysearch = re.search(
-                        r'rtt min/avg/max/mdev = \d+(?:\.\d+)?/\d+(?:\.\d+)?/\d+(?:\.\d+)?/\d+(?:\.\d+)?',
-                        pinger)
-                    if latencysearch is not None:
-                        latencyraw = str(latencysearch.group())
-                        latency = latencyraw.split("/")[4]
-                    else:
-                        latency = "999"
-                except CalledProcessError:
-                    latency = "999"
-
-                latency_float = float(latency)
-                if latency != "999":
-                    latency_string = "{0:.1f} ms".format(latency_float)
+                #recent results are shown right away instead of probing again
+                if self.store is not None and not self.store.due(k, now):
+                    self.emit_result(k, self.store.get(k))
+                    continue
+
+                ip = self.get_ip(v)
+                if self.mode == "handshake":
+                    self.retry.append(k)
+                elif ":" in ip:
+                    fallback.append((k, ip))
                 else:
-                    latency_string = "N.A."
+                    targets.append((k, ip))
+
+            sock = self.open_socket()
+            if sock is None:
+                fallback = targets + fallback
+                targets = []
 
-                self.lat_signal.emit((k, latency_string, latency_float))
+            else:
+                with sock:
+                    self.probe_socket(sock, targets)
+
+            self.probe_ping(fallback)
+
+            #servers that drop icmp are timed by connecting to their vpn port
+            self.probe_handshake(self.retry)
 
         except RuntimeError:
             logging.debug("RuntimeError: Latency check is already running")
 
+        if self.store is not None:
+            self.store.save()
+
+        if self.cancelled.is_set():
+            logging.debug("Latency check cancelled")
+
         self.finished.emit()
+
+    def report(self, key, samples, method="icmp"):
+        if self.cancelled.is_set():
+            return
+
+        stats = summarize(samples, self.samples)
+        stats["method"] = method
+
+        if self.mode == "auto" and method == "icmp" and stats["rtt"] is None:
+            self.retry.append(key)
+            return
+
+        if self.store is not None:
+            self.store.update(key, stats, received=len([x for x in samples if x is not None]))
+
+            if time.time() - self.last_save > SAVE_INTERVAL:
+                self.store.save()
+                self.last_save = time.time()
+
+        self.emit_result(key, stats)
+
+    def emit_result(self, key, stats):
+        latency = stats.get("rtt") if stats is not None else None
+
+        if latency is not None:
+            latency_float = round(latency, 3)
+            latency_string = "{0:.1f} ms".format(latency_float)
+        else:
+            latency_float = 999.0
+            latency_string = "N.A."
+
+        self.lat_signal.emit((key, latency_string, latency_float, score(stats, self.weights)))
+
+    #unprivileged icmp sockets need net.ipv4.ping_group_range to include the user
+    def open_socket(self):
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            sock.setblocking(False)
+
+        except (OSError, AttributeError) as e:
+            logging.debug("ICMP datagram socket not available - falling back to ping: {}".format(e))
+            return None
+
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, self.interface.encode("utf-8"))
+
+        except OSError:
+            logging.debug("Could not bind latency check to {}".format(self.interface))
+
+        return sock
+
+    def echo_request(self, seq):
+        ident = os.getpid() & 0xffff
+        header = struct.pack("!BBHHH", 8, 0, 0, ident, seq)
+        payload = struct.pack("!d", time.time())
+        data = header + payload
+
+        if len(data) % 2:
+            data += b"\0"
+        checksum = sum(struct.unpack("!{}H".format(len(data) // 2), data))
+        checksum = (checksum >> 16) + (checksum & 0xffff)
+        checksum = ~(checksum + (checksum >> 16)) & 0xffff
+
+        return struct.pack("!BBHHH", 8, 0, checksum, ident, seq) + payload
+
+    def probe_socket(self, sock, targets):
+        #servers waiting for their next sample are only ranked once it is due
+        ready = [(self.rank(key), key, ip) for key, ip in targets]
+        heapq.heapify(ready)
+        delayed = []
+        results = {key: [] for key, ip in targets}
+        pending = {}
+        seq = 0
+
+        def done(key, ip, rtt):
+            results[key].append(rtt)
+            if len(results[key]) < self.samples:
+                heapq.heappush(delayed, (time.time() + SPACING, key, ip))
+            else:
+                self.report(key, results.pop(key))
+
+        while (ready or delayed or pending) and not self.cancelled.is_set():
+            now = time.time()
+
+            while delayed and delayed[0][0] <= now:
+                due, key, ip = heapq.heappop(delayed)
+                heapq.heappush(ready, (self.rank(key), key, ip))
+
+            if self.reprioritise is True:
+                self.reprioritise = False
+                ready = [(self.rank(key), key, ip) for r, key, ip in ready]
+                heapq.heapify(ready)
+
+            #keep at most self.limit requests in flight
+            while ready and len(pending) < self.limit:
+                r, key, ip = heapq.heappop(ready)
+                seq = (seq + 1) & 0xffff
+
+                try:
+                    sock.sendto(self.echo_request(seq), (ip, 0))
+                    pending[(ip, seq)] = (key, time.time())
+
+                except OSError:
+                    done(key, ip, None)
+
+            delay = POLL
+            if pending:
+                oldest = next(iter(pending.values()))[1]
+                delay = min(delay, oldest + TIMEOUT - now)
+            if delayed:
+                delay = min(delay, delayed[0][0] - now)
+
+            if select.select([sock], [], [], max(0, delay))[0]:
+
+                while True:
+                    try:
+                        data, addr = sock.recvfrom(1024)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except OSError:
+                        break
+
+                    received = time.time()
+                    if len(data) < 8 or data[0] != 0:
+                        continue
+
+                    reply_seq = struct.unpack("!H", data[6:8])[0]
+                    entry = pending.pop((addr[0], reply_seq), None)
+                    if entry is not None:
+                        done(entry[0], addr[0], (received - entry[1]) * 1000)
+
+            #requests are ordered by the time they were sent
+            now = time.time()
+            for target, (key, sent) in list(pending.items()):
+                if now - sent < TIMEOUT:
+                    break
+                del pending[target]
+                done(key, target[0], None)
+
+    def run_pool(self, items, func, callback):
+        queue = [(self.rank(key), key) for key in items]
+        heapq.heapify(queue)
+        running = {}
+        pool = ThreadPoolExecutor(max_workers=max(1, min(self.limit, len(items))))
+
+        while (queue or running) and not self.cancelled.is_set():
+            if self.reprioritise is True:
+                self.reprioritise = False
+                queue = [(self.rank(key), key) for r, key in queue]
+                heapq.heapify(queue)
+
+            #only submit what can run right away so that priorities still apply
+            while queue and len(running) < self.limit:
+                r, key = heapq.heappop(queue)
+                running[pool.submit(func, items[key])] = key
+
+            finished, unfinished = wait(list(running), timeout=POLL, return_when=FIRST_COMPLETED)
+            for future in finished:
+                callback(running.pop(future), future.result())
+
+        #probes of a cancelled scan finish in the background
+        pool.shutdown(wait=not self.cancelled.is_set())
+
+    def probe_ping(self, targets):
+        if not targets:
+            return
+
+        self.run_pool(dict(targets), self.ping, self.report)
+
+    def ping(self, ip):
+        samples = []
+
+        try:
+            pinger = check_output(["ping",
+                                   "-c",
+                                   "{}".format(self.samples),
+                                   "-i",
+                                   "{}".format(SPACING),
+                                   "-W",
+                                   "1",
+                                   "-I",
+                                   "{}".format(self.interface),
+                                   "{}".format(ip)]).decode("utf-8")
+            samples = [float(x) for x in re.findall(r'time=(\d+(?:\.\d+)?) ms', pinger)]
+
+        except (CalledProcessError, FileNotFoundError):
+            pass
+
+        return samples + [None] * (self.samples - len(samples))
+
+    def get_port(self, server):
+        try:
+            server = utils.create_server_dict(dict(server), self.protocol_dict, config.SUPPORTED_PROVIDERS)
+            return server["protocol"].upper(), int(server["port"])
+
+        except (KeyError, ValueError, TypeError):
+            return "TCP", 443
+
+    def probe_handshake(self, keys):
+        if not keys:
+            return
+
+        self.run_pool({k: self.server_dict[k] for k in keys}, self.handshake,
+                      lambda key, result: self.report(key, result[0], method=result[1]))
+
+    def handshake(self, server):
+        ip = self.get_ip(server)
+        protocol, port = self.get_port(server)
+
+        #WireGuard only answers authenticated handshakes
+        if protocol == "UDP" and server.get("tunnel") != "WireGuard":
+            probes = [("udp", self.openvpn_udp, port)]
+        elif protocol == "UDP":
+            probes = []
+        else:
+            probes = [("tcp", self.tcp_connect, port)]
+
+        if ("tcp", self.tcp_connect, 443) not in probes:
+            probes.append(("tcp", self.tcp_connect, 443))
+
+        samples = []
+        method = "tcp"
+        for method, probe, p in probes:
+            samples = []
+            for i in range(self.samples):
+                if i != 0:
+                    time.sleep(SPACING)
+                samples.append(probe(ip, p))
+
+            if any(x is not None for x in samples):
+                break
+
+        return samples, method
+
+    def open_stream(self, ip, kind):
+        family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+        sock = socket.socket(family, kind)
+        sock.setblocking(False)
+
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, self.interface.encode("utf-8"))
+        except OSError:
+            pass
+
+        return sock
+
+    #a refused connection still measures a full round trip
+    def tcp_connect(self, ip, port):
+        sock = self.open_stream(ip, socket.SOCK_STREAM)
+
+        try:
+            start = time.time()
+            err = sock.connect_ex((ip, port))
+            if err not in [0, errno.EINPROGRESS]:
+                return None
+
+            if not select.select([], [sock], [], TIMEOUT)[1]:
+                return None
+
+            err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err in [0, errno.ECONNREFUSED]:
+                return (time.time() - start) * 1000
+
+        except OSError:
+            pass
+
+        finally:
+            sock.close()
+
+        return None
+
+    #P_CONTROL_HARD_RESET_CLIENT_V2 - only answered by servers without tls-auth
+    def openvpn_udp(self, ip, port):
+        sock = self.open_stream(ip, socket.SOCK_DGRAM)
+        packet = bytes([7 << 3]) + os.urandom(8) + b"\x00" + struct.pack("!I", 0)
+
+        try:
+            sock.connect((ip, port))
+            start = time.time()
+            sock.send(packet)
+
+            if select.select([sock], [], [], TIMEOUT)[0]:
+                sock.recv(1024)
+                return (time.time() - start) * 1000
+
+        except ConnectionRefusedError:
+            return (time.time() - start) * 1000
+
+        except OSError:
+            pass
+
+        finally:
+            sock.close()
+
+        return None
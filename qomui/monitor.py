@@ -4,6 +4,8 @@
 import os
 import time
 import json
+import select
+import socket
 import psutil
 import requests
 from subprocess import CalledProcessError, check_output
@@ -104,6 +106,39 @@ class NetMon(QtCore.QThread):
             "interface_6": default_interface_6
         }
 
+class AddrMon(QtCore.QThread):
+    addr_change = QtCore.pyqtSignal()
+    log = QtCore.pyqtSignal(tuple)
+    RTMGRP_LINK = 0x1
+    RTMGRP_IPV6_IFADDR = 0x100
+
+    def __init__(self):
+        QtCore.QThread.__init__(self)
+
+    def run(self):
+        try:
+            nl = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            nl.bind((0, self.RTMGRP_LINK | self.RTMGRP_IPV6_IFADDR))
+
+        except (OSError, AttributeError) as e:
+            self.log.emit(("warning", "Could not subscribe to netlink address events: {}".format(e)))
+            return
+
+        while True:
+
+            try:
+                nl.recv(65535)
+
+                #bursts of events are reported as a single change
+                while select.select([nl], [], [], 0.5)[0]:
+                    nl.recv(65535)
+
+                self.addr_change.emit()
+
+            except OSError as e:
+                self.log.emit(("error", e))
+                time.sleep(2)
+
 class TunnelMon(QtCore.QThread):
     stat = QtCore.pyqtSignal(list)
     ip = QtCore.pyqtSignal(dict)
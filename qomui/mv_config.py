@@ -3,11 +3,14 @@
 
 import sys
 import os
-import shutil
 import getopt
-from subprocess import Popen
 
-from qomui import config
+from qomui import config, persist
+
+def install(src, dest):
+    with open(src, "r") as s:
+        persist.write_json(dest, s.read(), mode=0o644)
+    os.remove(src)
 
 def copy(argv):
     try:
@@ -18,22 +21,12 @@ def copy(argv):
         if opt == "-d":
             homedir = arg
             try:
-                shutil.copyfile(
-                    "{}/config_temp.json".format(homedir),
-                    "{}/config.json".format(config.ROOTDIR))
-                Popen(['chown', 'root', '{}/config.json'.format(config.ROOTDIR)])
-                Popen(['chmod', '644', '{}/config.json'.format(config.ROOTDIR)])
-                os.remove("{}/config_temp.json".format(homedir))
+                install("{}/config_temp.json".format(homedir), config.CONFIG_FILE)
             except FileNotFoundError:
                 sys.exit(1)
         if opt == "-f":
             try:
-                shutil.copyfile(
-                    "{}/firewall_temp.json".format(homedir),
-                    "{}/firewall.json".format(config.ROOTDIR))
-                Popen(['chown', 'root', '{}/firewall.json'.format(config.ROOTDIR)])
-                Popen(['chmod', '644', '{}/firewall.json'.format(config.ROOTDIR)])
-                os.remove("{}/firewall_temp.json".format(homedir))
+                install("{}/firewall_temp.json".format(homedir), "{}/firewall.json".format(config.ROOTDIR))
             except FileNotFoundError:
                 pass
 
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import time
+import logging
+from subprocess import run, PIPE, CalledProcessError
+
+TABLE = "qomui"
+CHAINS = {"INPUT": "input", "OUTPUT": "output", "FORWARD": "forward"}
+VERDICTS = {"ACCEPT": "accept", "DROP": "drop", "REJECT": "reject", "RETURN": "return"}
+MODULES = ["state", "conntrack", "tcp", "udp", "icmp", "icmp6", "cgroup", "comment"]
+
+active = False
+allowed = {"ip4": {}, "ip6": {}}
+handles = {}
+
+
+def nft(script, echo=False):
+    nft_cmd = ["nft", "-f", "-"]
+    if echo is True:
+        nft_cmd = ["nft", "--echo", "--handle", "-f", "-"]
+
+    result = run(nft_cmd, input=script.encode("utf-8"), stdout=PIPE, stderr=PIPE, check=True)
+    return result.stdout.decode("utf-8")
+
+
+def translate(rule, ipt="ip4"):
+    if "-t" in rule:
+        raise ValueError("nftables: only the filter table is supported")
+
+    if ipt == "ip4":
+        exprs = ["meta nfproto ipv4"]
+        addr = "ip"
+        icmp = "icmp"
+    else:
+        exprs = ["meta nfproto ipv6"]
+        addr = "ip6"
+        icmp = "icmpv6"
+
+    command = None
+    chain = None
+    verdict = None
+    comment = None
+    proto = None
+    negate = False
+    i = 0
+
+    while i < len(rule):
+        opt = rule[i]
+
+        if opt == "!":
+            negate = True
+            i += 1
+            continue
+
+        try:
+            arg = rule[i + 1]
+        except IndexError:
+            raise ValueError("nftables: missing argument for {}".format(opt))
+
+        op = "!= " if negate is True else ""
+        negate = False
+
+        if opt in ["-A", "-I", "-D"]:
+            command = {"-A": "add", "-I": "insert", "-D": "delete"}[opt]
+            try:
+                chain = CHAINS[arg]
+            except KeyError:
+                raise ValueError("nftables: unsupported chain {}".format(arg))
+
+            #rule numbers have no equivalent - inserted rules always go to the top
+            if command == "insert" and i + 2 < len(rule) and rule[i + 2].isdigit():
+                i += 1
+
+        elif opt in ["-i", "--in-interface"]:
+            exprs.append('iifname {}"{}"'.format(op, arg.replace("+", "*")))
+
+        elif opt in ["-o", "--out-interface"]:
+            exprs.append('oifname {}"{}"'.format(op, arg.replace("+", "*")))
+
+        elif opt in ["-s", "--source"]:
+            exprs.append("{} saddr {}{}".format(addr, op, arg))
+
+        elif opt in ["-d", "--destination"]:
+            exprs.append("{} daddr {}{}".format(addr, op, arg))
+
+        elif opt in ["-p", "--protocol"]:
+            proto = arg.lower()
+            if proto in ["icmpv6", "ipv6-icmp"]:
+                proto = "ipv6-icmp"
+            exprs.append("meta l4proto {}{}".format(op, proto))
+
+        elif opt in ["--dport", "--sport"]:
+            if proto not in ["tcp", "udp"]:
+                raise ValueError("nftables: {} requires tcp or udp".format(opt))
+            exprs.append("{} {} {}{}".format(proto, opt[2:], op, arg.replace(":", "-")))
+
+        elif opt in ["--icmp-type", "--icmpv6-type"]:
+            exprs.append("{} type {}{}".format(icmp, op, arg))
+
+        elif opt in ["--state", "--ctstate"]:
+            exprs.append("ct state {}{}".format(op, arg.lower()))
+
+        elif opt == "--cgroup":
+            exprs.append("meta cgroup {}{}".format(op, int(arg, 0)))
+
+        elif opt == "--comment":
+            comment = 'comment "{}"'.format(arg.replace('"', ""))
+
+        elif opt in ["-m", "--match"]:
+            if arg not in MODULES:
+                raise ValueError("nftables: unsupported match {}".format(arg))
+
+        elif opt in ["-j", "--jump"]:
+            try:
+                verdict = VERDICTS[arg]
+            except KeyError:
+                raise ValueError("nftables: unsupported target {}".format(arg))
+
+        else:
+            raise ValueError("nftables: unsupported option {}".format(opt))
+
+        i += 2
+
+    if command is None or verdict is None:
+        raise ValueError("nftables: cannot translate {}".format(rule))
+
+    exprs.append(verdict)
+    if comment is not None:
+        exprs.append(comment)
+
+    return command, chain, " ".join(exprs)
+
+
+def build_ruleset(fw_rules, block_lan=0):
+    chains = {"input": [], "forward": [], "output": []}
+    policies = {"input": "accept", "forward": "accept", "output": "accept"}
+
+    #whitelisted servers and api hosts are elements of a set
+    chains["output"].append("ip daddr @allow4 accept")
+    chains["output"].append("ip6 daddr @allow6 accept")
+
+    families = [
+        ("ip4", fw_rules["defaults"], fw_rules["ipv4local"], fw_rules["ipv4rules"]),
+        ("ip6", fw_rules["defaultsv6"], fw_rules["ipv6local"], fw_rules["ipv6rules"])
+        ]
+
+    for ipt, defaults, local, rules in families:
+        if block_lan == 0:
+            rules = local + rules
+
+        for rule in rules:
+            command, chain, stmt = translate(rule, ipt=ipt)
+            if command == "insert":
+                chains[chain].insert(0, stmt)
+            elif command == "add":
+                chains[chain].append(stmt)
+
+        for rule in defaults:
+            if len(rule) == 3 and rule[0] == "-P":
+                chain = CHAINS[rule[1]]
+                verdict = VERDICTS[rule[2]]
+
+                if ipt == "ip4":
+                    policies[chain] = verdict
+
+                #inet tables have one policy for both families
+                elif verdict != policies[chain]:
+                    chains[chain].append("meta nfproto ipv6 {}".format(verdict))
+
+    return chains, policies
+
+
+def render(chains, policies):
+    lines = [
+        "add table inet {}".format(TABLE),
+        "delete table inet {}".format(TABLE),
+        "table inet {} {{".format(TABLE)
+        ]
+
+    for name, ipt, addr_type in [("allow4", "ip4", "ipv4_addr"), ("allow6", "ip6", "ipv6_addr")]:
+        lines.append("    set {} {{".format(name))
+        lines.append("        type {}".format(addr_type))
+        lines.append("        flags timeout")
+        elements = [element(ip, ipt) for ip in sorted(allowed[ipt])]
+        elements = [e for e in elements if e is not None]
+        if len(elements) != 0:
+            lines.append("        elements = {{ {} }}".format(", ".join(elements)))
+        lines.append("    }")
+
+    for chain, rules in chains.items():
+        lines.append("    chain {} {{".format(chain))
+        lines.append("        type filter hook {} priority 0; policy {};".format(chain, policies[chain]))
+        for stmt in rules:
+            lines.append("        {}".format(stmt))
+        lines.append("    }")
+
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def apply_rules(fw_rules, opt, block_lan=0):
+    global active
+
+    if opt == 1:
+        chains, policies = build_ruleset(fw_rules, block_lan=block_lan)
+        nft(render(chains, policies))
+        active = True
+        #the table was rebuilt, so rules added later have new handles
+        handles.clear()
+
+    elif opt == 0:
+        remove_table()
+
+
+def remove_table():
+    global active
+
+    try:
+        nft("add table inet {0}\ndelete table inet {0}\n".format(TABLE))
+
+    except (CalledProcessError, FileNotFoundError) as e:
+        logging.debug("nftables: failed to delete table {} - {}".format(TABLE, e))
+
+    active = False
+    handles.clear()
+
+
+def batch_rule(rules, ipt="ip4"):
+    script = []
+    echoed = []
+    unhandled = []
+
+    if active is False:
+        return rules
+
+    for rule in rules:
+
+        try:
+            command, chain, stmt = translate(rule, ipt=ipt)
+
+        except ValueError:
+            unhandled.append(rule)
+            continue
+
+        key = (chain, stmt)
+        if command == "delete":
+            handle = handles.pop(key, None)
+            if handle is not None:
+                script.append("delete rule inet {} {} handle {}".format(TABLE, chain, handle))
+            else:
+                unhandled.append(rule)
+
+        elif key not in handles:
+            script.append("{} rule inet {} {} {}".format(command, TABLE, chain, stmt))
+            echoed.append(key)
+
+    if len(script) != 0:
+
+        try:
+            output = nft("\n".join(script) + "\n", echo=True)
+            found = re.findall(r"# handle (\d+)", output)
+            for key, handle in zip(echoed, found):
+                handles[key] = handle
+
+            logging.debug("nftables: committed {} rules in one transaction".format(len(script)))
+
+        except (CalledProcessError, FileNotFoundError) as e:
+            logging.warning("nftables: failed to apply rules - {}".format(e))
+            return rules
+
+    return unhandled
+
+
+def element(ip, ipt="ip4"):
+    expires = allowed[ipt].get(ip)
+
+    if expires is None:
+        return ip
+
+    remaining = int(expires - time.time())
+    if remaining <= 0:
+        allowed[ipt].pop(ip, None)
+        return None
+
+    return "{} timeout {}s".format(ip, remaining)
+
+
+def allow_script(ip, action, ipt="ip4", timeout=None):
+    if ipt == "ip4":
+        name = "allow4"
+    else:
+        name = "allow6"
+
+    if action == "-I":
+        allowed[ipt][ip] = time.time() + timeout if timeout else None
+        #re-adding an element does not reset its timeout
+        script = "add element inet {0} {1} {{ {2} }}\ndelete element inet {0} {1} {{ {2} }}\n".format(TABLE, name, ip)
+        script += "add element inet {} {} {{ {} }}\n".format(TABLE, name, element(ip, ipt))
+    else:
+        allowed[ipt].pop(ip, None)
+        script = "delete element inet {} {} {{ {} }}\n".format(TABLE, name, ip)
+
+    return script
+
+
+def allow_dest_ip(ip, action, ipt="ip4", timeout=None):
+    allow_dest_ips([ip], action, ipt=ipt, timeout=timeout)
+
+
+def allow_dest_ips(ips, action, ipt="ip4", timeout=None):
+    script = "".join(allow_script(ip, action, ipt=ipt, timeout=timeout) for ip in ips)
+    cmd = "add" if action == "-I" else "delete"
+    name = "allow4" if ipt == "ip4" else "allow6"
+    target = ips[0] if len(ips) == 1 else "{} addresses".format(len(ips))
+
+    if active is True and script != "":
+
+        try:
+            nft(script)
+            logging.debug("nftables: {} {} in set {}".format(cmd, target, name))
+
+        except (CalledProcessError, FileNotFoundError) as e:
+            logging.debug("nftables: {} {} in set {} failed - {}".format(cmd, target, name, e))
\ No newline at end of file
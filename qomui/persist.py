@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import atexit
+import logging
+import threading
+
+#writes to the same file within this many seconds are coalesced
+DELAY = 0.5
+
+files = {}
+lock = threading.Lock()
+
+
+def write_json(path, data, mode=None):
+    """Write data to path via fsync'd temp file and rename - never truncates path"""
+    tmp = "{}.tmp".format(path)
+
+    try:
+        with open(tmp, "w") as j:
+            if isinstance(data, str):
+                j.write(data)
+            else:
+                json.dump(data, j)
+            j.flush()
+            os.fsync(j.fileno())
+
+        if mode is not None:
+            os.chmod(tmp, mode)
+
+        os.replace(tmp, path)
+
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    except OSError:
+        pass
+
+
+def stat_token(path):
+    try:
+        st = os.stat(path)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    except OSError:
+        return None
+
+
+class JsonFile(object):
+    """Debounced, atomic writer for one json file
+
+    generation is bumped whenever the file is written by this process or
+    found replaced by another one, so callers only reload when it moved.
+    """
+
+    def __init__(self, path, delay=DELAY, mode=None):
+        self.path = path
+        self.delay = delay
+        self.mode = mode
+        self.generation = 0
+        self.token = stat_token(path)
+        self.pending = None
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def load(self, default=None):
+        with self.lock:
+            if self.pending is not None:
+                return json.loads(self.pending)
+
+        try:
+            with open(self.path, "r") as j:
+                data = json.load(j)
+
+        except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
+            logging.warning("{}: Could not open {}".format(e, self.path))
+            data = {} if default is None else default
+
+        self.token = stat_token(self.path)
+        return data
+
+    def changed(self):
+        token = stat_token(self.path)
+        if token != self.token:
+            self.token = token
+            self.generation += 1
+            return True
+        return False
+
+    def save(self, data):
+        #serialise now so later changes to data do not race the timer thread
+        with self.lock:
+            self.pending = json.dumps(data)
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            payload = self.pending
+            self.pending = None
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            if payload is None:
+                return
+
+            try:
+                write_json(self.path, payload, mode=self.mode)
+                self.token = stat_token(self.path)
+                self.generation += 1
+
+            except OSError as e:
+                logging.warning("Failed to save {} - {}".format(self.path, e))
+
+
+def get(path, **kwargs):
+    with lock:
+        try:
+            return files[path]
+
+        except KeyError:
+            files[path] = JsonFile(path, **kwargs)
+            return files[path]
+
+
+def save_json(path, data, now=False):
+    get(path).save(data)
+    if now is True:
+        get(path).flush()
+
+
+def load_json(path, default=None):
+    return get(path).load(default=default)
+
+
+@atexit.register
+def flush_all():
+    for f in list(files.values()):
+        f.flush()
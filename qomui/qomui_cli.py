@@ -14,7 +14,7 @@ from PyQt5 import QtCore, Qt
 from subprocess import Popen, PIPE
 import getpass
 import signal
-from qomui import utils, update
+from qomui import utils, update, catalogue, store, persist
 
 ROOTDIR = "/usr/share/qomui"
 HOMEDIR = "{}/.qomui".format(os.path.expanduser("~"))
@@ -58,7 +58,8 @@ class QomuiCli(QtCore.QObject):
             sys.exit(0)
 
         if args["set_protocol"] is not None:
-            protocol_dict = self.load_json("{}/protocol.json".format(HOMEDIR))
+            server_store = store.ServerStore(homedir=HOMEDIR)
+            protocol_dict = server_store.protocols()
             provider = args["set_protocol"]
 
             try:
@@ -74,9 +75,7 @@ class QomuiCli(QtCore.QObject):
 
                 if prot_chosen in protocol_dict[provider].keys():
                     protocol_dict[provider]["selected"] = prot_chosen
-
-                    with open ("{}/protocol.json".format(HOMEDIR), "w") as p:
-                        json.dump(protocol_dict, p)
+                    server_store.put_protocol(provider, protocol_dict[provider])
 
                     print("Port/Protocol for {} successfully changed".format(provider))
 
@@ -89,8 +88,9 @@ class QomuiCli(QtCore.QObject):
             sys.exit(0)
 
         if args["connect"] is not None:
-            self.server_dict = self.load_json("{}/server.json".format(HOMEDIR))
-            self.protocol_dict = self.load_json("{}/protocol.json".format(HOMEDIR))
+            server_store = store.ServerStore(homedir=HOMEDIR)
+            self.server_dict = server_store.servers()
+            self.protocol_dict = server_store.protocols()
             keys = self.server_dict.keys()
 
             if args["via"] is not None:
@@ -114,14 +114,12 @@ class QomuiCli(QtCore.QObject):
                 self.autocomplete(keys, action="establish_connection")
 
         if args["list"] is not None:
-            server_dict = self.load_json("{}/server.json".format(HOMEDIR))
-            for k,v in server_dict.items():
-                v_lower = [v.lower() for v in v.values()]
-                a_lower = [a.lower() for a in args["list"]]
-                check = all(i in v_lower for i in a_lower)
-                if check:
-                    formatted = "{} - {} - {}".format(k, v["country"], v["provider"])
-                    print(formatted)
+            server_dict = store.ServerStore(homedir=HOMEDIR).servers()
+            servers = catalogue.ServerCatalogue(server_dict)
+            for k in servers.ordered(servers.match(args["list"])):
+                v = server_dict[k]
+                formatted = "{} - {} - {}".format(k, v["country"], v["provider"])
+                print(formatted)
 
             sys.exit(0)
 
@@ -157,24 +155,9 @@ class QomuiCli(QtCore.QObject):
             self.show_config(config)
 
         if args["delete_provider"] is not None:
-            del_list = []
             provider = args["delete_provider"]
-            self.server_dict = self.load_json("{}/server.json".format(HOMEDIR))
-            self.protocol_dict = self.load_json("{}/protocol.json".format(HOMEDIR))
-            for k, v in self.server_dict.items():
-                if v["provider"] == provider:
-                    del_list.append(k)
-            for k in del_list:
-                self.server_dict.pop(k)
-            try:
-                self.protocol_dict.pop(provider)
-            except KeyError:
-                pass
-
+            store.ServerStore(homedir=HOMEDIR).delete_provider(provider)
             self.qomui_service.delete_provider(provider)
-            with open ("{}/server.json".format(HOMEDIR), "w") as s:
-                json.dump(self.server_dict, s)
-
             print("{} deleted".format(provider))
             sys.exit(0)
 
@@ -193,8 +176,9 @@ class QomuiCli(QtCore.QObject):
         do(line)
 
     def establish_connection(self, server):
-        self.ovpn_dict = utils.create_server_dict(self.server_dict[server],
-                                                                self.protocol_dict
+        self.ovpn_dict = utils.create_server_dict(self.server_dict[server].copy(),
+                                                                self.protocol_dict,
+                                                                SUPPORTED_PROVIDERS
                                                                 )
 
         if self.hop_server_dict is not None:
@@ -213,8 +197,9 @@ class QomuiCli(QtCore.QObject):
             pass
 
     def set_hop(self, server):
-        self.hop_server_dict = utils.create_server_dict(self.server_dict[server],
-                                                                    self.protocol_dict
+        self.hop_server_dict = utils.create_server_dict(self.server_dict[server].copy(),
+                                                                    self.protocol_dict,
+                                                                    SUPPORTED_PROVIDERS
                                                                     )
         self.qomui_service.set_hop(self.hop_server_dict)
 
@@ -264,32 +249,13 @@ class QomuiCli(QtCore.QObject):
             app.quit()
 
         else:
-            self.server_dict = self.load_json("{}/server.json".format(HOMEDIR))
-            self.protocol_dict = self.load_json("{}/protocol.json".format(HOMEDIR))
+            server_store = store.ServerStore(homedir=HOMEDIR)
+            self.protocol_dict = server_store.protocols()
             with open("{}/{}.json".format(HOMEDIR, msg), "r") as p:
                 content = json.load(p)
 
             provider = content["provider"]
-            for k, v in content["server"].items():
-
-                try:
-                    if self.server_dict[k]["favourite"] == "on":
-                        content["server"][k]["favourite"] = "on"
-
-                except KeyError:
-                    pass
-
-            if provider in SUPPORTED_PROVIDERS:
-                del_list = []
-
-                for k, v in self.server_dict.items():
-                    if v["provider"] == provider:
-                        del_list.append(k)
-
-                for k in del_list:
-                    self.server_dict.pop(k)
-
-            self.server_dict.update(content["server"])
+            server_store.apply_import(content, replace=provider in SUPPORTED_PROVIDERS)
 
             try:
                 if 'selected' in self.protocol_dict[provider].keys():
@@ -301,17 +267,11 @@ class QomuiCli(QtCore.QObject):
                 pass
 
             try:
-                self.protocol_dict[provider] = (content["protocol"])
+                server_store.put_protocol(provider, content["protocol"])
 
             except KeyError:
                 pass
 
-            with open ("{}/server.json".format(HOMEDIR), "w") as s:
-                json.dump(self.server_dict, s)
-
-            with open ("{}/protocol.json".format(HOMEDIR), "w") as p:
-                json.dump(self.protocol_dict, p)
-
             os.remove("{}/{}.json".format(HOMEDIR, msg))
             print("Succesfully added config files for {}".format(provider))
             app.quit()
@@ -364,8 +324,7 @@ class QomuiCli(QtCore.QObject):
 
     def applyoptions(self, temp_config):
 
-        with open ('{}/config_temp.json'.format(HOMEDIR), 'w') as config:
-            json.dump(temp_config, config)
+        persist.write_json('{}/config_temp.json'.format(HOMEDIR), temp_config)
 
         update_cmd = ['sudo', sys.executable, '-m', 'qomui.mv_config',
                         '-d', '{}'.format(HOMEDIR)]
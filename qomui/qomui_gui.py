@@ -18,7 +18,7 @@ from dbus.mainloop.pyqt5 import DBusQtMainLoop
 import bisect
 import signal
 
-from qomui import config, update, latency, utils, firewall, widgets, profiles, monitor
+from qomui import config, update, latency, utils, firewall, widgets, profiles, monitor, catalogue, store, persist, record
 
 
 try:
@@ -36,8 +36,6 @@ except AttributeError:
         return QtWidgets.QApplication.translate(context, text, disambig)
 
 JSON_FILE_LIST = [
-                  ("server_dict", "{}/server.json".format(config.HOMEDIR)),
-                  ("protocol_dict", "{}/protocol.json".format(config.HOMEDIR)),
                   ("bypass_dict", "{}/bypass_apps.json".format(config.HOMEDIR)),
                   ("profile_dict", "{}/profile.json".format(config.HOMEDIR))
                   ]
@@ -58,6 +56,7 @@ class DbusLogHandler(logging.Handler):
 class QomuiGui(QtWidgets.QWidget):
     network_state = 0
     server_dict = {}
+    server_catalogue = catalogue.ServerCatalogue()
     protocol_dict = {}
     profile_dict = {}
     country_list = ["All countries"]
@@ -70,7 +69,6 @@ class QomuiGui(QtWidgets.QWidget):
     bypass_dict = {}
     config_dict = {}
     packetmanager = None
-    queue = []
     tunnel_list = ["OpenVPN", "WireGuard"]
     config_list = [
                    "firewall",
@@ -141,6 +139,7 @@ class QomuiGui(QtWidgets.QWidget):
         self.dbus_call("disconnect", "main")
         self.dbus_call("disconnect", "bypass")
         self.dbus_call("save_default_dns")
+        self.ipv6_state_change(self.dbus_call("get_ipv6_available"))
         self.check_other_instance()
         self.load_saved_files()
         self.systemtray()
@@ -242,10 +241,24 @@ class QomuiGui(QtWidgets.QWidget):
         self.qomui_service.connect_to_signal("updated", self.restart)
         self.qomui_service.connect_to_signal("imported", self.downloaded)
         self.qomui_service.connect_to_signal("progress_bar", self.start_progress_bar)
+        self.qomui_service.connect_to_signal("ipv6_state", self.ipv6_state_change)
 
     def receive_log(self, msg):
         self.logText.appendPlainText(msg)
 
+    def ipv6_state_change(self, available):
+        if available is None:
+            return
+
+        elif available == True:
+            text = "Disables ipv6 stack systemwide"
+
+        else:
+            text = "Disables ipv6 stack systemwide - ipv6 is currently not available"
+
+        self.logger.debug("ipv6 available: {}".format(bool(available)))
+        self.ipv6_disableOptLabel.setText(_translate("Form", text, None))
+
     def setupUi(self, Form):
         Form.setObjectName(_fromUtf8("Form"))
         self.gLayoutMain = QtWidgets.QGridLayout(Form)
@@ -369,11 +382,18 @@ class QomuiGui(QtWidgets.QWidget):
         self.searchLine = QtWidgets.QLineEdit(self.serverTab)
         self.searchLine.setObjectName(_fromUtf8("searchLine"))
         self.vLayoutServer.addWidget(self.searchLine)
-        self.serverListWidget = QtWidgets.QListWidget(self.serverTab)
-        self.serverListWidget.setObjectName(_fromUtf8("serverListWidget"))
-        self.serverListWidget.setBatchSize(10)
-        self.serverListWidget.setUniformItemSizes(True)
-        self.vLayoutServer.addWidget(self.serverListWidget)
+        self.serverListView = QtWidgets.QListView(self.serverTab)
+        self.serverListView.setObjectName(_fromUtf8("serverListView"))
+        self.serverListView.setUniformItemSizes(True)
+        self.serverListView.setMouseTracking(True)
+        self.serverListView.viewport().setAttribute(QtCore.Qt.WA_Hover)
+        self.serverModel = widgets.ServerListModel(self.server_catalogue, self.serverTab)
+        self.serverProxy = widgets.ServerFilterProxy(self.serverTab)
+        self.serverProxy.setSourceModel(self.serverModel)
+        self.serverListView.setModel(self.serverProxy)
+        self.serverDelegate = widgets.ServerDelegate(self.serverListView)
+        self.serverListView.setItemDelegate(self.serverDelegate)
+        self.vLayoutServer.addWidget(self.serverListView)
         self.showHop = widgets.HopWidget(self.serverTab)
         self.showHop.setVisible(False)
         self.vLayoutServer.addWidget(self.showHop)
@@ -760,6 +780,9 @@ class QomuiGui(QtWidgets.QWidget):
         self.providerProtocolBox.activated[str].connect(self.pop_ProtocolListWidget)
         self.addServerBt.clicked.connect(self.switch_providerTab)
         self.delServerBt.clicked.connect(self.del_single_server)
+        self.serverDelegate.server_chosen.connect(self.server_chosen)
+        self.serverDelegate.set_hop_signal.connect(self.set_hop)
+        self.serverDelegate.changed_favourite_signal.connect(self.change_favourite)
         self.countryBox.activated[str].connect(self.filter_servers)
         self.providerBox.activated[str].connect(self.filter_servers)
         self.tunnelBox.activated[str].connect(self.filter_servers)
@@ -1047,10 +1070,8 @@ class QomuiGui(QtWidgets.QWidget):
             self.tabWidget.setCurrentIndex(6)
             self.bypassVpnBox.clear()
 
-            for k, v in self.server_dict.items():
-                if "favourite" in v:
-                    if v["favourite"] == "on":
-                        self.bypassVpnBox.addItem(k)
+            for k in self.server_catalogue.ordered(self.server_catalogue.favourites):
+                self.bypassVpnBox.addItem(k)
 
     def switch_providerTab(self):
         self.tabWidget.setCurrentIndex(4)
@@ -1107,8 +1128,16 @@ class QomuiGui(QtWidgets.QWidget):
         self.kill()
         self.disconnect_bypass()
         self.dbus_call("load_firewall", 2)
-        with open ("{}/server.json".format(config.HOMEDIR), "w") as s:
-            json.dump(self.server_dict, s)
+
+        #a cancelled latency check still saves what it has measured
+        try:
+            self.PingThread.cancel()
+            self.PingThread.wait()
+
+        except AttributeError:
+            pass
+
+        self.server_store.close()
         sys.exit()
 
     def restoreUi(self, reason):
@@ -1162,13 +1191,7 @@ class QomuiGui(QtWidgets.QWidget):
             self.exit_event.accept()
 
     def load_json(self, json_file):
-        try:
-            with open(json_file, 'r') as j:
-                return json.load(j)
-
-        except (FileNotFoundError,json.decoder.JSONDecodeError) as e:
-            self.logger.warning('{}: Could not open {}'.format(e, json_file))
-            return {}
+        return persist.load_json(json_file)
 
     def connect_last_server(self):
         try:
@@ -1257,6 +1280,11 @@ class QomuiGui(QtWidgets.QWidget):
         for saved_file in JSON_FILE_LIST:
             setattr(self, saved_file[0], self.load_json(saved_file[1]))
 
+        self.server_store = store.ServerStore()
+        self.server_dict = self.server_store.servers()
+        self.protocol_dict = self.server_store.protocols()
+        self.load_latencies()
+
         try:
             if config.settings["minimize"] == 0:
                 self.setWindowState(QtCore.Qt.WindowActive)
@@ -1337,8 +1365,7 @@ class QomuiGui(QtWidgets.QWidget):
             if k not in temp_config:
                 temp_config[k] = v
 
-        with open ('{}/config_temp.json'.format(config.HOMEDIR), 'w') as c:
-            json.dump(temp_config, c)
+        persist.write_json('{}/config_temp.json'.format(config.HOMEDIR), temp_config)
 
         update_cmd = ['pkexec', sys.executable, '-m', 'qomui.mv_config',
                       '-d', '{}'.format(config.HOMEDIR)]
@@ -1496,7 +1523,6 @@ class QomuiGui(QtWidgets.QWidget):
 
     def del_provider(self):
         provider = self.delProviderBox.currentText()
-        del_list = []
         ret = self.messageBox(
                         "Are you sure?", "",
                         buttons = [("No", "NoRole"), ("Yes", "YesRole")],
@@ -1505,9 +1531,7 @@ class QomuiGui(QtWidgets.QWidget):
 
         if ret == 1:
             self.logger.info("Deleting {}".format(provider))
-            for k, v in self.server_dict.items():
-                if v["provider"] == provider:
-                    del_list.append(k)
+            del_list = self.server_catalogue.filter(provider=provider)
 
             for k in del_list:
                 self.server_dict.pop(k)
@@ -1518,9 +1542,7 @@ class QomuiGui(QtWidgets.QWidget):
                 pass
 
             self.dbus_call("delete_provider", provider)
-
-            with open ("{}/server.json".format(config.HOMEDIR), "w") as s:
-                json.dump(self.server_dict, s)
+            self.server_store.delete_provider(provider)
 
             self.notify(
                         "Qomui: Deleted provider",
@@ -1541,8 +1563,7 @@ class QomuiGui(QtWidgets.QWidget):
 
     def del_profile(self, number):
         self.profile_dict.pop(number)
-        with open ("{}/profile.json".format(config.HOMEDIR), "w") as s:
-                json.dump(self.profile_dict, s)
+        persist.save_json("{}/profile.json".format(config.HOMEDIR), self.profile_dict)
         getattr(self, "{}_widget".format(number)).deleteLater()
         self.vLayoutProfile_2.removeWidget(getattr(self, "{}_widget".format(number)))
 
@@ -1567,8 +1588,7 @@ class QomuiGui(QtWidgets.QWidget):
             self.profile_dict[number] = profile_dict
             getattr(self, "{}_widget".format(number)).setText(self.profile_dict[number])
 
-        with open ("{}/profile.json".format(config.HOMEDIR), "w") as s:
-                    json.dump(self.profile_dict, s)
+        persist.save_json("{}/profile.json".format(config.HOMEDIR), self.profile_dict)
 
     def display_profile(self, number):
         setattr(self, "{}_widget".format(number), profiles.ProfileWidget(self.profile_dict[number]))
@@ -1578,35 +1598,19 @@ class QomuiGui(QtWidgets.QWidget):
         self.vLayoutProfile_2.insertWidget(0, getattr(self, "{}_widget".format(number)))
         name = self.profile_dict[number]["name"]
 
+    def profile_servers(self, p):
+        return self.server_catalogue.profile(self.profile_dict[p])
+
     def connect_profile(self, p):
         result = None
         profile = self.profile_dict[p]
-        temp_list = []
-        for s, v in self.server_dict.items():
-            if v["country"] in profile["countries"] and v["provider"] in profile["providers"]:
-                if len(profile["filters"]) != 0:
-                    for f in profile["filters"]:
-                        search = "{}{}".format(s, v["city"])
-                        if f.lower() in search.lower() and f != "":
-                            if profile["protocol"] == v["tunnel"]:
-                                temp_list.append(s)
-                            elif profile["protocol"] == "All protocols":
-                                temp_list.append(s)
-
-                else:
-                    if profile["protocol"] == v["tunnel"]:
-                        temp_list.append(s)
-                    elif profile["protocol"] == "All protocols":
-                        temp_list.append(s)
+        temp_list = self.profile_servers(p)
 
         if temp_list:
             if profile["mode"] == "Fastest":
                 fastest = 10000
                 for s in temp_list:
-                    try:
-                        lat = float(self.server_dict[s]["latency"])
-                    except KeyError:
-                        lat = 1000
+                    lat = self.server_score(s)
                     if lat <= fastest:
                         fastest = lat
                         result = s
@@ -1618,10 +1622,7 @@ class QomuiGui(QtWidgets.QWidget):
                 max_length = int(len(temp_list) * 0.20)
                 for s in temp_list:
                     country = self.server_dict[s]["country"]
-                    try:
-                        lat = float(self.server_dict[s]["latency"])
-                    except KeyError:
-                        lat = 1000
+                    lat = self.server_score(s)
 
                     bisect.insort(l_list, lat)
                     s_list.insert(l_list.index(lat), (s, country))
@@ -1646,6 +1647,19 @@ class QomuiGui(QtWidgets.QWidget):
             self.notify("No match found", "No server fits your profile", icon="Error")
 
 
+    #rank by score of latency statistics if available
+    def server_score(self, server):
+        try:
+            val = self.server_dict[server]
+        except KeyError:
+            return 1000
+
+        if val.score is not None:
+            return val.score
+        elif val.latency is not None:
+            return val.latency
+        return 1000
+
     def start_progress_bar(self, bar, server=None):
         action = bar
 
@@ -1712,7 +1726,7 @@ class QomuiGui(QtWidgets.QWidget):
             self.notify(split[0], split[1], icon="Error")
 
         else:
-            config.settings = self.load_json("{}/config.json".format(config.ROOTDIR))
+            config.reload_config()
 
             with open("{}/{}.json".format(config.HOMEDIR, msg), "r") as p:
                 content = json.load(p)
@@ -1720,6 +1734,12 @@ class QomuiGui(QtWidgets.QWidget):
             provider = content["provider"]
             self.stop_progress_bar(provider)
             QtWidgets.QApplication.restoreOverrideCursor()
+            self.server_store.apply_import(content, replace=provider in config.SUPPORTED_PROVIDERS)
+            os.remove("{}/{}.json".format(config.HOMEDIR, msg))
+
+            if content.get("unchanged") == "1":
+                self.logger.info("{}: Server list is up to date".format(provider))
+                return
 
             txt = "List of available servers updated"
 
@@ -1731,26 +1751,23 @@ class QomuiGui(QtWidgets.QWidget):
                 pass
 
             self.notify("Qomui: Importing {} successful".format(provider), txt, icon="Information")
-            for k, v in content["server"].items():
 
-                try:
-                    if self.server_dict[k]["favourite"] == "on":
-                        content["server"][k]["favourite"] = "on"
-
-                except KeyError:
-                    pass
-
-            if provider in config.SUPPORTED_PROVIDERS:
-                del_list = []
-
-                for k, v in self.server_dict.items():
-                    if v["provider"] == provider:
-                        del_list.append(k)
+            if provider in config.SUPPORTED_PROVIDERS and content.get("full") == "1":
+                removed = self.server_catalogue.filter(provider=provider) - set(content["added"])
+            else:
+                removed = content["removed"]
 
-                for k in del_list:
-                    self.server_dict.pop(k)
+            for k in removed:
+                self.server_dict.pop(k, None)
 
-            self.server_dict.update(content["server"])
+            #servers the provider did not touch keep their records, the others keep their local state
+            for servers in [content["added"], content["changed"]]:
+                for k, v in servers.items():
+                    val = record.ServerRecord(v)
+                    old = self.server_dict.get(k)
+                    if old is not None:
+                        val.favourite, val.latency, val.score = old.favourite, old.latency, old.score
+                    self.server_dict[k] = val
 
             try:
                 if 'selected' in self.protocol_dict[provider].keys():
@@ -1767,73 +1784,32 @@ class QomuiGui(QtWidgets.QWidget):
             except KeyError:
                 pass
 
-            with open ("{}/server.json".format(config.HOMEDIR), "w") as s:
-                json.dump(self.server_dict, s)
+            if provider in self.protocol_dict:
+                self.server_store.put_protocol(provider, self.protocol_dict[provider])
 
-            with open ("{}/protocol.json".format(config.HOMEDIR), "w") as p:
-                json.dump(self.protocol_dict, p)
-
-            os.remove("{}/{}.json".format(config.HOMEDIR, msg))
-            self.pop_boxes()
+            if len(removed) + len(content["added"]) + len(content["changed"]) != 0:
+                self.pop_boxes()
 
     def del_single_server(self):
-        for item in self.serverListWidget.selectedItems():
-            data = item.data(QtCore.Qt.UserRole)
-            index = self.serverListWidget.row(item)
-
-            try:
-                self.server_dict.pop(data, None)
-                self.serverListWidget.takeItem(index)
-
-            except KeyError:
-                pass
-
-        with open ("{}/server.json".format(config.HOMEDIR), "w") as s:
-            json.dump(self.server_dict, s)
-
-    def set_flag(self, country):
-        flag = '{}/flags/{}.png'.format(config.ROOTDIR, country)
-
-        if not os.path.isfile(flag):
-            flag = '{}/flags/Unknown.png'.format(config.ROOTDIR)
-
-        pixmap = QtGui.QPixmap(flag).scaled(25, 25,
-                                            transformMode=QtCore.Qt.SmoothTransformation
-                                            )
-
-        setattr(self, country + "_pixmap", pixmap)
+        selected = self.serverListView.selectionModel().selectedIndexes()
+        keys = [index.data(widgets.KEY_ROLE) for index in selected]
+        for data in keys:
+            self.serverModel.remove(data)
+            self.server_dict.pop(data, None)
 
+        self.server_store.delete_servers(keys)
 
     def pop_boxes(self, country=None):
-        malformed_entries = []
-        self.country_list = []
-        self.provider_list = ["All providers"]
-        self.tunnel_list = ["All protocols"]
-        self.tunnelBox.clear()
         server_count = len(self.server_dict.keys())
         self.logger.info("Total number of server: {}".format(server_count))
 
-        for k,v in (self.server_dict.items()):
-
-            try:
-
-                if v["country"] not in self.country_list:
-                    self.country_list.append(v["country"])
-                    self.set_flag(v["country"])
-
-                elif v["provider"] not in self.provider_list:
-                    self.provider_list.append(v["provider"])
-
-                elif v["tunnel"] not in self.tunnel_list:
-                    self.tunnel_list.append(v["tunnel"])
-
-            except KeyError:
-                malformed_entries.append(k)
-                self.logger.error("Malformed server entry: {} {}".format(k ,v))
-
-        for e in malformed_entries:
+        for e in self.serverModel.rebuild(self.server_dict):
             self.server_dict.pop(e)
 
+        self.country_list = sorted(self.server_catalogue.countries)
+        self.provider_list = ["All providers"] + sorted(self.server_catalogue.providers)
+        self.tunnel_list = ["All protocols"] + sorted(self.server_catalogue.tunnels)
+
         self.pop_providerProtocolBox()
         self.pop_delProviderBox()
         self.countryBox.clear()
@@ -1867,12 +1843,8 @@ class QomuiGui(QtWidgets.QWidget):
             self.tunnelBox.addItem(provider)
             self.tunnelBox.setItemText(index, provider)
 
-        self.index_list = []
-        self.serverListWidget.clear()
-
-        for key,val in sorted(self.server_dict.items(), key=lambda s: s[0].upper()):
-            self.index_list.append(key)
-            self.add_server_widget(key, val)
+        #the previous search or filter would hide new and renamed servers
+        self.filter_servers()
 
         try:
             if config.settings["ping"] == 1:
@@ -1883,43 +1855,90 @@ class QomuiGui(QtWidgets.QWidget):
 
     def get_latencies(self):
         try:
-            self.PingThread.terminate()
+            self.PingThread.cancel()
             self.PingThread.wait()
-            self.logger.debug("Thread for latency checks terminated - Starting new one")
+            self.logger.debug("Thread for latency checks cancelled - Starting new one")
 
         except AttributeError:
             pass
 
+        #the killswitch only lets icmp echo requests through
+        ping_mode = config.settings["ping_mode"]
+        if config.settings["firewall"] == 1 and ping_mode != "icmp":
+            ping_mode = self.allow_probes(ping_mode)
+
         gateway = self.routes["interface"]
         if gateway != "None":
-            self.latency_list = []
-            self.PingThread = latency.LatencyCheck(self.server_dict, gateway)
+            self.PingThread = latency.LatencyCheck(self.server_dict, gateway,
+                                                   limit=config.settings["ping_limit"],
+                                                   store=latency.LatencyStore(),
+                                                   samples=config.settings["ping_samples"],
+                                                   weights=self.latency_weights(),
+                                                   protocol_dict=self.protocol_dict,
+                                                   mode=ping_mode)
             self.PingThread.lat_signal.connect(self.display_latency)
             self.PingThread.finished.connect(self.check_update)
+            self.prioritise_latency()
             self.PingThread.start()
 
+    def allow_probes(self, ping_mode):
+        ips = set()
+        for val in self.server_dict.values():
+            try:
+                ips.add(latency.server_ip(val))
+            except KeyError:
+                pass
+
+        if self.dbus_call("allow_probes", sorted(ips), latency.ALLOW_TIMEOUT) == True:
+            return ping_mode
+
+        #single iptables rules would outlive the check, so handshakes are skipped
+        self.logger.info("Firewall active and ipset not available - measuring latencies with icmp only")
+        return "icmp"
+
+    def latency_weights(self):
+        return {"jitter": config.settings["score_jitter"], "loss": config.settings["score_loss"]}
+
+    #results of earlier checks are only kept in latency.json
+    def load_latencies(self):
+        cache = latency.LatencyStore()
+        weights = self.latency_weights()
+
+        for key, val in self.server_dict.items():
+            entry = cache.get(key)
+            if entry is not None and entry.get("rtt") is not None:
+                val.latency = entry["rtt"]
+                val.score = latency.score(entry, weights)
+
+    #servers the user is currently looking at are probed first
+    def prioritise_latency(self):
+        try:
+            ping_thread = self.PingThread
+        except AttributeError:
+            return
+
+        keys = self.serverProxy.keys()
+        keys.extend(self.server_catalogue.favourites)
+        for p in self.profile_dict:
+            try:
+                keys.extend(self.profile_servers(p))
+            except KeyError:
+                pass
+
+        ping_thread.set_priority(keys)
+
     def display_latency(self, result):
-        hidden = False
         server = result[0]
         latency_string = result[1]
         latency_float = result[2]
 
         try:
-            self.server_dict[server]["latency"] = str(latency_float)
-            old_index = self.index_list.index(server)
-            bisect.insort(self.latency_list, latency_float)
-            update_index = self.latency_list.index(latency_float)
-            rm = self.index_list.index(server)
-            self.index_list.pop(rm)
-            self.index_list.insert(update_index, server)
-            if getattr(self, server).isHidden() is True:
-                hidden = True
-            self.serverListWidget.takeItem(old_index)
-            self.add_server_widget(server, self.server_dict[server], insert=update_index)
-            self.serverListWidget.setRowHidden(update_index, hidden)
-            getattr(self, server).display_latency(latency_string)
+            self.server_dict[server].latency = latency_float
+            self.server_dict[server].score = result[3]
+            self.serverModel.set_latency(server, latency_string, latency_float)
+            self.serverProxy.schedule_sort()
 
-        except ValueError:
+        except KeyError:
             pass
 
     def filter_by_text(self, text):
@@ -1927,23 +1946,8 @@ class QomuiGui(QtWidgets.QWidget):
         self.providerBox.setCurrentIndex(0)
         self.tunnelBox.setCurrentIndex(0)
         self.randomSeverBt.setVisible(False)
-
-        for k, v in self.server_dict.items():
-
-            try:
-                index = self.index_list.index(k)
-                search = "{}{}".format(k, v["city"])
-
-                if text.lower() in search.lower():
-                    self.serverListWidget.setRowHidden(index, False)
-                    getattr(self, k).setHidden(False)
-
-                else:
-                    self.serverListWidget.setRowHidden(index, True)
-                    getattr(self, k).setHidden(True)
-
-            except ValueError:
-                pass
+        self.show_rows(self.server_catalogue.search(text))
+        self.prioritise_latency()
 
     def show_favourite_servers(self, state):
         self.countryBox.setCurrentIndex(0)
@@ -1951,26 +1955,8 @@ class QomuiGui(QtWidgets.QWidget):
         self.tunnelBox.setCurrentIndex(0)
         self.randomSeverBt.setVisible(True)
         if state == True:
-            i = 0
-
-            try:
-                for key, val in self.server_dict.items():
-                    index = self.index_list.index(key)
-
-                    try:
-                        if val["favourite"] == "on":
-                            self.serverListWidget.setRowHidden(index, False)
-                            getattr(self, key).setHidden(False)
-                        else:
-                            self.serverListWidget.setRowHidden(index, True)
-                            getattr(self, key).setHidden(True)
-
-                    except KeyError:
-                        self.serverListWidget.setRowHidden(index, True)
-                        getattr(self, key).setHidden(True)
-
-            except ValueError:
-                pass
+            self.show_rows(set(self.server_catalogue.favourites))
+            self.prioritise_latency()
 
         elif state == False:
             self.filter_servers()
@@ -1985,68 +1971,17 @@ class QomuiGui(QtWidgets.QWidget):
         if self.favouriteButton.isChecked() == True:
             self.favouriteButton.setChecked(False)
 
-        try:
-            for key, val in self.server_dict.items():
-                index = self.index_list.index(key)
-
-                if val["provider"] == provider or provider == "All providers":
-                    if val["country"] == country or country == "All countries":
-                        if val["tunnel"] == tunnel or tunnel == "All protocols":
-                            self.serverListWidget.setRowHidden(index, False)
-                            getattr(self, key).setHidden(False)
-                        else:
-                            self.serverListWidget.setRowHidden(index, True)
-                            getattr(self, key).setHidden(True)
-                    else:
-                        self.serverListWidget.setRowHidden(index, True)
-                        getattr(self, key).setHidden(True)
-                else:
-                    self.serverListWidget.setRowHidden(index, True)
-                    getattr(self, key).setHidden(True)
+        visible = self.server_catalogue.filter(
+            provider=None if provider == "All providers" else provider,
+            country=None if country == "All countries" else country,
+            tunnel=None if tunnel == "All protocols" else tunnel
+            )
 
-        except ValueError:
-            pass
+        self.show_rows(visible)
+        self.prioritise_latency()
 
-    def add_server_widget(self, key, val, insert=None):
-        setattr(self, key, widgets.ServerWidget())
-        self.ListItem = QtWidgets.QListWidgetItem()
-        self.ListItem.setData(QtCore.Qt.UserRole, key)
-        self.ListItem.setSizeHint(QtCore.QSize(100, 50))
-
-        if insert is None:
-            self.serverListWidget.addItem(self.ListItem)
-        else:
-            self.serverListWidget.insertItem(insert, self.ListItem)
-
-        self.serverListWidget.setItemWidget(self.ListItem, getattr(self, key))
-
-        try:
-            fav = val["favourite"]
-
-        except KeyError:
-            fav = 1
-
-        try:
-            getattr(self, key).setText(val["name"], val["provider"],
-                            getattr(self, "{}_pixmap".format(val["country"])),
-                            val["city"], fav=fav)
-
-        except AttributeError:
-            self.set_flag(val["country"])
-            getattr(self, key).setText(val["name"], val["provider"],
-                            getattr(self, "{}_pixmap".format(val["country"])),
-                            val["city"], fav=fav)
-
-        try:
-            if val["tunnel"] == "WireGuard":
-                getattr(self, key).hide_button(0)
-
-        except KeyError:
-            pass
-
-        getattr(self, key).server_chosen.connect(self.server_chosen)
-        getattr(self, key).set_hop_signal.connect(self.set_hop)
-        getattr(self, key).changed_favourite_signal.connect(self.change_favourite)
+    def show_rows(self, visible):
+        self.serverProxy.set_visible(visible)
 
     def pop_providerProtocolBox(self):
         self.providerProtocolBox.clear()
@@ -2115,9 +2050,7 @@ class QomuiGui(QtWidgets.QWidget):
         provider = self.providerProtocolBox.currentText()
         if provider in config.SUPPORTED_PROVIDERS:
             self.protocol_dict[provider]["selected"] = selection.data(QtCore.Qt.UserRole)
-
-            with open ("{}/protocol.json".format(config.HOMEDIR), "w") as p:
-                json.dump(self.protocol_dict, p)
+            self.server_store.put_protocol(provider, self.protocol_dict[provider])
 
             for item in range(self.protocolListWidget.count()):
                 if self.protocolListWidget.item(item) != selection:
@@ -2139,12 +2072,10 @@ class QomuiGui(QtWidgets.QWidget):
                 self.portEdit.setText(port)
 
         elif state == False:
-            try:
-                self.protocol_dict.pop(self.providerProtocolBox.currentText(), None)
-                with open ("{}/protocol.json".format(config.HOMEDIR), "w") as p:
-                    json.dump(self.protocol_dict, p)
-            except KeyError:
-                pass
+            provider = self.providerProtocolBox.currentText()
+            if provider in self.protocol_dict:
+                self.protocol_dict.pop(provider)
+                self.server_store.delete_protocol(provider)
 
     def override_protocol(self):
         protocol = self.chooseProtocolBox.currentText()
@@ -2153,8 +2084,7 @@ class QomuiGui(QtWidgets.QWidget):
 
         if self.overrideCheck.checkState() == 2:
             self.protocol_dict[provider] = {"protocol" : protocol, "port": port}
-            with open ("{}/protocol.json".format(config.HOMEDIR), "w") as p:
-                json.dump(self.protocol_dict, p)
+            self.server_store.put_protocol(provider, self.protocol_dict[provider])
 
     def pop_delProviderBox(self):
         self.delProviderBox.clear()
@@ -2163,14 +2093,15 @@ class QomuiGui(QtWidgets.QWidget):
                 self.delProviderBox.addItem(provider)
 
     def change_favourite(self, change):
+        self.server_catalogue.set_favourite(change[0], change[1])
         if change[1] == True:
             self.server_dict[change[0]].update({"favourite" : "on"})
         elif change[1] == False:
             self.server_dict[change[0]].update({"favourite" : "off"})
             if self.favouriteButton.isChecked() == True:
                 self.show_favourite_servers(True)
-        with open ("{}/server.json".format(config.HOMEDIR), "w") as s:
-            json.dump(self.server_dict, s)
+        self.serverModel.refresh(change[0], [widgets.FAVOURITE_ROLE])
+        self.server_store.set_favourite(change[0], change[1])
 
     def set_hop(self, server):
         try:
@@ -2200,13 +2131,7 @@ class QomuiGui(QtWidgets.QWidget):
         self.filter_servers()
 
     def choose_random_server(self):
-        random_list = []
-        for key, val in self.server_dict.items():
-            try:
-                if val["favourite"] == "on":
-                    random_list.append(key)
-            except KeyError:
-                pass
+        random_list = list(self.server_catalogue.favourites)
 
         if len(random_list) != 0:
             self.server_chosen(random.choice(random_list), random="on")
@@ -2293,12 +2218,11 @@ class QomuiGui(QtWidgets.QWidget):
                     icon="Information"
                     )
 
+        self.server_store.set_last_used(self.ovpn_dict["name"])
         last_server_dict = self.load_json("{}/last_server.json".format(config.HOMEDIR))
-        with open('{}/last_server.json'.format(config.HOMEDIR), 'w') as lserver:
-            last_server_dict["last"] = self.ovpn_dict
-            last_server_dict["hop"] = self.hop_server_dict
-            json.dump(last_server_dict, lserver)
-            lserver.close()
+        last_server_dict["last"] = self.ovpn_dict
+        last_server_dict["hop"] = self.hop_server_dict
+        persist.save_json("{}/last_server.json".format(config.HOMEDIR), last_server_dict)
 
         tun = self.dbus_call("return_tun_device", "tun")
         self.tray.setToolTip("Connected to {}".format(self.ovpn_dict["name"]))
@@ -2331,10 +2255,8 @@ class QomuiGui(QtWidgets.QWidget):
                     )
 
         last_server_dict = self.load_json("{}/last_server.json".format(config.HOMEDIR))
-        with open('{}/last_server.json'.format(config.HOMEDIR), 'w') as lserver:
-            last_server_dict["bypass"] = self.bypass_ovpn_dict
-            json.dump(last_server_dict, lserver)
-            lserver.close()
+        last_server_dict["bypass"] = self.bypass_ovpn_dict
+        persist.save_json("{}/last_server.json".format(config.HOMEDIR), last_server_dict)
 
         try:
             self.BypassActive.setVisible(False)
@@ -2422,37 +2344,42 @@ class QomuiGui(QtWidgets.QWidget):
     def update_check(self):
         QtWidgets.QApplication.restoreOverrideCursor()
 
-        if not self.queue:
-            self.queue = [p for p in config.SUPPORTED_PROVIDERS if p in self.provider_list]
+        #the service runs each import in its own thread, so hand over all due providers at once
+        for provider in [p for p in config.SUPPORTED_PROVIDERS if p in self.provider_list]:
 
-        provider = self.queue[0]
+            try:
+                get_last = config.settings["{}_last".format(provider)]
+                last_update = datetime.strptime(get_last, '%Y-%m-%d %H:%M:%S.%f')
+                time_now = datetime.utcnow()
+                delta = time_now.date() - last_update.date()
+                days_since = delta.days
+                self.logger.info("Last {} update: {} days ago".format(provider, days_since))
+
+                if days_since >= 5:
+                    credentials = {
+                                    "provider" : provider,
+                                    "credentials" : "unknown",
+                                    "folderpath" : "None",
+                                    "homedir" : config.HOMEDIR,
+                                    "update" : "0",
+                                    "validators" : self.import_validators(provider)
+                                    }
+
+                    if config.settings["auto_update"] == 1:
+                        self.logger.info("Updating {}".format(provider))
+                        self.dbus_call("import_thread", credentials)
 
-        try:
-            get_last = config.settings["{}_last".format(provider)]
-            last_update = datetime.strptime(get_last, '%Y-%m-%d %H:%M:%S.%f')
-            time_now = datetime.utcnow()
-            delta = time_now.date() - last_update.date()
-            days_since = delta.days
-            self.logger.info("Last {} update: {} days ago".format(provider, days_since))
-
-            if days_since >= 5:
-                credentials = {
-                                "provider" : provider,
-                                "credentials" : "unknown",
-                                "folderpath" : "None",
-                                "config.HOMEDIR" : config.HOMEDIR,
-                                "update" : "0"
-                                }
-
-                if config.settings["auto_update"] == 1:
-                    self.logger.info("Updating {}".format(provider))
-                    self.dbus_call("import_thread", credentials)
+            except KeyError:
+                self.logger.debug("Update timestamp for {} not found".format(provider))
 
-        except KeyError:
-            self.logger.debug("Update timestamp for {} not found".format(provider))
+    def import_validators(self, provider):
+        #digests of what we hold let the importer send only what differs
+        validators = self.server_store.validators(provider)
+        keys = self.server_catalogue.providers.get(provider, set())
+        if len(keys) != 0:
+            validators["servers"] = {k: record.digest(self.server_dict[k]) for k in keys}
 
-        finally:
-            self.queue.remove(provider)
+        return json.dumps(validators)
 
     def reconnect(self):
         if self.tunnel_active == 1:
@@ -2492,9 +2419,7 @@ class QomuiGui(QtWidgets.QWidget):
         if "bypass" in last_server_dict.keys():
             last_server_dict.pop("bypass")
 
-        with open('{}/last_server.json'.format(config.HOMEDIR), 'w') as lserver:
-            json.dump(last_server_dict, lserver)
-            lserver.close()
+        persist.save_json("{}/last_server.json".format(config.HOMEDIR), last_server_dict)
 
         self.disconnect_bypass()
 
@@ -2573,9 +2498,7 @@ class QomuiGui(QtWidgets.QWidget):
 
     def add_bypass_app(self, app_info):
         self.bypass_dict[app_info[0]] = [app_info[1], app_info[2]]
-
-        with open ("{}/bypass_apps.json".format(config.HOMEDIR), "w") as save_bypass:
-            json.dump(self.bypass_dict, save_bypass)
+        persist.save_json("{}/bypass_apps.json".format(config.HOMEDIR), self.bypass_dict)
 
         self.pop_bypassAppList()
 
@@ -2590,8 +2513,7 @@ class QomuiGui(QtWidgets.QWidget):
             except KeyError:
                 pass
 
-        with open ("{}/bypass_apps.json".format(config.HOMEDIR), "w") as save_bypass:
-            json.dump(self.bypass_dict, save_bypass)
+        persist.save_json("{}/bypass_apps.json".format(config.HOMEDIR), self.bypass_dict)
 
         self.pop_bypassAppList()
 
@@ -2603,7 +2525,6 @@ class QomuiGui(QtWidgets.QWidget):
             self.ListItem.setSizeHint(QtCore.QSize(100, 50))
             self.Item.setText(k, "bypass", v[0], None, button="bypass")
             self.ListItem.setData(QtCore.Qt.UserRole, k)
-            self.Item.hide_button(0)
             self.bypassAppList.addItem(self.ListItem)
             self.bypassAppList.setItemWidget(self.ListItem, self.Item)
             self.Item.server_chosen.connect(self.bypass_tunnel)
@@ -2657,18 +2578,7 @@ class QomuiGui(QtWidgets.QWidget):
 
 
     def modify_server(self):
-        try:
-            if self.serverListWidget.isVisible() is False:
-                item = self.serverListFilterWidget.currentItem()
-                data = item.data(QtCore.Qt.UserRole)
-                self.modify_row = self.serverListFilterWidget.row(item)
-            else:
-                item = self.serverListWidget.currentItem()
-                data = item.data(QtCore.Qt.UserRole)
-                self.modify_row = self.serverListWidget.row(item)
-
-        except AttributeError:
-            pass
+        data = self.serverListView.currentIndex().data(widgets.KEY_ROLE)
 
         try:
             editor = widgets.ModifyServer(key=data,
@@ -2676,23 +2586,16 @@ class QomuiGui(QtWidgets.QWidget):
             editor.modified.connect(self.apply_edit)
             editor.exec_()
 
-        except (UnboundLocalError, KeyError):
+        except KeyError:
             pass
 
     def apply_edit(self, modifications):
         key = modifications["key"]
-        val = modifications["info_update"]
+        val = record.ServerRecord(modifications["info_update"])
         provider = val["provider"]
         new_config =  modifications["config_change"]
-        row = self.modify_row
-        self.server_dict.pop(key)
         key_update = val["name"]
-        self.server_dict[key_update] = val
-        rm = self.index_list.index(key)
-        self.index_list.pop(rm)
-        self.index_list.insert(rm, key_update)
-        self.serverListWidget.takeItem(row)
-        self.add_server_widget(key_update, val, insert=row)
+        self.serverModel.rename(key, key_update, val)
 
         if val["country"] not in self.country_list:
             self.country_list.append(val["country"])
@@ -2705,8 +2608,7 @@ class QomuiGui(QtWidgets.QWidget):
                 self.countryBox.addItem(country)
                 self.countryBox.setItemText(index+1, country)
 
-        with open ("{}/server.json".format(config.HOMEDIR), "w") as s:
-            json.dump(self.server_dict, s)
+        self.server_store.rename(key, key_update, val)
 
         if len(new_config) != 0:
             try:
@@ -2734,9 +2636,7 @@ class QomuiGui(QtWidgets.QWidget):
                 pass
 
     def search_listitem(self, key):
-        for row in range(self.serverListWidget.count()):
-            if self.serverListWidget.item(row).data(QtCore.Qt.UserRole) == key:
-                return row
+        return self.server_catalogue.row(key)
 
 def main():
     if not os.path.exists("{}/.qomui".format(os.path.expanduser("~"))):
@@ -21,12 +21,13 @@ import dbus
 import dbus.service
 from dbus.mainloop.pyqt5 import DBusQtMainLoop
 
-from qomui import config, firewall, bypass, update, dns_manager, tunnel
+from qomui import config, firewall, bypass, update, dns_manager, tunnel, monitor, persist
 
 LOGDIR = "/usr/share/qomui/logs"
 OPATH = "/org/qomui/service"
 IFACE = "org.qomui.service"
 BUS_NAME = "org.qomui.service"
+PID_FILE = "{}/pids.json".format(config.ROOTDIR)
 
 class GuiLogHandler(logging.Handler):
     def __init__(self, send_log, parent=None):
@@ -72,13 +73,14 @@ class QomuiDbus(dbus.service.Object):
         self.logger.info("Dbus-service successfully initialized")
 
         #Clean slate after (re-)starting
-        try:
-            check_call(["killall", "openvpn"])
-            self.logger.debug("Killed all running instances of OpenVPN")
-        except CalledProcessError:
-            pass
-
+        self.kill_recorded_pids()
         self.check_version()
+        firewall.refresh_ipv6()
+        self.addr_mon_thread = monitor.AddrMon()
+        self.addr_mon_thread.addr_change.connect(self.addr_change)
+        self.addr_mon_thread.log.connect(self.log_thread)
+        self.addr_mon_thread.start()
+        firewall.recover()
         firewall.save_iptables()
         self.load_firewall(0)
 
@@ -122,9 +124,7 @@ class QomuiDbus(dbus.service.Object):
     def log_level_change(self, level):
         self.logger.setLevel(getattr(logging, level.upper()))
         config.settings["log_level"] = level
-
-        with open('{}/config.json'.format(config.ROOTDIR), 'w') as save_config:
-            json.dump(config.settings, save_config)
+        config.save_config()
 
     @dbus.service.method(BUS_NAME, in_signature='a{ss}', out_signature='')
     def connect_to_server(self, ovpn_dict):
@@ -150,10 +150,45 @@ class QomuiDbus(dbus.service.Object):
     def add_pid(self, pid):
         self.pid_list.append(pid)
 
+        try:
+            persist.write_json(PID_FILE, self.pid_list)
+
+        except OSError as e:
+            self.logger.debug("Failed to record pid {} - {}".format(pid, e))
+
+    #only kill processes started by a previous instance of qomui-service
+    def kill_recorded_pids(self):
+        try:
+            with open(PID_FILE, "r") as p:
+                recorded = json.load(p)
+
+        except FileNotFoundError:
+            self.logger.debug("{} not found - no processes left to terminate".format(PID_FILE))
+            return
+
+        except (OSError, json.decoder.JSONDecodeError):
+            recorded = []
+
+        for pid, name in recorded:
+
+            try:
+                if psutil.Process(pid).name().lower().startswith(name.split("_")[0].lower()):
+                    psutil.Process(pid).terminate()
+                    self.logger.debug("OS: process {} killed - {}".format(pid, name))
+
+            except psutil.Error:
+                pass
+
+        try:
+            os.remove(PID_FILE)
+        except OSError:
+            pass
+
     #get fw configuration - might be called from gui after config change
-    @dbus.service.method(BUS_NAME, in_signature='i', out_signature='')
+    @dbus.service.method(BUS_NAME, in_signature='i', out_signature='b')
     def load_firewall(self, stage):
         config.load_config()
+        result = True
 
         try:
             self.logger.setLevel(config.settings["log_level"].upper())
@@ -163,6 +198,11 @@ class QomuiDbus(dbus.service.Object):
             block_lan=config.settings["block_lan"]
             preserve=config.settings["preserve_rules"]
 
+            if config.settings["nftables"] == 1:
+                firewall.set_engine("nftables")
+            else:
+                firewall.set_engine("iptables")
+
             if fw == 1 and gui_only == 0:
                 opt = 1
             elif gui_only == 1 and stage == 1:
@@ -178,13 +218,14 @@ class QomuiDbus(dbus.service.Object):
                 opt = 2
 
             if opt < 2:
-                firewall.apply_rules(
+                result = firewall.apply_rules(
                                     opt,
                                     block_lan=block_lan,
                                     preserve=preserve
                                     )
         except KeyError:
             self.logger.warning('Malformed config file')
+            result = False
 
         #default dns is always set to the alternative servers
         self.dns = config.settings["alt_dns1"]
@@ -192,6 +233,26 @@ class QomuiDbus(dbus.service.Object):
         self.dns_bypass = config.settings["alt_dns1"]
         self.dns_2_bypass = config.settings["alt_dns2"]
 
+        return result
+
+    #latency probes other than icmp echo are dropped by the killswitch
+    @dbus.service.method(BUS_NAME, in_signature='asi', out_signature='b')
+    def allow_probes(self, ips, timeout):
+        return firewall.allow_temporary([str(ip) for ip in ips], int(timeout))
+
+    def addr_change(self):
+        previous = firewall.ip6_available
+        if firewall.refresh_ipv6() != previous:
+            self.ipv6_state(firewall.ip6_available)
+
+    @dbus.service.method(BUS_NAME, in_signature='', out_signature='b')
+    def get_ipv6_available(self):
+        return firewall.check_ipv6()
+
+    @dbus.service.signal(BUS_NAME, signature='b')
+    def ipv6_state(self, available):
+        return available
+
     @dbus.service.method(BUS_NAME, in_signature='i', out_signature='')
     def disable_ipv6(self, i):
         if i == 1:
@@ -237,8 +298,7 @@ class QomuiDbus(dbus.service.Object):
                     ["-D", "INPUT", "-i", "wg_qomui", "-j", "ACCEPT"],
                     ["-D", "OUTPUT", "-o", "wg_qomui", "-j", "ACCEPT"]
                     ]
-                firewall.batch_rule_6(wg_rules)
-                firewall.batch_rule(wg_rules)
+                firewall.batch_rules(wg_rules, wg_rules)
                 tunnel.exe_custom_scripts("down", self.wg_provider, config.settings)
                 self.wg_connect = 0
 
@@ -324,6 +384,12 @@ class QomuiDbus(dbus.service.Object):
             self.start_import_thread(provider, credentials)
 
     def start_import_thread(self, provider, credentials):
+        #providers import side by side, but only one thread per provider
+        running = getattr(self, "import_{}".format(provider), None)
+        if running is not None and running.isRunning():
+            self.logger.info("Import of {} is already running".format(provider))
+            return
+
         setattr(self, "import_{}".format(provider), update.AddServers(credentials))
         getattr(self, "import_{}".format(provider)).log.connect(self.log_thread)
         getattr(self, "import_{}".format(provider)).finished.connect(self.downloaded)
@@ -346,15 +412,12 @@ class QomuiDbus(dbus.service.Object):
         dns_manager.dns_request_exception("-D", config.settings["alt_dns1"], config.settings["alt_dns2"], "53")
 
         if provider in config.SUPPORTED_PROVIDERS:
-            with open('{}/config.json'.format(config.ROOTDIR), 'w') as save_config:
-                config.settings["{}_last".format(provider)] = str(datetime.utcnow())
-                if provider == "Airvpn":
-                    config.settings["airvpn_key"] = content["airvpn_key"]
-                json.dump(config.settings, save_config)
+            config.settings["{}_last".format(provider)] = str(datetime.utcnow())
+            if provider == "Airvpn":
+                config.settings["airvpn_key"] = content["airvpn_key"]
+            config.save_config(now=True)
 
-        with open('{}/{}.json'.format(self.homedir, provider), 'w') as p:
-            Popen(['chmod', '0666', '{}/{}.json'.format(self.homedir, provider)])
-            json.dump(content, p)
+        persist.write_json('{}/{}.json'.format(self.homedir, provider), content, mode=0o666)
 
         self.imported(provider)
 
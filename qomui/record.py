@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import socket
+import hashlib
+from collections.abc import MutableMapping
+
+IP_FIELDS = ("ip", "ip1", "ip2", "ip3", "ip4", "ip1_6", "ip2_6", "ip3_6", "ip4_6")
+INTERNED = ("provider", "country", "tunnel", "protocol", "port")
+TEXT = ("name", "city", "path", "public_key")
+FLOATS = ("latency", "score")
+#kept per user, never part of what a provider hands out
+LOCAL = FLOATS + ("favourite",)
+
+
+def pack_ip(ip):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(family, ip)
+        except (OSError, ValueError, TypeError):
+            pass
+
+    #hostnames and anything unparsable are kept as they are
+    return ip
+
+
+def digest(val):
+    """Hash of a server entry as imported - ips are normalised, local state is ignored"""
+    data = {k: v for k, v in ServerRecord(val).items() if k not in LOCAL}
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def unpack_ip(packed):
+    if isinstance(packed, bytes):
+        family = socket.AF_INET if len(packed) == 4 else socket.AF_INET6
+        return socket.inet_ntop(family, packed)
+    return packed
+
+
+class ServerRecord(MutableMapping):
+    """Compact server entry that still behaves like the old server dict
+
+    Provider, country and tunnel are interned, addresses are packed and
+    latency/score are native floats. Indexing returns the same strings
+    the json files always held, so dict(record) is what goes to json or
+    D-Bus.
+    """
+
+    __slots__ = INTERNED + TEXT + FLOATS + ("favourite", "addrs", "extra")
+
+    def __init__(self, data=None, **kwargs):
+        for attr in self.__slots__:
+            object.__setattr__(self, attr, None)
+
+        if data is not None:
+            self.update(data)
+        if kwargs:
+            self.update(kwargs)
+
+    def __getitem__(self, key):
+        if key in IP_FIELDS:
+            if self.addrs is None or self.addrs[IP_FIELDS.index(key)] is None:
+                raise KeyError(key)
+            return unpack_ip(self.addrs[IP_FIELDS.index(key)])
+
+        elif key in INTERNED or key in TEXT:
+            value = getattr(self, key)
+
+        elif key in FLOATS:
+            value = getattr(self, key)
+            if value is not None:
+                return str(value)
+
+        elif key == "favourite":
+            if self.favourite is None:
+                raise KeyError(key)
+            return "on" if self.favourite is True else "off"
+
+        else:
+            value = self.extra.get(key) if self.extra is not None else None
+
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in IP_FIELDS:
+            addrs = list(self.addrs or [None] * len(IP_FIELDS))
+            addrs[IP_FIELDS.index(key)] = pack_ip(value)
+            self.addrs = tuple(addrs)
+
+        elif key in INTERNED:
+            self.__setattr__(key, sys.intern(value) if isinstance(value, str) else value)
+
+        elif key in TEXT:
+            self.__setattr__(key, value)
+
+        elif key in FLOATS:
+            try:
+                self.__setattr__(key, float(value))
+            except (TypeError, ValueError):
+                self.__setattr__(key, None)
+
+        elif key == "favourite":
+            self.favourite = value == "on"
+
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        self[key]
+        if key in IP_FIELDS:
+            addrs = list(self.addrs)
+            addrs[IP_FIELDS.index(key)] = None
+            self.addrs = tuple(addrs) if any(a is not None for a in addrs) else None
+        elif key in self.__slots__:
+            self.__setattr__(key, None)
+        else:
+            del self.extra[key]
+
+    def __iter__(self):
+        for attr in INTERNED + TEXT + FLOATS:
+            if getattr(self, attr) is not None:
+                yield attr
+
+        if self.favourite is not None:
+            yield "favourite"
+
+        if self.addrs is not None:
+            for key, packed in zip(IP_FIELDS, self.addrs):
+                if packed is not None:
+                    yield key
+
+        if self.extra is not None:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "ServerRecord({})".format(dict(self))
+
+    def copy(self):
+        return dict(self)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import errno
+import random
+import select
+import socket
+import struct
+import logging
+import threading
+from subprocess import CalledProcessError, check_output
+
+from qomui import config
+
+TIMEOUT = 2.0
+TRIES = 2
+#queries in flight per nameserver at any time
+WINDOW = 64
+NEG_TTL = 30
+MAX_TTL = 3600
+#upper bound for waiting on a lookup another thread is running
+WAIT = 300
+RESOLV_CONF = "/etc/resolv.conf"
+
+A = 1
+AAAA = 28
+FAMILIES = {A: socket.AF_INET, AAAA: socket.AF_INET6}
+
+cache = {}
+inflight = {}
+lock = threading.Lock()
+rand = random.SystemRandom()
+
+
+def nameservers():
+    servers = config.settings.get("resolvers", [])
+    if len(servers) != 0:
+        return servers
+
+    servers = []
+    try:
+        with open(RESOLV_CONF, "r") as conf:
+            for line in conf:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver":
+                    servers.append(fields[1].split("%")[0])
+
+    except OSError as e:
+        logging.debug("Could not read {}: {}".format(RESOLV_CONF, e))
+
+    return servers
+
+
+def is_ip(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (OSError, ValueError):
+            pass
+    return False
+
+
+def build_query(qid, host, qtype):
+    qname = b""
+    for label in host.rstrip(".").split("."):
+        label = label.encode("idna")
+        qname += struct.pack("!B", len(label)) + label
+
+    #recursion desired, one question
+    return struct.pack("!HHHHHH", qid, 0x0100, 1, 0, 0, 0) + qname + b"\x00" + struct.pack("!HH", qtype, 1)
+
+
+def read_name(data, offset):
+    labels = []
+    end = None
+
+    #compression pointers may only point backwards, which bounds the loop
+    for _ in range(128):
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = struct.unpack_from("!H", data, offset)[0] & 0x3FFF
+        elif length == 0:
+            return ".".join(labels), end if end is not None else offset + 1
+        else:
+            labels.append(data[offset + 1:offset + 1 + length].decode("ascii", "replace"))
+            offset += length + 1
+
+    raise ValueError("DNS name too long")
+
+
+def parse_response(data):
+    """Return id, rcode, question name and type and the addresses found as (ip, ttl)"""
+    qid, flags, qdcount, ancount = struct.unpack_from("!HHHH", data)
+    rcode = flags & 0x000F
+    offset = 12
+    name, offset = read_name(data, offset)
+    qtype = struct.unpack_from("!H", data, offset)[0]
+    offset += 4
+
+    for _ in range(qdcount - 1):
+        _, offset = read_name(data, offset)
+        offset += 4
+
+    found = []
+    for _ in range(ancount):
+        _, offset = read_name(data, offset)
+        rtype, rclass, ttl, length = struct.unpack_from("!HHIH", data, offset)
+        offset += 10
+        rdata = data[offset:offset + length]
+        offset += length
+
+        #CNAME records are skipped, the addresses of the target follow them
+        if rtype == qtype and rtype in FAMILIES and rclass == 1:
+            found.append((socket.inet_ntop(FAMILIES[rtype], rdata), ttl))
+
+    return qid, rcode, name.lower(), qtype, found
+
+
+def exchange(questions, servers):
+    """Send all (host, qtype) questions over UDP and collect the answers
+
+    Unanswered questions are retried on the next nameserver. Returns
+    {(host, qtype): [(ip, ttl), ...]} for every question that got a
+    definite answer - an empty list means the name has no such record.
+    """
+    answers = {}
+    pending = list(questions)
+
+    for attempt in range(TRIES * len(servers)):
+        if len(pending) == 0:
+            break
+
+        server = servers[attempt % len(servers)]
+        family = socket.AF_INET6 if ":" in server else socket.AF_INET
+        unanswered = []
+
+        try:
+            sock = socket.socket(family, socket.SOCK_DGRAM)
+
+        except OSError as e:
+            logging.debug("Resolver: cannot open socket for {} - {}".format(server, e))
+            continue
+
+        try:
+            sock.setblocking(False)
+            sock.connect((server, 53))
+
+            for start in range(0, len(pending), WINDOW):
+                window = pending[start:start + WINDOW]
+                ids = rand.sample(range(65536), len(window))
+                waiting = {}
+
+                for qid, question in zip(ids, window):
+                    try:
+                        sock.send(build_query(qid, *question))
+                        waiting[qid] = question
+
+                    except UnicodeError:
+                        logging.debug("Resolver: invalid hostname {}".format(question[0]))
+                        answers[question] = []
+
+                    except OSError as e:
+                        if e.errno not in (errno.EAGAIN, errno.ENOBUFS):
+                            raise
+                        unanswered.append(question)
+
+                deadline = time.monotonic() + TIMEOUT
+                while len(waiting) != 0:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+
+                    readable = select.select([sock], [], [], remaining)[0]
+                    if not readable:
+                        continue
+
+                    try:
+                        data = sock.recv(4096)
+                        qid, rcode, name, qtype, found = parse_response(data)
+
+                    except OSError:
+                        continue
+
+                    except (ValueError, IndexError, struct.error):
+                        logging.debug("Resolver: malformed reply from {}".format(server))
+                        continue
+
+                    question = waiting.get(qid)
+                    if question is None or question[0].lower().rstrip(".") != name or question[1] != qtype:
+                        continue
+
+                    #NOERROR and NXDOMAIN are final, anything else is worth another server
+                    if rcode in (0, 3):
+                        answers[question] = found
+                        waiting.pop(qid)
+
+                unanswered.extend(waiting.values())
+
+        except OSError as e:
+            logging.debug("Resolver: query to {} failed - {}".format(server, e))
+            unanswered = [q for q in pending if q not in answers]
+
+        finally:
+            sock.close()
+
+        pending = unanswered
+
+    return answers
+
+
+def dig(host):
+    try:
+        dig_cmd = ["dig", "+time=2", "+tries=2", "{}".format(host), "+short"]
+        output = check_output(dig_cmd).decode("utf-8").split("\n")
+        return [ip for ip in output if is_ip(ip)]
+
+    except (FileNotFoundError, CalledProcessError):
+        return []
+
+
+def lookup(hosts):
+    servers = nameservers()
+    answers = exchange([(h, t) for h in hosts for t in (A, AAAA)], servers) if servers else {}
+    results = {}
+
+    for host in hosts:
+        found = answers.get((host, A), []) + answers.get((host, AAAA), [])
+        ips = []
+        for ip, _ in found:
+            if ip not in ips:
+                ips.append(ip)
+
+        if len(ips) != 0:
+            ttl = min(MAX_TTL, min(t for _, t in found))
+
+        elif config.settings.get("resolve_dig", 0) == 1:
+            ips = dig(host)
+            ttl = NEG_TTL
+
+        else:
+            if (host, A) not in answers and (host, AAAA) not in answers:
+                logging.debug("Resolver: no answer for {}".format(host))
+            ttl = NEG_TTL
+
+        results[host] = (time.monotonic() + ttl, ips)
+
+    return results
+
+
+def resolve_many(hosts):
+    """Resolve hostnames concurrently - returns {host: [ipv4..., ipv6...]}
+
+    Identical names are only queried once, also across threads, and
+    answers are kept for their TTL.
+    """
+    now = time.monotonic()
+    results = {}
+    mine = []
+    others = []
+
+    with lock:
+        for host in set(hosts):
+            if is_ip(host):
+                results[host] = [host]
+                continue
+
+            try:
+                expires, ips = cache[host]
+                if expires > now:
+                    results[host] = ips
+                    continue
+
+            except KeyError:
+                pass
+
+            if host in inflight:
+                others.append(host)
+            else:
+                inflight[host] = threading.Event()
+                mine.append(host)
+
+    if len(mine) != 0:
+        found = {}
+        try:
+            found = lookup(mine)
+
+        finally:
+            with lock:
+                for host in mine:
+                    if host in found:
+                        cache[host] = found[host]
+                    inflight.pop(host).set()
+
+        for host, (_, ips) in found.items():
+            results[host] = ips
+
+    for host in others:
+        event = inflight.get(host)
+        if event is not None:
+            event.wait(WAIT)
+
+        results[host] = cache.get(host, (0, []))[1]
+
+    return results
+
+
+def resolve(host):
+    return resolve_many([host])[host]
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import sqlite3
+import logging
+
+from qomui import config, record
+
+SCHEMA_VERSION = 1
+META = ["favourite", "last_used"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS servers (
+    key TEXT PRIMARY KEY,
+    provider TEXT NOT NULL,
+    country TEXT NOT NULL,
+    tunnel TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS servers_provider ON servers (provider);
+CREATE INDEX IF NOT EXISTS servers_country ON servers (country);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    favourite INTEGER NOT NULL DEFAULT 0,
+    last_used REAL
+);
+CREATE TABLE IF NOT EXISTS protocols (
+    provider TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sources (
+    provider TEXT PRIMARY KEY,
+    validators TEXT NOT NULL
+);
+"""
+
+
+class ServerStore(object):
+    """Servers, protocols and per-server metadata in ~/.qomui/servers.db
+
+    server.json and protocol.json are imported once and left in place.
+    """
+
+    def __init__(self, path=None, homedir=None):
+        self.homedir = homedir or config.HOMEDIR
+        self.path = path or "{}/servers.db".format(self.homedir)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SCHEMA)
+        self.migrate()
+
+    def migrate(self):
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        servers = self.read_json("server.json")
+        protocols = self.read_json("protocol.json")
+
+        with self.db:
+            self.put_servers(servers, commit=False)
+            for provider, protocol in protocols.items():
+                self.put_protocol(provider, protocol, commit=False)
+            self.db.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+
+        if len(servers) != 0:
+            logging.info("Migrated {} servers from server.json to {}".format(len(servers), self.path))
+
+    def read_json(self, name):
+        try:
+            with open("{}/{}".format(self.homedir, name), "r") as j:
+                return json.load(j)
+
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return {}
+
+    def row(self, key, val):
+        #latency and score are kept by LatencyStore in latency.json
+        data = {k: v for k, v in val.items() if k not in META and k not in record.FLOATS}
+        return (key, val["provider"], val["country"], val.get("tunnel"), json.dumps(data))
+
+    def put_servers(self, servers, commit=True):
+        rows = []
+        meta = []
+
+        for key, val in servers.items():
+
+            try:
+                rows.append(self.row(key, val))
+                meta.append((key, 1 if val.get("favourite") == "on" else 0))
+
+            except (KeyError, AttributeError):
+                logging.error("Malformed server entry: {} {}".format(key, val))
+
+        self.db.executemany("INSERT OR REPLACE INTO servers VALUES (?, ?, ?, ?, ?)", rows)
+        self.db.executemany("INSERT OR IGNORE INTO meta (key, favourite) VALUES (?, ?)", meta)
+        self.db.executemany("UPDATE meta SET favourite = ? WHERE key = ?", [(f, k) for k, f in meta])
+        if commit is True:
+            self.db.commit()
+
+    def upsert_servers(self, servers):
+        #unlike put_servers this leaves favourite and last use of known keys alone
+        rows = []
+
+        for key, val in servers.items():
+
+            try:
+                rows.append(self.row(key, val))
+
+            except (KeyError, AttributeError):
+                logging.error("Malformed server entry: {} {}".format(key, val))
+
+        self.db.executemany("INSERT OR REPLACE INTO servers VALUES (?, ?, ?, ?, ?)", rows)
+        self.db.executemany("INSERT OR IGNORE INTO meta (key) VALUES (?)", [(r[0],) for r in rows])
+
+    def apply_import(self, content, replace=False):
+        """Write the added, changed and removed servers of one import
+
+        With replace a full import (no earlier state) drops every other
+        server of that provider, as the provider list is authoritative.
+        """
+        provider = content["provider"]
+
+        with self.db:
+            if "validators" in content:
+                self.set_validators(provider, content["validators"], commit=False)
+
+            if content.get("unchanged") == "1":
+                return
+
+            if replace is True and content.get("full") == "1":
+                self.db.execute("DELETE FROM servers WHERE provider = ?", (provider,))
+
+            self.db.executemany("DELETE FROM servers WHERE key = ?", [(k,) for k in content["removed"]])
+            self.upsert_servers(content["added"])
+            self.upsert_servers(content["changed"])
+            self.db.execute("DELETE FROM meta WHERE key NOT IN (SELECT key FROM servers)")
+
+    def delete_servers(self, keys):
+        with self.db:
+            self.db.executemany("DELETE FROM servers WHERE key = ?", [(k,) for k in keys])
+            self.db.executemany("DELETE FROM meta WHERE key = ?", [(k,) for k in keys])
+
+    def delete_provider(self, provider):
+        with self.db:
+            self.db.execute("DELETE FROM meta WHERE key IN (SELECT key FROM servers WHERE provider = ?)",
+                            (provider,))
+            self.db.execute("DELETE FROM servers WHERE provider = ?", (provider,))
+            self.db.execute("DELETE FROM protocols WHERE provider = ?", (provider,))
+            self.db.execute("DELETE FROM sources WHERE provider = ?", (provider,))
+
+    def rename(self, key, new_key, val):
+        with self.db:
+            self.db.execute("DELETE FROM servers WHERE key = ?", (key,))
+            self.db.execute("UPDATE OR REPLACE meta SET key = ? WHERE key = ?", (new_key, key))
+            self.put_servers({new_key: val}, commit=False)
+
+    def set_favourite(self, key, state):
+        with self.db:
+            self.db.execute("UPDATE meta SET favourite = ? WHERE key = ?", (1 if state else 0, key))
+
+    def set_last_used(self, key):
+        with self.db:
+            self.db.execute("UPDATE meta SET last_used = ? WHERE key = ?", (time.time(), key))
+
+    def servers(self, provider=None, country=None):
+        query = ("SELECT s.key, s.data, m.favourite "
+                 "FROM servers s LEFT JOIN meta m ON s.key = m.key")
+        where = []
+        args = []
+
+        if provider is not None:
+            where.append("s.provider = ?")
+            args.append(provider)
+
+        if country is not None:
+            where.append("s.country = ?")
+            args.append(country)
+
+        if len(where) != 0:
+            query += " WHERE " + " AND ".join(where)
+
+        servers = {}
+        for key, data, favourite in self.db.execute(query, args):
+            val = record.ServerRecord(json.loads(data))
+            val.favourite = favourite == 1
+            servers[key] = val
+
+        return servers
+
+    def favourites(self):
+        return [r[0] for r in self.db.execute("SELECT key FROM meta WHERE favourite = 1")]
+
+    def last_used(self, limit=10):
+        query = "SELECT key FROM meta WHERE last_used IS NOT NULL ORDER BY last_used DESC LIMIT ?"
+        return [r[0] for r in self.db.execute(query, (limit,))]
+
+    def keys(self, provider=None):
+        if provider is None:
+            return [r[0] for r in self.db.execute("SELECT key FROM servers")]
+
+        return [r[0] for r in self.db.execute("SELECT key FROM servers WHERE provider = ?", (provider,))]
+
+    def protocols(self):
+        return {p: json.loads(d) for p, d in self.db.execute("SELECT provider, data FROM protocols")}
+
+    def put_protocol(self, provider, protocol, commit=True):
+        self.db.execute("INSERT OR REPLACE INTO protocols VALUES (?, ?)", (provider, json.dumps(protocol)))
+        if commit is True:
+            self.db.commit()
+
+    def delete_protocol(self, provider):
+        with self.db:
+            self.db.execute("DELETE FROM protocols WHERE provider = ?", (provider,))
+
+    def validators(self, provider):
+        row = self.db.execute("SELECT validators FROM sources WHERE provider = ?", (provider,)).fetchone()
+        if row is None:
+            return {}
+
+        return json.loads(row[0])
+
+    def set_validators(self, provider, validators, commit=True):
+        self.db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?)", (provider, json.dumps(validators)))
+        if commit is True:
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
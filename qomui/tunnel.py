@@ -306,8 +306,7 @@ class TunnelThread(QtCore.QThread):
                     ["-I", "OUTPUT", "2", "-o", "wg_qomui", "-j", "ACCEPT"]
                     ]
 
-        firewall.batch_rule_6(wg_rules)
-        firewall.batch_rule(wg_rules)
+        firewall.batch_rules(wg_rules, wg_rules)
         time.sleep(1)
 
         try:
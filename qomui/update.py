@@ -7,17 +7,21 @@ import gzip
 import tarfile
 import requests
 import os
-import re
-import io
 import logging
 import shutil
 import uuid
+import zlib
+import hashlib
+import tempfile
+import multiprocessing
 
 from PyQt5 import QtCore
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from subprocess import PIPE, Popen, check_output, CalledProcessError, run
 
-from qomui import config, firewall
+from qomui import config, firewall, record, resolver, geoip, conf_parser
 
 try:
     _fromUtf8 = QtCore.QString.fromUtf8
@@ -26,17 +30,35 @@ except AttributeError:
         return s
 
 TEMPDIR = "/usr/share/qomui/temp"
+ALLOW_TIMEOUT = 900
+FETCH_WORKERS = 4
+POOL_SIZE = 16
+#smaller folders are parsed in this thread, a process pool is not worth starting
+PARSE_INLINE = 64
+CHUNK = 65536
+#downloads larger than this spill from memory to disk
+SPOOL_MAX = 4 * 1024 * 1024
+
+#one connection pool shared by every provider import
+pool_adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
 
 def country_translate(cc):
-    try:
-        with open("{}/countries.json".format(config.ROOTDIR), "r") as c_json:
-            cc_lib = json.load(c_json)
+    return geoip.country_name(cc)
 
-        country = cc_lib[cc.upper()]
-        return country
 
-    except KeyError:
-        return "Unknown"
+class PooledSession(requests.Session):
+    """Session with its own cookies and headers that borrows connections from pool_adapter
+
+    Closing it leaves the shared pool alone as other imports may still use it.
+    """
+
+    def __init__(self):
+        super(PooledSession, self).__init__()
+        self.mount("https://", pool_adapter)
+        self.mount("http://", pool_adapter)
+
+    def close(self):
+        pass
 
 
 class AddServers(QtCore.QThread):
@@ -61,6 +83,15 @@ class AddServers(QtCore.QThread):
         except KeyError:
             self.key = "Default"
 
+        #validators of the last import plus digests of the servers the caller holds
+        try:
+            self.validators = json.loads(credentials["validators"])
+        except (KeyError, ValueError):
+            self.validators = {}
+
+        self.known = self.validators.get("servers")
+        self.new_validators = {"http" : dict(self.validators.get("http", {}))}
+
     def run(self):
         self.started.emit(self.provider)
         self.log.emit(("debug", "Started new thread to import {}".format(self.provider)))
@@ -83,11 +114,12 @@ class AddServers(QtCore.QThread):
         from cryptography.hazmat.primitives import serialization, hashes, asymmetric, ciphers
 
         self.log.emit(("info", "Creating temporary rule to access Airvpn API"))
-        firewall.allow_dest_ip("54.93.175.114", "-I")
+        firewall.allow_dest_ip("54.93.175.114", "-I", timeout=ALLOW_TIMEOUT)
         self.allowed_ips.append("54.93.175.114")
         self.airvpn_servers = {}
         self.airvpn_protocols = {}
         self.backend = default_backend()
+        self.session = PooledSession()
 
         #Those are sent with AES-256-CBC encryption
         data_params = {
@@ -166,62 +198,22 @@ class AddServers(QtCore.QThread):
                         c.write(user_key.attrib[a])
 
             data_params["act"] = "manifest"
-            data_params["ts"] = "0"
+            data_params["ts"] = self.validators.get("ts", "0") if self.known is not None else "0"
             server_params_crypt = self.encrypt_data_params(data_params)
             payload["d"] = base64.b64encode(server_params_crypt).decode("utf-8")
-            server_xml = self.call_air_api(payload)
-            decrypt_server = self.cipher.decryptor()
-            server_xml = decrypt_server.update(server_xml.content) + decrypt_server.finalize()
-            server_xml = server_xml.decode("utf-8").split("</manifest>")[0] + "</manifest>"
-            server_xml_root = et.fromstring(server_xml, parser=parser)
-            for i, child in enumerate(server_xml_root):
-                if child.tag == "modes":
-                    modes = i
-                elif child.tag == "servers":
-                    servers = i
-
-            n = 1
-            for mode in server_xml_root[modes]:
-                try:
-                    self.airvpn_protocols["protocol_{}".format(n)] = {
-                                        "protocol" : mode.attrib["protocol"].upper(),
-                                        "port" : mode.attrib["port"],
-                                        "ip" : "ip" + str(int(mode.attrib["entry_index"])+1),
-                                        "ipv6" : "ipv4"
-                                        }
+            server_xml = self.call_air_api(payload, stream=True)
+            content_hash, complete = self.airvpn_manifest(server_xml)
 
-                    n+=1
-                    self.airvpn_protocols["protocol_{}".format(n)] = {
-                                        "protocol" : mode.attrib["protocol"].upper(),
-                                        "port" : mode.attrib["port"],
-                                        "ip" : "ip" + str(int(mode.attrib["entry_index"])+1),
-                                        "ipv6" : "ipv6"
-                                        }
-                    n+=1
-                except KeyError:
-                    pass
-
-            entry_ips = ["ip1", "ip2", "ip3", "ip4", "ip1_6", "ip2_6", "ip3_6", "ip4_6"]
-
-            for server in server_xml_root[servers]:
-                try:
-                    country = country_translate(server.attrib["country_code"])
-                    self.airvpn_servers[server.attrib["name"]] = {
-                                        "name" : server.attrib["name"],
-                                        "provider": "Airvpn",
-                                        "city": server.attrib["location"],
-                                        "country" : country,
-                                        "tunnel" : "OpenVPN"
-                                        }
-
-                    self.log.emit(("debug", "Importing {}".format(server.attrib["name"])))
-                    ips = server.attrib["ips_entry"].split(",")
-                    for index, entry in enumerate(ips):
-                        self.airvpn_servers[server.attrib["name"]][entry_ips[index]] = entry
-
-                except KeyError:
-                    pass
+            #a truncated manifest must not pass for an unchanged one
+            if complete is False:
+                self.log.emit(("info", "Airvpn: Incomplete server manifest - aborting"))
+                self.remove_temp_dir(self.provider)
+                self.failed.emit("Airvpn download failed&Incomplete server list received&{}".format(self.provider))
+                return
 
+            if self.digest_unchanged(content_hash):
+                self.unchanged({"airvpn_key" : self.key})
+                return
 
             airvpn_data = {
                             "server" : self.airvpn_servers,
@@ -231,7 +223,7 @@ class AddServers(QtCore.QThread):
                             }
 
             self.copy_certs(self.provider)
-            self.finished.emit(airvpn_data)
+            self.finished.emit(self.diff(airvpn_data))
 
         except ValueError as e:
             self.log.emit(("debug", e.args))
@@ -261,13 +253,115 @@ class AddServers(QtCore.QThread):
 
         return encrypted
 
-    def call_air_api(self, payload):
+    def airvpn_manifest(self, response):
+        """Decrypt the manifest while it downloads and parse it as it goes
+
+        Servers and modes are taken as their elements close and then
+        dropped, so neither the plaintext nor the whole tree is ever held.
+        Returns the sha256 of the plaintext and whether a server list was found.
+        """
+        from lxml import etree
+        from cryptography.hazmat.primitives import padding
+
+        decryptor = self.cipher.decryptor()
+        unpadder = padding.PKCS7(128).unpadder()
+        parser = etree.XMLPullParser(events=("start", "end"), recover=True)
+        content_hash = hashlib.sha256()
+        self.airvpn_mode = 1
+        self.airvpn_complete = False
+
+        for chunk in response.iter_content(CHUNK):
+            data = unpadder.update(decryptor.update(chunk))
+            content_hash.update(data)
+            parser.feed(data)
+            self.airvpn_events(parser.read_events())
+
+        data = decryptor.finalize()
         try:
-            xml = requests.post(
+            data = unpadder.update(data) + unpadder.finalize()
+
+        except ValueError:
+            #the old importer never unpadded either, recover mode copes with the leftovers
+            self.log.emit(("debug", "Airvpn: manifest padding is invalid"))
+
+        content_hash.update(data)
+        parser.feed(data)
+        self.airvpn_events(parser.read_events())
+
+        try:
+            parser.close()
+
+        except etree.XMLSyntaxError as e:
+            self.log.emit(("debug", "Airvpn: {}".format(e)))
+
+        self.airvpn_events(parser.read_events())
+        return content_hash.hexdigest(), self.airvpn_complete
+
+    def airvpn_events(self, events):
+        entry_ips = ["ip1", "ip2", "ip3", "ip4", "ip1_6", "ip2_6", "ip3_6", "ip4_6"]
+
+        for event, elem in events:
+            if event == "start":
+                if elem.tag == "manifest" and "time" in elem.attrib:
+                    self.new_validators["ts"] = elem.attrib["time"]
+                continue
+
+            parent = elem.getparent()
+            parent_tag = parent.tag if parent is not None else None
+
+            if elem.tag == "mode" and parent_tag == "modes":
+                try:
+                    for ipv6 in ["ipv4", "ipv6"]:
+                        self.airvpn_protocols["protocol_{}".format(self.airvpn_mode)] = {
+                                            "protocol" : elem.attrib["protocol"].upper(),
+                                            "port" : elem.attrib["port"],
+                                            "ip" : "ip" + str(int(elem.attrib["entry_index"])+1),
+                                            "ipv6" : ipv6
+                                            }
+                        self.airvpn_mode += 1
+
+                except (KeyError, ValueError):
+                    pass
+
+            elif elem.tag == "server" and parent_tag == "servers":
+                try:
+                    name = elem.attrib["name"]
+                    server = {
+                                "name" : name,
+                                "provider": "Airvpn",
+                                "city": elem.attrib["location"],
+                                "country" : country_translate(elem.attrib["country_code"]),
+                                "tunnel" : "OpenVPN"
+                                }
+
+                    for index, entry in enumerate(elem.attrib["ips_entry"].split(",")[:len(entry_ips)]):
+                        server[entry_ips[index]] = entry
+
+                    self.log.emit(("debug", "Importing {}".format(name)))
+                    self.airvpn_servers[name] = server
+
+                except KeyError:
+                    pass
+
+            elif elem.tag == "servers":
+                self.airvpn_complete = True
+
+            else:
+                continue
+
+            #finished elements and their already handled siblings are not needed anymore
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+
+    def call_air_api(self, payload, stream=False):
+        try:
+            xml = self.session.post(
                                 "http://54.93.175.114",
                                 data=payload,
                                 cert="{}/airvpn_cacert.pem".format(config.ROOTDIR),
-                                timeout=2
+                                timeout=2,
+                                stream=stream
                                 )
             return xml
 
@@ -283,18 +377,26 @@ class AddServers(QtCore.QThread):
         self.log.emit(("info", "Downloading certificates for Mullvad"))
         auth = 0
         certificates = {"ca.crt":"mullvad_ca.crt" ,"api_root_ca.pem":"mullvad_crl.pem"}
-        with requests.Session() as self.session:
+        with PooledSession() as self.session:
             try:
+                listing = self.fetch_listing([
+                                            "https://www.mullvad.net/en/servers/",
+                                            "https://api.mullvad.net/public/relays/wireguard/v1/"
+                                            ])
+
+                if listing is None:
+                    self.unchanged()
+                    return
+
                 certfiles = ["ca.crt", "api_root_ca.pem"]
                 git_raw = "https://raw.githubusercontent.com/mullvad/mullvadvpn-app/master/dist-assets/"
+                urls = ["{}{}".format(git_raw, c) for c in certfiles]
 
-                for c in certfiles:
-                    certificate = self.session.get("{}{}".format(git_raw, c), timeout=2)
-
+                for c, certificate in zip(certfiles, self.parallel(self.get, urls)):
                     with open("{}/{}".format(self.temp_path, certificates[c]), 'w') as cert_file:
                         cert_file.write(certificate.content.decode("utf-8"))
 
-                page = self.session.get('https://www.mullvad.net/en/servers/', timeout=2)
+                page = listing[0]
                 self.log.emit(("info", "Fetching server list for Mullvad"))
                 server_page = BeautifulSoup(page.content, "lxml")
                 server_parse = server_page.find_all("div", {"class": "table-container"})
@@ -330,9 +432,7 @@ class AddServers(QtCore.QThread):
                 try:
                     self.log.emit(("info", "Creating WireGuard config files for Mullvad"))
                     wg_list = []
-                    wg_api = "https://api.mullvad.net/public/relays/wireguard/v1/"
-                    wg_get = self.session.get(wg_api, timeout=2)
-                    wg_dict = wg_get.json()
+                    wg_dict = listing[1].json()
                     for c in wg_dict["countries"]:
                         for k,v in c.items():
                             country_raw = c["name"]
@@ -401,7 +501,7 @@ class AddServers(QtCore.QThread):
                                     }
 
                     self.copy_certs(self.provider)
-                    self.finished.emit(Mullvad_dict)
+                    self.finished.emit(self.diff(Mullvad_dict))
 
             except requests.exceptions.RequestException as e:
                 self.log.emit(("error", "Network error: Unable to retrieve data from mullvad.net"))
@@ -419,6 +519,143 @@ class AddServers(QtCore.QThread):
 
         return country
 
+    def get(self, url):
+        return self.session.get(url, timeout=2)
+
+    def parallel(self, func, items):
+        #results keep the order of items, the first exception is re-raised
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+            return list(pool.map(func, items))
+
+    def conditional_get(self, url, name=None, force=False, stream=False):
+        name = name or url
+        cached = self.new_validators["http"].get(name, {})
+        headers = {}
+
+        if self.known is not None and force is False:
+            if "etag" in cached:
+                headers["If-None-Match"] = cached["etag"]
+            if "last_modified" in cached:
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        response = self.session.get(url, headers=headers, timeout=2, stream=stream)
+        if response.status_code != 304:
+            self.new_validators["http"][name] = {
+                k: response.headers[h] for k, h in [("etag", "ETag"), ("last_modified", "Last-Modified")]
+                if h in response.headers
+                }
+
+        return response
+
+    def fetch_listing(self, urls, names=None):
+        """Conditionally fetch the documents a server list is built from
+
+        Returns None if none of them changed since the last import,
+        otherwise the responses in the order of urls.
+        """
+        names = names or urls
+        responses = self.parallel(lambda u: self.conditional_get(*u), zip(urls, names))
+        if all(r.status_code == 304 for r in responses):
+            return None
+
+        #a partial hit is useless as the list is built from all documents
+        for i, r in enumerate(responses):
+            if r.status_code == 304:
+                responses[i] = self.conditional_get(urls[i], name=names[i], force=True)
+
+        for r in responses:
+            r.raise_for_status()
+
+        content_hash = hashlib.sha256(b"".join(r.content for r in responses)).hexdigest()
+        if self.digest_unchanged(content_hash):
+            return None
+
+        return responses
+
+    def digest_unchanged(self, content_hash):
+        self.new_validators["digest"] = content_hash
+        return self.known is not None and content_hash == self.validators.get("digest")
+
+    def spool(self, response):
+        """Stream a response into a spooled temporary file, returns the file and its sha256"""
+        response.raise_for_status()
+        spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX, dir=TEMPDIR)
+        content_hash = hashlib.sha256()
+
+        for chunk in response.iter_content(CHUNK):
+            content_hash.update(chunk)
+            spooled.write(chunk)
+
+        spooled.seek(0)
+        return spooled, content_hash.hexdigest()
+
+    def extract_changed(self, archive, members):
+        """Write zip members to temp_path unless the provider directory already holds them
+
+        members maps ZipInfo to the file name to use. Existing files are
+        compared by CRC, so unchanged ones are neither extracted nor copied.
+        """
+        provider_dir = "{}/{}".format(config.ROOTDIR, self.provider)
+        skipped = 0
+
+        for info, name in members.items():
+            crc = 0
+
+            try:
+                with open("{}/{}".format(provider_dir, name), "rb") as existing:
+                    for chunk in iter(lambda: existing.read(CHUNK), b""):
+                        crc = zlib.crc32(chunk, crc)
+
+                if crc == info.CRC:
+                    skipped += 1
+                    continue
+
+            except OSError:
+                pass
+
+            with archive.open(info) as src, open("{}/{}".format(self.temp_path, name), "wb") as dest:
+                shutil.copyfileobj(src, dest, CHUNK)
+
+        self.log.emit(("debug", "{}: {} of {} files unchanged".format(self.provider, skipped, len(members))))
+
+    def unchanged(self, content=None):
+        self.log.emit(("info", "{}: Server list has not changed since last update".format(self.provider)))
+        content = content or {}
+        content.update({
+                        "provider" : self.provider,
+                        "unchanged" : "1",
+                        "validators" : self.new_validators
+                        })
+
+        self.copy_certs(self.provider)
+        self.finished.emit(content)
+
+    def diff(self, content):
+        """Replace the full server dict by what was added, changed and removed
+
+        Without digests from the caller everything counts as added and
+        the import is marked full.
+        """
+        servers = content.pop("server")
+        content["validators"] = self.new_validators
+
+        if self.known is None:
+            content["full"] = "1"
+            content["added"] = servers
+            content["changed"] = {}
+            content["removed"] = []
+
+        else:
+            content["added"] = {k: v for k, v in servers.items() if k not in self.known}
+            content["changed"] = {k: v for k, v in servers.items()
+                                  if k in self.known and record.digest(v) != self.known[k]}
+            content["removed"] = [k for k in self.known if k not in servers]
+
+        self.log.emit(("info", "{}: {} servers added, {} changed, {} removed".format(
+            self.provider, len(content["added"]), len(content["changed"]), len(content["removed"]))))
+
+        return content
+
     def pia(self):
         self.allow_ip(["www.privateinternetaccess.com"])
         self.pia_servers = {}
@@ -428,54 +665,80 @@ class AddServers(QtCore.QThread):
         url_strong =  "https://www.privateinternetaccess.com/openvpn/openvpn-strong.zip"
 
         try:
-            with requests.Session() as self.session:
-                download_ip = self.session.get(url_ip, timeout=2)
-                filepath = "{}/ip".format(self.temp_path)
-                z = zipfile.ZipFile(io.BytesIO(download_ip.content))
-                z.extractall(filepath)
-
-            vpnfiles = sorted([f for f in os.listdir(filepath) if f.endswith('.ovpn')])
-            for ovpn in vpnfiles:
-                f = "{}/{}".format(filepath, ovpn)
-                filedata = open(f, "r").read()
-                ipsearch = re.compile('\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
-                result = ipsearch.findall(filedata)
+            with PooledSession() as self.session:
+                urls = [url_ip, url_strong]
+                downloads = self.parallel(lambda u: self.conditional_get(u, stream=True), urls)
+                if all(d.status_code == 304 for d in downloads):
+                    self.unchanged()
+                    return
+
+                #certificates in the strong archive may change on their own
+                for i, d in enumerate(downloads):
+                    if d.status_code == 304:
+                        downloads[i] = self.conditional_get(urls[i], force=True, stream=True)
+
+                (ip_zip, ip_hash), (strong_zip, strong_hash) = [self.spool(d) for d in downloads]
+                if self.digest_unchanged("{}{}".format(ip_hash, strong_hash)):
+                    ip_zip.close()
+                    strong_zip.close()
+                    self.unchanged()
+                    return
+
+            #configs are parsed straight from the archive, nothing is extracted
+            with ip_zip, zipfile.ZipFile(ip_zip) as z:
+                members = sorted([i for i in z.infolist() if i.filename.endswith('.ovpn')], key=lambda i: i.filename)
+
+                for info in members:
+                    with z.open(info) as member:
+                        filedata = member.read().decode("utf-8", "replace")
+
+                    result = conf_parser.IPV4.findall(filedata)
+                    if len(result) == 0:
+                        continue
 
-                for i in result:
-                    ip = i
+                    ip = result[-1]
+                    raw_name = os.path.splitext(os.path.basename(info.filename))[0]
+                    name = "PIA-{}".format(raw_name)
 
-                raw_name = os.path.splitext(ovpn)[0]
-                name = "PIA-{}".format(raw_name)
+                    try:
+                        parse_country = raw_name.split(" ")[0]
+                        if len(parse_country) == 2:
 
-                try:
-                    parse_country = raw_name.split(" ")[0]
-                    if len(parse_country) == 2:
+                            if parse_country == "UK":
+                                parse_country = "GB"
+                            country = country_translate(parse_country)
 
-                        if parse_country == "UK":
-                            parse_country = "GB"
-                        country = country_translate(parse_country)
+                        else:
+                            country = raw_name
 
-                    else:
+                    except AttributeError:
                         country = raw_name
 
-                except AttributeError:
-                    country = raw_name
+                    self.log.emit(("debug", "importing {}".format(name)))
+                    self.pia_servers[name] = {
+                                                "name" : name,
+                                                "country" : country,
+                                                "ip" : ip,
+                                                "city" : "",
+                                                "provider" : "PIA",
+                                                "tunnel" : "OpenVPN"
+                                                }
 
-                self.log.emit(("debug", "importing {}".format(name)))
-                self.pia_servers[name] = {
-                                            "name" : name,
-                                            "country" : country,
-                                            "ip" : ip,
-                                            "city" : "",
-                                            "provider" : "PIA",
-                                            "tunnel" : "OpenVPN"
-                                            }
+            certificates = {
+                            "crl.rsa.4096.pem" : "pia_crl.rsa.4096.pem",
+                            "ca.rsa.4096.crt" : "pia_ca.rsa.4096.crt"
+                            }
+
+            with strong_zip, zipfile.ZipFile(strong_zip) as z:
+                members = {}
+                for orig, dest in certificates.items():
+                    try:
+                        members[z.getinfo(orig)] = dest
 
-            with requests.Session() as self.session:
-                download_ip = self.session.get(url_strong, timeout=2)
-                filepath = "{}/strong".format(self.temp_path)
-                z = zipfile.ZipFile(io.BytesIO(download_ip.content))
-                z.extractall(filepath)
+                    except KeyError as e:
+                        self.log.emit(("error", e))
+
+                self.extract_changed(z, members)
 
             self.pia_protocols = {
                                     "protocol_1" : {"protocol": "UDP", "port": "1197"},
@@ -489,27 +752,8 @@ class AddServers(QtCore.QThread):
                         "tunnel" : "OpenVPN"
                         }
 
-            certificates = {
-                            "{}/strong/crl.rsa.4096.pem".format(self.temp_path) :"{}/pia_crl.rsa.4096.pem".format(self.temp_path),
-                            "{}/strong/ca.rsa.4096.crt".format(self.temp_path) :"{}/pia_ca.rsa.4096.crt".format(self.temp_path)
-                            }
-
-            for orig, dest in certificates.items():
-                try:
-                    shutil.copyfile(orig, dest)
-
-                except FileNotFoundError as e:
-                    self.log.emit(("error", e))
-
-            try:
-                shutil.rmtree("{}/ip".format(self.temp_path))
-                shutil.rmtree("{}/strong".format(self.temp_path))
-
-            except FileNotFoundError as e:
-                self.log.emit(("error", e))
-
             self.copy_certs(self.provider)
-            self.finished.emit(pia_dict)
+            self.finished.emit(self.diff(pia_dict))
 
         except requests.exceptions.RequestException as e:
             self.log.emit(("error", "Network error: Unable to retrieve data from privateinternetaccess.com"))
@@ -532,7 +776,7 @@ class AddServers(QtCore.QThread):
         self.log.emit(("info", "Logging into windscribe.com"))
 
         try:
-            with requests.Session() as self.session:
+            with PooledSession() as self.session:
                 self.session.headers.update(self.header)
                 self.session.get(login_url, timeout=2)
                 self.session.headers.update({"Host" : "res.windscribe.com",
@@ -578,15 +822,22 @@ class AddServers(QtCore.QThread):
     def windscribe_get_servers(self):
         self.log.emit(("info", "Generating server list for Windscribe"))
         cert_url = "https://assets.windscribe.com/desktop/other/openvpn_cert.zip"
-        get_certs = self.session.get(cert_url, timeout=2)
-        z = zipfile.ZipFile(io.BytesIO(get_certs.content))
-        z.extractall(self.temp_path)
-
         uid = uuid.uuid4()
         random = uid.hex
         api_url = "https://assets.windscribe.com/serverlist/openvpn/1/{}".format(random)
 
-        data = json.loads(self.session.get(api_url, timeout=2).content.decode("utf-8"))
+        #the random suffix changes every time so validators are kept under a fixed name
+        listing = self.fetch_listing([api_url], names=["serverlist"])
+        if listing is None:
+            self.unchanged()
+            return
+
+        cert_zip = self.spool(self.session.get(cert_url, timeout=2, stream=True))[0]
+        with cert_zip, zipfile.ZipFile(cert_zip) as z:
+            members = {i: os.path.basename(i.filename) for i in z.infolist() if not i.is_dir()}
+            self.extract_changed(z, members)
+
+        data = json.loads(listing[0].content.decode("utf-8"))
 
         for s in data["data"]:
 
@@ -648,7 +899,7 @@ class AddServers(QtCore.QThread):
                     }
 
         self.copy_certs(self.provider)
-        self.finished.emit(ws_dict)
+        self.finished.emit(self.diff(ws_dict))
 
     def protonvpn(self):
         self.allow_ip(["api.protonmail.ch"])
@@ -661,10 +912,15 @@ class AddServers(QtCore.QThread):
                   }
 
         try:
-            with requests.Session() as self.session:
+            with PooledSession() as self.session:
                 self.session.headers.update(headers)
                 api_url = "https://api.protonmail.ch/vpn/logicals"
-                get_servers = json.loads(self.session.get(api_url, timeout=2).content.decode("utf-8"))
+                listing = self.fetch_listing([api_url])
+                if listing is None:
+                    self.unchanged()
+                    return
+
+                get_servers = json.loads(listing[0].content.decode("utf-8"))
 
                 for s in get_servers["LogicalServers"]:
                     tor = 0
@@ -721,7 +977,7 @@ class AddServers(QtCore.QThread):
 
 
                 cert_url = "https://api.protonmail.ch/vpn/config?Platform=Linux&LogicalID={}&Protocol=udp".format(server_id)
-                ovpn = requests.get(cert_url, timeout=2).content.decode("utf-8")
+                ovpn = self.get(cert_url).content.decode("utf-8")
 
                 ca_cert = BeautifulSoup(ovpn, "lxml").find("ca")
                 with open("{}/proton_ca.crt".format(self.temp_path), "w") as ca:
@@ -742,7 +998,7 @@ class AddServers(QtCore.QThread):
                                 }
 
                 self.copy_certs(self.provider)
-                self.finished.emit(proton_dict)
+                self.finished.emit(self.diff(proton_dict))
 
         except requests.exceptions.RequestException as e:
             self.log.emit(("error", "Network error: Unable to retrieve data from api.protonmail.ch"))
@@ -752,52 +1008,35 @@ class AddServers(QtCore.QThread):
     def azirevpn(self):
         self.az_servers = {}
         self.allow_ip(["azirevpn.net"])
+        self.session = PooledSession()
 
         try:
 
             try:
                 self.log.emit(("info", "Downloading AzireVPN OpenVPN configs"))
                 az_api_url = "https://api.azirevpn.com/v1/locations"
-                az_servers = json.loads(requests.get(az_api_url, timeout=2).content.decode("utf-8"))
+                listing = self.fetch_listing([az_api_url])
 
             except requests.exceptions.RequestException as e:
-                az_servers = {"locations" : []}
                 self.log.emit(("error", "Network error: Unable to retrieve data from api.azirevpn.com"))
                 self.remove_temp_dir(self.provider)
                 self.failed.emit("Network error&No internet connection&{}".format(self.provider))
+                return
 
-            for s in az_servers["locations"]:
-                name = s["name"] + "-openvpn" + "-azirevpn"
-                wg_name = s["name"] + "-wireguard" + "-azirevpn"
-                country = country_translate(s["iso"])
-                hostname = s["endpoints"]["openvpn"][0]["hostname"]
-                ip = resolve(hostname)[0]
-                self.log.emit(("info", "Importing {}".format(name)))
+            if listing is None:
+                self.unchanged()
+                return
 
-                if ip != "Failed to resolve":
-                    self.az_servers[name] = {
-                                            "name": name,
-                                            "provider" : self.provider,
-                                            "city" : s["city"],
-                                            "ip" : ip,
-                                            "country" : country,
-                                            "tunnel" : "OpenVPN"
-                                            }
+            az_servers = json.loads(listing[0].content.decode("utf-8"))
 
-                    crt_url = s["openvpn-ca"]
-                    crt_file = "{}/{}.crt".format(self.temp_path, name)
-                    crt = requests.get(crt_url, timeout=2).content.decode("utf-8")
-                    with open(crt_file, "w") as c:
-                        c.write(crt)
+            #locations do not depend on each other so resolve and fetch them side by side
+            for location in self.parallel(self.azirevpn_location, az_servers["locations"]):
+                if location is not None:
+                    self.az_servers[location["name"]] = location
 
-                    tls_url = s["openvpn-tls-key"]
-                    tls_file = "{}/{}.key".format(self.temp_path, name)
-                    tls = requests.get(tls_url, timeout=2).content.decode("utf-8")
-                    with open(tls_file, "w") as t:
-                        t.write(tls)
-
-                else:
-                    self.log.emit(("Error: Could not resolve {} - skipping".format(hostname)))
+            for s in az_servers["locations"]:
+                wg_name = s["name"] + "-wireguard" + "-azirevpn"
+                country = country_translate(s["iso"])
 
                 try:
                     wg_file = "{}.conf".format(wg_name)
@@ -811,7 +1050,7 @@ class AddServers(QtCore.QThread):
                                 'pubkey' : wg_keys[1]
                                 }
 
-                        pub_up = requests.post(wg_api_url, data=data, timeout=10)
+                        pub_up = self.session.post(wg_api_url, data=data, timeout=10)
                         if pub_up.status_code == 200:
                             api_resp = json.loads(pub_up.content.decode("utf-8"))
 
@@ -825,7 +1064,7 @@ class AddServers(QtCore.QThread):
                                                 "\n",
                                                 "[Peer]\n",
                                                 "PublicKey = {}\n".format(api_resp["data"]["PublicKey"]),
-                                                "Endpoint = {}:51820\n".format(wg_ip),
+                                                "Endpoint = {}\n".format(conf_parser.endpoint(wg_ip, 51820)),
                                                 "AllowedIPs = 0.0.0.0/0, ::/0\n"
                                                 ]
 
@@ -876,11 +1115,37 @@ class AddServers(QtCore.QThread):
                             }
 
             self.copy_certs(self.provider)
-            self.finished.emit(azire_dict)
+            self.finished.emit(self.diff(azire_dict))
+
+    def azirevpn_location(self, s):
+        name = s["name"] + "-openvpn" + "-azirevpn"
+        hostname = s["endpoints"]["openvpn"][0]["hostname"]
+        ip = resolve(hostname)[0]
+        self.log.emit(("info", "Importing {}".format(name)))
+
+        if ip == "Failed to resolve":
+            self.log.emit(("error", "Could not resolve {} - skipping".format(hostname)))
+            return None
+
+        crt = self.get(s["openvpn-ca"]).content.decode("utf-8")
+        with open("{}/{}.crt".format(self.temp_path, name), "w") as c:
+            c.write(crt)
+
+        tls = self.get(s["openvpn-tls-key"]).content.decode("utf-8")
+        with open("{}/{}.key".format(self.temp_path, name), "w") as t:
+            t.write(tls)
+
+        return {
+                "name": name,
+                "provider" : self.provider,
+                "city" : s["city"],
+                "ip" : ip,
+                "country" : country_translate(s["iso"]),
+                "tunnel" : "OpenVPN"
+                }
 
     def add_folder(self):
         self.conf_files = [f for f in os.listdir(self.folderpath) if f.endswith('.ovpn') or f.endswith('.conf')]
-        self.cert_files = [f for f in os.listdir(self.folderpath) if f.endswith('.ovpn') or f.endswith('.conf')]
 
         if len(self.conf_files) == 0:
             m = "Import Error&No config files found or folder seems\nto contain many unrelated files&{}".format(self.provider)
@@ -895,120 +1160,74 @@ class AddServers(QtCore.QThread):
             self.failed.emit(m)
 
         else:
-            shutil.copytree(self.folderpath, "{}/copy/".format(self.temp_path))
             self.import_configs()
 
-    def import_configs(self):
-        self.log.emit(("info", "Parsing config files"))
-        custom_servers = {}
-        failed_list = []
-
-        for f in self.conf_files:
-            tunnel = "OpenVPN"
-            name = os.path.splitext(f)[0]
-            conf_copy = "{}/copy/{}".format(self.temp_path, f)
-            ip = 0
-            protocol_found = 0
-
-            with open(conf_copy, "r") as conf_file:
-                modify = conf_file.readlines()
-
-                for index, line in enumerate(modify):
-                    if line.startswith("remote "):
-                        if ip == 0:
-
-                            try:
-                                protocol = line.split(" ")[3]
-
-                            except IndexError:
-                                protocol = "udp\n"
-
-                            port = line.split(" ")[2]
-                            ipsearch = re.compile('\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
-                            result = ipsearch.search(line)
-
-                            if result is not None:
-                                ip = result.group()
+    def parse_configs(self):
+        auth_file = '{}/certs/{}-auth.txt'.format(config.ROOTDIR, self.provider)
+        paths = ["{}/{}".format(self.folderpath, f) for f in self.conf_files]
+        args = [auth_file] * len(paths)
 
-                            else:
-                                server = line.split(" ")[1]
-                                ip = resolve(server)[0]
+        if len(paths) <= PARSE_INLINE:
+            return list(map(conf_parser.parse, paths, args))
 
-                                if ip != "Failed to resolve":
-                                    modify[index] = "remote {} {}\n".format(ip, port)
+        #forkserver keeps workers from inheriting the threads of the service
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(["qomui.conf_parser"])
+        workers = os.cpu_count() or 1
+        chunk = max(1, len(paths) // (workers * 4))
 
-                                else:
-                                    self.log.emit(("warning", "Failed to resolve {}".format(server)))
-                                    failed_list.append(server)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            return list(pool.map(conf_parser.parse, paths, args, chunksize=chunk))
 
-                        else:
-                            modify[index] = "#{}".format(line)
-
-                    elif line.startswith("auth-user-pass"):
-                        auth_file = '{}/certs/{}-auth.txt'.format(config.ROOTDIR, self.provider)
-                        modify[index] = 'auth-user-pass {}\n'.format(auth_file)
-
-                    elif line.startswith("verb "):
-                        modify[index] = 'verb 3\n'
-
-                    elif line.startswith("up ") or line.startswith("down "):
-                        modify[index] = "#{}".format(line)
-
-                    elif line.startswith("proto "):
-                        protocol = line.split(" ")[1]
-                        protocol_found = 1
-
-                    #WireGuard
-                    elif line.startswith("Endpoint ="):
-                        tunnel = "WireGuard"
-                        protocol_found = 1
-                        ip_port = line.split(" = ")[1]
-                        ipsearch = re.compile('\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}')
-                        result = ipsearch.search(line)
-                        port = ip_port.split(":")[1]
-                        server = ip_port.split(":")[0]
-                        protocol = "UDP"
+    def import_configs(self):
+        self.log.emit(("info", "Parsing config files"))
+        custom_servers = {}
+        failed_list = []
+        provider_dir = "{}/{}".format(config.ROOTDIR, self.provider)
+        results = self.parse_configs()
 
-                        if result is not None:
-                            ip = result.group()
+        #all hostnames of the folder go out in one concurrent batch
+        hosts = set(r["host"][2] for r in results if r.get("host") is not None)
+        resolved = resolver.resolve_many(hosts) if len(hosts) != 0 else {}
 
-                        else:
-                            ip = resolve(server)[0]
-                            if ip != "Failed to resolve":
-                                modify[index] = "Endpoint = {}:{}\n".format(ip, port)
-
-                            else:
-                                failed_list.append(server)
+        if not os.path.exists(provider_dir):
+            os.makedirs(provider_dir)
 
-                if protocol_found == 0:
-                    modify.insert(0, "proto {}".format(protocol.lower()))
+        for r in results:
+            if "error" in r:
+                self.log.emit(("warning", "Skipping {}: {}".format(r["file"], r["error"])))
+                continue
 
-                conf_file.close()
+            if r["host"] is not None:
+                server = r["host"][2]
+                if len(resolved.get(server, [])) != 0:
+                    conf_parser.patch(r, resolved[server][0])
 
-                with open (conf_copy, "w") as file_edit:
-                    file_edit.writelines(modify)
-                    file_edit.close()
+                else:
+                    self.log.emit(("warning", "Failed to resolve {}".format(server)))
+                    failed_list.append(server)
 
-                if ip != 0:
+            #configs are written to their destination once, no temporary copy
+            with self.private_open("{}/{}".format(provider_dir, r["file"])) as file_edit:
+                file_edit.writelines(r["lines"])
 
-                    country_check = check_output(["geoiplookup", "{}".format(ip)]).decode("utf-8")
-                    cc = country_check.split(" ")[3].split(",")[0]
-                    country = country_translate(cc)
-                    self.log.emit(("debug", "importing {}".format(name)))
-                    custom_servers[name] = {
-                                                "name": name,
-                                                "provider" : self.provider,
-                                                "city" : "",
-                                                "path" : "{}/{}".format(self.provider, f),
-                                                "ip" : ip,
-                                                "country" : country,
-                                                "tunnel" : tunnel,
-                                                "port": port.upper().split("\n")[0],
-                                                "protocol": protocol.upper().split("\n")[0]
-                                                }
+            if r["ip"] is not None:
+                self.log.emit(("debug", "importing {}".format(r["name"])))
+                custom_servers[r["name"]] = {
+                                            "name": r["name"],
+                                            "provider" : self.provider,
+                                            "city" : "",
+                                            "path" : "{}/{}".format(self.provider, r["file"]),
+                                            "ip" : r["ip"],
+                                            "tunnel" : r["tunnel"],
+                                            "port": r["port"],
+                                            "protocol": r["protocol"]
+                                            }
 
-                else:
-                    pass
+        #one lookup for the whole batch instead of a geoiplookup per server
+        countries = geoip.countries_of([s["ip"] for s in custom_servers.values()])
+        for s in custom_servers.values():
+            s["country"] = countries.get(s["ip"], "Unknown")
 
         custom_dict = {
                         "server" : custom_servers,
@@ -1017,7 +1236,7 @@ class AddServers(QtCore.QThread):
                         }
 
         self.copy_certs(self.provider)
-        self.finished.emit(custom_dict)
+        self.finished.emit(self.diff(custom_dict))
 
     def sanity_check(self, path):
         unrelated_files = 0
@@ -1056,13 +1275,12 @@ class AddServers(QtCore.QThread):
         return wg_keys
 
     def allow_ip(self, hosts):
+        resolved = resolver.resolve_many(hosts)
         for host in hosts:
             self.log.emit(("info", "Creating temporary rule to access {}".format(host)))
-            ips = resolve(host)
-            for i in ips:
-                if i != "" and i != "Failed to resolve":
-                    firewall.allow_dest_ip(i, "-I")
-                    self.allowed_ips.append(i)
+            for i in resolved[host]:
+                firewall.allow_dest_ip(i, "-I", timeout=ALLOW_TIMEOUT)
+                self.allowed_ips.append(i)
 
     def copy_certs(self, provider):
         for i in self.allowed_ips:
@@ -1072,16 +1290,15 @@ class AddServers(QtCore.QThread):
         if not os.path.exists(provider_dir):
             os.makedirs(provider_dir)
 
-        oldmask = os.umask(0o077)
-        with open("{}/{}-auth.txt".format(provider_dir, self.provider) , "w") as passfile:
+        #umask is process wide and other imports may be writing files right now
+        with self.private_open("{}/{}-auth.txt".format(provider_dir, self.provider)) as passfile:
             passfile.write('{}\n{}\n'.format(self.username, self.password))
 
         if provider in config.SUPPORTED_PROVIDERS:
 
             for f in os.listdir(self.temp_path):
-                shutil.copyfile("{}/{}".format(self.temp_path, f), "{}/{}".format(provider_dir, f))
+                self.private_copy("{}/{}".format(self.temp_path, f), "{}/{}".format(provider_dir, f))
                 Popen(['chown', 'root', '{}/{}'.format(provider_dir, f)])
-                Popen(['chmod', '0600', '{}/{}'.format(provider_dir, f)])
 
             try:
                 openvpn_orig_conf = "{}/{}_config".format(config.ROOTDIR, provider)
@@ -1094,22 +1311,16 @@ class AddServers(QtCore.QThread):
                 self.log.emit(("error", "{} does not exist".format(openvpn_orig_conf)))
 
         else:
-            path = "{}/copy/".format(self.temp_path)
-            for f in os.listdir(path):
-                f_source = "{}/{}".format(path, f)
+            #config files were already written by import_configs, this copies the rest
+            for f in os.listdir(self.folderpath):
+                f_source = "{}/{}".format(self.folderpath, f)
                 f_dest = "{}/{}/{}".format(config.ROOTDIR, provider, f)
-                if os.path.isfile(f_source):
+                if f in self.conf_files:
+                    continue
 
-                    try:
-                        shutil.copyfile(f_source, f_dest)
-                        self.log.emit(("debug", "copied {} to {}".format(f, f_dest)))
-
-                    except FileNotFoundError:
-                        if not os.path.exists("{}/{}".format(config.ROOTDIR, provider)):
-                            os.makedirs("{}/{}".format(config.ROOTDIR, provider))
-
-                        shutil.copyfile(f_source,f_dest)
-                        self.log.emit(("debug", "copied {} to {}".format(f, f_dest)))
+                elif os.path.isfile(f_source):
+                    self.private_copy(f_source, f_dest)
+                    self.log.emit(("debug", "copied {} to {}".format(f, f_dest)))
 
                 elif os.path.isdir(f_source):
 
@@ -1119,12 +1330,22 @@ class AddServers(QtCore.QThread):
                     except (NotADirectoryError, FileNotFoundError):
                         pass
 
-                    shutil.copytree(f_source, f_dest)
+                    shutil.copytree(f_source, f_dest, copy_function=self.private_copy)
+                    os.chmod(f_dest, 0o700)
                     self.log.emit(("debug", "copied folder {} to {}".format(f, f_dest)))
 
-        os.umask(oldmask)
         self.remove_temp_dir(self.provider)
 
+    def private_open(self, path, mode="w"):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        return os.fdopen(fd, mode)
+
+    def private_copy(self, src, dest):
+        with open(src, "rb") as s, self.private_open(dest, "wb") as d:
+            shutil.copyfileobj(s, d)
+        return dest
+
     def remove_temp_dir(self, provider):
         try:
             shutil.rmtree(self.temp_path)
@@ -1134,15 +1355,11 @@ class AddServers(QtCore.QThread):
             pass
 
 def resolve(host):
-    try:
-        dig_cmd = ["dig", "+time=2", "+tries=2", "{}".format(host), "+short"]
-        ip = check_output(dig_cmd).decode("utf-8")
-        ip = ip.split("\n")
-
-    except (FileNotFoundError, CalledProcessError):
-        ip = ["Failed to resolve"]
+    ips = resolver.resolve(host)
+    if len(ips) == 0:
+        return ["Failed to resolve"]
 
-    return ip
+    return ips
 
 
 class UpdateCheck(QtCore.QThread):
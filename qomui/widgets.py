@@ -21,7 +21,7 @@ try:
 except ImportError:
     webengine_available = 0
 
-from qomui import config, update, monitor, plotter
+from qomui import config, update, monitor, plotter, persist
 
 try:
     _fromUtf8 = QtCore.QString.fromUtf8
@@ -37,14 +37,18 @@ except AttributeError:
     def _translate(context, text, disambig):
         return QtWidgets.QApplication.translate(context, text, disambig)
 
+def star_polygon():
+    star = QtGui.QPolygonF([QtCore.QPointF(1.0, 0.5)])
+    for i in range(5):
+        star << QtCore.QPointF(0.5 + 0.5 * math.cos(0.8 * i * math.pi),
+                               0.5 + 0.5 * math.sin(0.8 * i * math.pi)
+                               )
+    return star
+
 class favouriteButton(QtWidgets.QAbstractButton):
     def __init__(self, parent=None):
         super(favouriteButton, self).__init__(parent)
-        self.star = QtGui.QPolygonF([QtCore.QPointF(1.0, 0.5)])
-        for i in range(5):
-            self.star << QtCore.QPointF(0.5 + 0.5 * math.cos(0.8 * i * math.pi),
-                                        0.5 + 0.5 * math.sin(0.8 * i * math.pi)
-                                        )
+        self.star = star_polygon()
 
     def paintEvent(self, event):
         painter = QtGui.QPainter(self)
@@ -73,13 +77,9 @@ class favouriteButton(QtWidgets.QAbstractButton):
 
 class ServerWidget(QtWidgets.QWidget):
     server_chosen = QtCore.pyqtSignal(str)
-    set_hop_signal = QtCore.pyqtSignal(str)
-    changed_favourite_signal = QtCore.pyqtSignal(tuple)
 
     def __init__ (self, show=None, parent=None):
         super(ServerWidget, self).__init__(parent=None)
-        self.hidden = False
-        self.fav = 0
         self.show = show
         self.setMouseTracking(True)
         self.setupUi(self)
@@ -100,15 +100,6 @@ class ServerWidget(QtWidgets.QWidget):
         self.cityLabel.setObjectName(_fromUtf8("cityLabel"))
         self.horizontalLayout.addWidget(self.cityLabel)
         self.horizontalLayout.addStretch()
-        self.favouriteButton = favouriteButton(Form)
-        self.favouriteButton.setVisible(False)
-        self.favouriteButton.setCheckable(True)
-        self.favouriteButton.setObjectName(_fromUtf8("favouriteButton"))
-        self.horizontalLayout.addWidget(self.favouriteButton)
-        self.hop_bt = QtWidgets.QPushButton(Form)
-        self.hop_bt.setVisible(False)
-        self.hop_bt.setObjectName(_fromUtf8("hop_bt"))
-        self.horizontalLayout.addWidget(self.hop_bt)
         self.connect_bt = QtWidgets.QPushButton(Form)
         if self.show == None:
             self.connect_bt.setVisible(False)
@@ -116,14 +107,11 @@ class ServerWidget(QtWidgets.QWidget):
         self.horizontalLayout.addWidget(self.connect_bt)
         QtCore.QMetaObject.connectSlotsByName(Form)
         self.connect_bt.clicked.connect(self.signal)
-        self.hop_bt.clicked.connect(self.hop_signal)
-        self.favouriteButton.toggled.connect(self.fav_change)
 
-    def setText(self, name, provider, country, city, button = "connect", fav = 0):
+    def setText(self, name, provider, country, city, button = "connect"):
         self.name = name
         self.provider = provider
         self.city = city
-        self.fav = fav
 
         if self.provider != "bypass":
 
@@ -147,97 +135,303 @@ class ServerWidget(QtWidgets.QWidget):
         bold_font.setWeight(75)
         bold_font.setPointSize(11)
 
-        if self.fav == "on":
-            self.favouriteButton.setChecked(True)
-
         self.nameLabel.setFont(bold_font)
         self.nameLabel.setText(self.name)
         self.cityLabel.setText(self.city)
+        self.connect_bt.setText(_translate("Form", button, None))
 
-        try:
-            self.connect_bt.setText(_translate("Form", button, None))
-
-        except AttributeError:
-            pass
-
-        try:
-            self.hop_bt.setText(_translate("Form", "hop", None))
-
-        except AttributeError:
-            pass
-
-    def hide_button(self, choice=None):
-        self.choice = choice
-        #self.horizontalLayout.removeWidget(self.hop_bt)
-        self.hop_bt = None
+    def enterEvent(self, event):
+        if self.show == None:
+            self.connect_bt.setVisible(True)
+            self.cityLabel.setVisible(False)
 
-        if choice == 1:
+    def leaveEvent(self, event):
+        if self.show == None:
             self.connect_bt.setVisible(False)
-            self.horizontalLayout.removeWidget(self.connect_bt)
-            self.connect_bt = None
+            self.cityLabel.setVisible(True)
 
-    def enterEvent(self, event):
-        if self.show == None:
+    def signal(self):
+        self.server_chosen.emit(self.name)
 
-            try:
-                self.connect_bt.setVisible(True)
+    def sizeHint(self):
+        return QtCore.QSize(100, 50)
 
-            except AttributeError:
-                pass
+KEY_ROLE = QtCore.Qt.UserRole
+PROVIDER_ROLE = QtCore.Qt.UserRole + 1
+CITY_ROLE = QtCore.Qt.UserRole + 2
+LATENCY_ROLE = QtCore.Qt.UserRole + 3
+FAVOURITE_ROLE = QtCore.Qt.UserRole + 4
+TUNNEL_ROLE = QtCore.Qt.UserRole + 5
+LATENCY_VALUE_ROLE = QtCore.Qt.UserRole + 6
 
-            try:
-                self.hop_bt.setVisible(True)
-            except AttributeError:
-                pass
+#latency results arriving within this many ms are sorted in one pass
+SORT_INTERVAL = 100
 
-            self.cityLabel.setVisible(False)
+class ServerListModel(QtCore.QAbstractListModel):
+    """Rows follow the display order kept by a ServerCatalogue"""
 
-            if self.fav != 0:
-                self.favouriteButton.setVisible(True)
+    def __init__(self, catalogue, parent=None):
+        super(ServerListModel, self).__init__(parent)
+        self.catalogue = catalogue
+        self.latency = {}
+        self.flags = {}
 
-    def leaveEvent(self, event):
-        if self.show == None:
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.catalogue.order)
 
-            try:
-                self.connect_bt.setVisible(False)
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
 
-            except AttributeError:
-                pass
+        try:
+            key = self.catalogue.order[index.row()]
+            val = self.catalogue.server_dict[key]
+
+        except (IndexError, KeyError):
+            return None
+
+        if role == QtCore.Qt.DisplayRole:
+            return val.get("name", key)
+        elif role == KEY_ROLE:
+            return key
+        elif role == QtCore.Qt.DecorationRole:
+            return self.flag(val.get("country", "Unknown"))
+        elif role == PROVIDER_ROLE:
+            return val.get("provider", "")
+        elif role == CITY_ROLE:
+            return val.get("city", "")
+        elif role == LATENCY_ROLE:
+            return self.latency.get(key, (None, None))[0]
+        elif role == LATENCY_VALUE_ROLE:
+            return self.latency.get(key, (None, None))[1]
+        elif role == FAVOURITE_ROLE:
+            return val.get("favourite", "off")
+        elif role == TUNNEL_ROLE:
+            return val.get("tunnel", "")
+        elif role == QtCore.Qt.ToolTipRole:
+            return "{} - {}".format(val.get("provider", ""), val.get("country", ""))
+        elif role == QtCore.Qt.SizeHintRole:
+            return QtCore.QSize(100, 50)
+
+        return None
+
+    def flag(self, country):
+        try:
+            return self.flags[country]
 
-            try:
-                self.hop_bt.setVisible(False)
+        except KeyError:
+            flag = '{}/flags/{}.png'.format(config.ROOTDIR, country)
+            if not os.path.isfile(flag):
+                flag = '{}/flags/Unknown.png'.format(config.ROOTDIR)
 
-            except AttributeError:
-                pass
+            pixmap = QtGui.QPixmap(flag).scaled(25, 25,
+                                                transformMode=QtCore.Qt.SmoothTransformation
+                                                )
+            self.flags[country] = pixmap
+            return pixmap
+
+    def rebuild(self, server_dict):
+        self.beginResetModel()
+        malformed = self.catalogue.rebuild(server_dict)
+        self.latency.clear()
+        self.endResetModel()
+        return malformed
+
+    def refresh(self, key, roles=[]):
+        row = self.catalogue.row(key)
+        if row is not None:
+            index = self.index(row, 0)
+            self.dataChanged.emit(index, index, roles)
+
+    def remove(self, key):
+        row = self.catalogue.row(key)
+        if row is None:
+            return
+
+        self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+        self.catalogue.remove(key)
+        self.latency.pop(key, None)
+        self.endRemoveRows()
+
+    def rename(self, key, new_key, val):
+        if self.catalogue.row(key) is None:
+            row = len(self.catalogue.order)
+            self.beginInsertRows(QtCore.QModelIndex(), row, row)
+            self.catalogue.rename(key, new_key, val)
+            self.endInsertRows()
 
-            self.cityLabel.setVisible(True)
-            self.favouriteButton.setVisible(False)
+        else:
+            self.catalogue.rename(key, new_key, val)
+            self.refresh(new_key)
 
-    def signal(self):
-        self.server_chosen.emit(self.name)
+        if key in self.latency:
+            self.latency[new_key] = self.latency.pop(key)
 
-    def display_latency(self, latency):
-        self.latency = latency
+    def set_latency(self, key, latency, value):
+        self.latency[key] = (latency, value)
+        self.refresh(key, [LATENCY_ROLE, LATENCY_VALUE_ROLE])
 
-        if self.city != "":
-            self.cityLabel.setText("{} - {}".format(self.city, self.latency))
+class ServerFilterProxy(QtCore.QSortFilterProxyModel):
 
-        else:
-            self.cityLabel.setText(latency)
+    def __init__(self, parent=None):
+        super(ServerFilterProxy, self).__init__(parent)
+        self.visible = None
+        self.setDynamicSortFilter(False)
+        self.sort(0, QtCore.Qt.AscendingOrder)
+        self.sort_timer = QtCore.QTimer(self)
+        self.sort_timer.setSingleShot(True)
+        self.sort_timer.setInterval(SORT_INTERVAL)
+        self.sort_timer.timeout.connect(self.resort)
+
+    def schedule_sort(self):
+        if not self.sort_timer.isActive():
+            self.sort_timer.start()
+
+    def resort(self):
+        self.sort(0, QtCore.Qt.AscendingOrder)
+
+    #servers with a latency come first - the rest keep catalogue order
+    def lessThan(self, left, right):
+        left_value = left.data(LATENCY_VALUE_ROLE)
+        right_value = right.data(LATENCY_VALUE_ROLE)
+
+        if left_value == right_value:
+            return left.row() < right.row()
+        elif left_value is None:
+            return False
+        elif right_value is None:
+            return True
+
+        return left_value < right_value
+
+    def set_visible(self, keys):
+        self.visible = keys
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, row, parent):
+        if self.visible is None:
+            return True
+
+        index = self.sourceModel().index(row, 0, parent)
+        return index.data(KEY_ROLE) in self.visible
+
+    def keys(self):
+        return [self.index(row, 0).data(KEY_ROLE) for row in range(self.rowCount())]
+
+class ServerDelegate(QtWidgets.QStyledItemDelegate):
+    server_chosen = QtCore.pyqtSignal(str)
+    set_hop_signal = QtCore.pyqtSignal(str)
+    changed_favourite_signal = QtCore.pyqtSignal(tuple)
 
-    def setHidden(self, state):
-        self.hidden = state
+    def __init__(self, parent=None):
+        super(ServerDelegate, self).__init__(parent)
+        self.star = star_polygon()
+
+    def buttons(self, rect, index):
+        right = rect.right() - 5
+        y = rect.y() + (rect.height() - 30) // 2
+        found = {"connect": QtCore.QRect(right - 80, y, 80, 30)}
+        right -= 85
+
+        if index.data(TUNNEL_ROLE) != "WireGuard":
+            found["hop"] = QtCore.QRect(right - 60, y, 60, 30)
+            right -= 65
+
+        found["favourite"] = QtCore.QRect(right - 25, rect.y() + (rect.height() - 25) // 2, 25, 25)
+        return found
+
+    def paint(self, painter, option, index):
+        painter.save()
+        widget = option.widget
+        style = widget.style() if widget is not None else QtWidgets.QApplication.style()
+        opt = QtWidgets.QStyleOptionViewItem(option)
+        self.initStyleOption(opt, index)
+        opt.text = ""
+        opt.icon = QtGui.QIcon()
+        style.drawControl(QtWidgets.QStyle.CE_ItemViewItem, opt, painter, widget)
+
+        rect = option.rect
+        hover = bool(option.state & QtWidgets.QStyle.State_MouseOver)
+        buttons = self.buttons(rect, index)
+
+        if option.state & QtWidgets.QStyle.State_Selected:
+            color = option.palette.highlightedText().color()
+        else:
+            color = option.palette.text().color()
 
-    def isHidden(self):
-        return self.hidden
+        flag = index.data(QtCore.Qt.DecorationRole)
+        if flag is not None:
+            painter.drawPixmap(rect.x() + 5, rect.y() + (rect.height() - flag.height()) // 2, flag)
 
-    def hop_signal(self):
-        self.set_hop_signal.emit(self.name)
+        text_rect = rect.adjusted(40, 0, -5, 0)
+        if hover is True:
+            text_rect.setRight(buttons["favourite"].left() - 5)
 
-    def fav_change(self, change):
-        self.changed_favourite_signal.emit((self.name, change))
+        name = index.data(QtCore.Qt.DisplayRole)
+        bold_font = QtGui.QFont(option.font)
+        bold_font.setBold(True)
+        bold_font.setWeight(75)
+        bold_font.setPointSize(11)
+        painter.setFont(bold_font)
+        painter.setPen(color)
+        align = QtCore.Qt.AlignVCenter | QtCore.Qt.AlignLeft
+        painter.drawText(text_rect, align, name)
+
+        if hover is False:
+            city = index.data(CITY_ROLE)
+            latency = index.data(LATENCY_ROLE)
+            if latency is not None:
+                city = "{} - {}".format(city, latency) if city != "" else latency
+
+            name_width = QtGui.QFontMetrics(bold_font).width(name)
+            painter.setFont(option.font)
+            painter.drawText(text_rect.adjusted(name_width + 10, 0, 0, 0), align, city)
+            painter.setPen(option.palette.color(QtGui.QPalette.Disabled, QtGui.QPalette.Text))
+            painter.drawText(text_rect, QtCore.Qt.AlignVCenter | QtCore.Qt.AlignRight,
+                             index.data(PROVIDER_ROLE))
 
-    def sizeHint(self):
+        else:
+            for button in ["hop", "connect"]:
+                if button in buttons:
+                    button_opt = QtWidgets.QStyleOptionButton()
+                    button_opt.rect = buttons[button]
+                    button_opt.text = _translate("Form", button, None)
+                    button_opt.state = QtWidgets.QStyle.State_Enabled | QtWidgets.QStyle.State_Raised
+                    button_opt.palette = option.palette
+                    style.drawControl(QtWidgets.QStyle.CE_PushButton, button_opt, painter, widget)
+
+            star = buttons["favourite"]
+            painter.setRenderHint(QtGui.QPainter.Antialiasing, True)
+            painter.setPen(QtCore.Qt.NoPen)
+            if index.data(FAVOURITE_ROLE) == "on":
+                painter.setBrush(option.palette.highlight())
+            else:
+                painter.setBrush(option.palette.buttonText())
+            painter.translate(star.x(), star.y())
+            painter.scale(25, 25)
+            painter.drawPolygon(self.star, QtCore.Qt.WindingFill)
+
+        painter.restore()
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QtCore.QEvent.MouseButtonRelease and event.button() == QtCore.Qt.LeftButton:
+            key = index.data(KEY_ROLE)
+
+            for button, rect in self.buttons(option.rect, index).items():
+                if rect.contains(event.pos()):
+                    if button == "connect":
+                        self.server_chosen.emit(key)
+                    elif button == "hop":
+                        self.set_hop_signal.emit(key)
+                    else:
+                        self.changed_favourite_signal.emit((key, index.data(FAVOURITE_ROLE) != "on"))
+                    return True
+
+        return super(ServerDelegate, self).editorEvent(event, model, option, index)
+
+    def sizeHint(self, option, index):
         return QtCore.QSize(100, 50)
 
 class HopWidget(QtWidgets.QWidget):
@@ -279,7 +473,6 @@ class HopWidget(QtWidgets.QWidget):
         self.activeHopWidget.setText(server_dict["name"], server_dict["provider"],
                                server_dict["country"], city, button="clear")
 
-        self.activeHopWidget.hide_button(0)
 
     def signal(self):
         self.clear.emit()
@@ -392,7 +585,6 @@ class ActiveWidget(QtWidgets.QWidget):
             self.hopCountryLabel.setVisible(False)
             self.hopNameLabel.setVisible(False)
 
-        self.ServerWidget.hide_button(0)
 
     def reconnect_signal(self):
         self.reconnect.emit()
@@ -696,7 +888,8 @@ class FirewallEditor(QtWidgets.QDialog):
     options = [
             "block_lan",
             "preserve_rules",
-            "fw_gui_only"
+            "fw_gui_only",
+            "nftables"
             ]
 
     def __init__ (self, settings, parent=None):
@@ -734,6 +927,9 @@ class FirewallEditor(QtWidgets.QDialog):
         self.preserve_rules_check = QtWidgets.QCheckBox()
         self.preserve_rules_check.setObjectName(_fromUtf8("headerLabel"))
         self.verticalLayout.addWidget(self.preserve_rules_check)
+        self.nftables_check = QtWidgets.QCheckBox()
+        self.nftables_check.setObjectName(_fromUtf8("headerLabel"))
+        self.verticalLayout.addWidget(self.nftables_check)
         self.warnLabel = QtWidgets.QLabel(Form)
         self.warnLabel.setObjectName(_fromUtf8("warnLabel"))
         self.verticalLayout.addWidget(self.warnLabel)
@@ -789,6 +985,7 @@ class FirewallEditor(QtWidgets.QDialog):
         self.block_lan_check.setText(_translate("Form", "Block lan/private networks", None))
         self.fw_gui_only_check.setText(_translate("Form", "Activate firewall only when gui is running", None))
         self.preserve_rules_check.setText(_translate("Form", "Preserve pre-existing firewall rules", None))
+        self.nftables_check.setText(_translate("Form", "Use nftables instead of iptables", None))
         self.ipv4Label.setText(_translate("Form", "IPv4 rules", None))
         self.ipv6Label.setText(_translate("Form", "IPv6 rules", None))
         self.saveButton.setText(_translate("Form", "Save", None))
@@ -838,8 +1035,7 @@ class FirewallEditor(QtWidgets.QDialog):
         self.firewall_dict["ipv4rules"] = new_ipv4_rules
         self.firewall_dict["ipv6rules"] = new_ipv6_rules
 
-        with open ("{}/firewall_temp.json".format(config.HOMEDIR), "w") as firedump:
-                json.dump(self.firewall_dict, firedump)
+        persist.write_json("{}/firewall_temp.json".format(config.HOMEDIR), self.firewall_dict)
 
         for option in self.options:
             if getattr(self, "{}_check".format(option)).checkState() == 2:
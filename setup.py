@@ -58,10 +58,22 @@ def post_install(i):
         pass
 
 
+def build_geoip(i):
+    try:
+        from qomui import geoip
+        sources = geoip.available_sources()
+        if len(sources) != 0:
+            geoip.build(*sources)
+
+    except (OSError, ValueError, IndexError) as e:
+        pass
+
+
 class CustomInstall(install):
     def run(self):
         install.run(self)
         self.execute(post_install, (self.install_lib,), msg="Running post-install script to fix file permissions")
+        self.execute(build_geoip, (self.install_lib,), msg="Building geoip table from geoip-database")
 
 
 setup(name="qomui",
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Compare the per-rule and the iptables-restore path on fake binaries
+
+Usage: python3 tests/bench/bench_firewall.py [delay in ms per call]
+
+The fake iptables, iptables-save and iptables-restore only sleep and
+count their calls, so the numbers show process and lock overhead only.
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from qomui import firewall
+
+RESOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "resources")
+
+SAVE = """*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+COMMIT
+"""
+
+FAKE = """#!/bin/sh
+echo "$0" >> "{calls}"
+sleep {delay}
+case "$0" in
+    *-save) cat "{save}" ;;
+    *-restore) cat > /dev/null ;;
+    *) for arg in "$@"; do [ "$arg" = "-C" ] && exit 1; done ;;
+esac
+exit 0
+"""
+
+
+def install(bindir, delay):
+    calls = os.path.join(bindir, "calls")
+    save = os.path.join(bindir, "save")
+
+    with open(save, "w") as s:
+        s.write(SAVE)
+
+    for name in ["iptables", "iptables-save", "iptables-restore"]:
+        path = os.path.join(bindir, name)
+        with open(path, "w") as f:
+            f.write(FAKE.format(calls=calls, save=save, delay=delay))
+        os.chmod(path, 0o755)
+
+    return calls
+
+
+def measure(func, rules, calls):
+    open(calls, "w").close()
+    firewall.ruleset["ip4"] = None
+
+    start = time.monotonic()
+    result = func(rules, ipt="ip4")
+    elapsed = time.monotonic() - start
+
+    with open(calls, "r") as c:
+        spawned = len(c.readlines())
+
+    return result, elapsed, spawned
+
+
+def main():
+    delay = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.005
+
+    with open(os.path.join(RESOURCES, "firewall_default.json"), "r") as f:
+        fw_rules = json.load(f)
+
+    rules, _ = firewall.compile_rules(fw_rules, 1)
+
+    with tempfile.TemporaryDirectory() as bindir:
+        calls = install(bindir, delay)
+        os.environ["PATH"] = "{}:{}".format(bindir, os.environ.get("PATH", ""))
+
+        print("{} ipv4 rules, {:.1f} ms per fake call".format(len(rules), delay * 1000))
+        for label, func in [("add_rules", firewall.add_rules), ("update_rules", firewall.update_rules)]:
+            result, elapsed, spawned = measure(func, rules, calls)
+            print("{:<14}{:>8.3f} s{:>6} processes  ok={}".format(label, elapsed, spawned, result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import copy
+import random
+import shlex
+
+import pytest
+
+from qomui import firewall
+
+LIVE = """# Generated by iptables-save
+*filter
+:INPUT ACCEPT [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+:qomui_in - [0:0]
+-A INPUT -i lo -j ACCEPT
+-A INPUT -j qomui_in
+-A OUTPUT -o lo -j ACCEPT
+-A OUTPUT -d 10.0.0.1/32 -p udp -m udp --dport 53 -j ACCEPT
+-A qomui_in -m state --state RELATED,ESTABLISHED -j ACCEPT
+COMMIT
+*nat
+:PREROUTING ACCEPT [0:0]
+:POSTROUTING ACCEPT [0:0]
+COMMIT
+"""
+
+RULES = [
+    "-i lo -j ACCEPT",
+    "-o tun+ -j ACCEPT",
+    "-p udp -m udp --dport 53 -j ACCEPT",
+    "-d 192.168.1.0/24 -j ACCEPT",
+    "-p icmp -m icmp --icmp-type 8 -j ACCEPT",
+    "-m state --state RELATED,ESTABLISHED -j ACCEPT",
+    "-j DROP",
+    ]
+
+
+def keys(rules):
+    return [firewall.rule_key(r) for r in rules]
+
+
+def apply_payload(model, payload):
+    """Replay a restore payload on a model the way iptables-restore would"""
+    table = None
+
+    for line in payload.split("\n"):
+        if line == "" or line == "COMMIT":
+            continue
+
+        elif line.startswith("*"):
+            table = line[1:]
+
+        elif line.startswith(":"):
+            name, policy = line[1:].split()[:2]
+            cmd = ["-N", name] if policy == "-" else ["-P", name, policy]
+            firewall.simulate(model, [["-t", table] + cmd])
+
+        else:
+            firewall.simulate(model, [["-t", table] + shlex.split(line)])
+
+    return model
+
+
+def comparable(model):
+    return {
+        table: {name: keys(chain["rules"]) for name, chain in chains.items()}
+        for table, chains in model.items()
+        }
+
+
+@pytest.mark.parametrize("seed", range(25))
+def test_diff_chain_round_trip(seed):
+    rand = random.Random(seed)
+    old = [r.split() for r in rand.sample(RULES, rand.randint(0, len(RULES)))]
+    new = [r.split() for r in rand.sample(RULES, rand.randint(0, len(RULES)))]
+
+    model = {"filter": {"OUTPUT": {"policy": "ACCEPT", "rules": copy.deepcopy(old)}}}
+    commands = [["-t", "filter"] + shlex.split(c) for c in firewall.diff_chain("OUTPUT", old, new)]
+    firewall.simulate(model, commands)
+
+    assert keys(model["filter"]["OUTPUT"]["rules"]) == keys(new)
+
+
+def test_diff_chain_keeps_equal_rules():
+    old = [r.split() for r in RULES]
+    assert firewall.diff_chain("OUTPUT", old, copy.deepcopy(old)) == []
+
+
+def test_rule_key_normalises_implicit_matches_and_masks():
+    assert firewall.rule_key("-d 10.0.0.1/32 -p udp -m udp --dport 53 -j ACCEPT".split()) == \
+        firewall.rule_key("-p udp -d 10.0.0.1 --dport 53 -j ACCEPT".split())
+    assert firewall.rule_key("-p icmp --icmp-type echo-request -j ACCEPT".split()) == \
+        firewall.rule_key("-p icmp -m icmp --icmp-type 8 -j ACCEPT".split())
+
+
+def test_simulate_commands():
+    model = firewall.parse_ruleset(LIVE)
+    firewall.simulate(model, [
+        ["-P", "OUTPUT", "DROP"],
+        ["-I", "OUTPUT", "1", "-o", "tun+", "-j", "ACCEPT"],
+        ["-D", "OUTPUT", "-o", "lo", "-j", "ACCEPT"],
+        ["-t", "nat", "-A", "POSTROUTING", "-o", "eth0", "-j", "MASQUERADE"],
+        ["-F", "qomui_in"],
+        ["-N", "qomui_out"],
+        ])
+
+    filter_table = model["filter"]
+    assert filter_table["OUTPUT"]["policy"] == "DROP"
+    assert keys(filter_table["OUTPUT"]["rules"]) == keys([
+        "-o tun+ -j ACCEPT".split(),
+        "-d 10.0.0.1 -p udp --dport 53 -j ACCEPT".split()
+        ])
+    assert filter_table["qomui_in"]["rules"] == []
+    assert filter_table["qomui_out"]["policy"] == "-"
+    assert model["nat"]["POSTROUTING"]["rules"] == [["-o", "eth0", "-j", "MASQUERADE"]]
+
+    firewall.simulate(model, [["-X", "qomui_out"], ["-X", "OUTPUT"]])
+    assert "qomui_out" not in filter_table
+    assert "OUTPUT" in filter_table
+
+
+def test_simulate_rejects_unknown_commands():
+    with pytest.raises(ValueError):
+        firewall.simulate({}, [["-R", "OUTPUT", "1", "-j", "DROP"]])
+
+
+def test_diff_rulesets_round_trip():
+    live = firewall.parse_ruleset(LIVE)
+    rules = [
+        ["-P", "OUTPUT", "DROP"],
+        ["-A", "OUTPUT", "-o", "tun+", "-j", "ACCEPT"],
+        ["-D", "OUTPUT", "-d", "10.0.0.1", "-p", "udp", "--dport", "53", "-j", "ACCEPT"],
+        ["-I", "INPUT", "2", "-i", "tun+", "-j", "ACCEPT"],
+        ["-N", "qomui_out"],
+        ["-A", "qomui_out", "-j", "RETURN"],
+        ["-t", "nat", "-A", "POSTROUTING", "-o", "tun0", "-j", "MASQUERADE"],
+        ]
+
+    desired = firewall.simulate(copy.deepcopy(live), rules)
+    payload = firewall.diff_rulesets(live, desired)
+    replayed = apply_payload(copy.deepcopy(live), payload)
+
+    assert comparable(replayed) == comparable(desired)
+    assert replayed["filter"]["OUTPUT"]["policy"] == "DROP"
+    assert firewall.diff_rulesets(desired, copy.deepcopy(desired)) == ""
+
+
+def test_render_ruleset_round_trip():
+    model = firewall.parse_ruleset(LIVE)
+    firewall.simulate(model, [["-P", "OUTPUT", "DROP"], ["-A", "qomui_implicit", "-j", "RETURN"]])
+    rendered = firewall.render_ruleset(model)
+
+    assert comparable(firewall.parse_ruleset(rendered)) == comparable(model)
+    assert ":OUTPUT DROP [0:0]" in rendered
+    assert ":qomui_in - [0:0]" in rendered
+
+
+def test_render_ruleset_declares_user_chains_without_policy():
+    model = firewall.simulate({}, [["-A", "qomui_implicit", "-j", "RETURN"], ["-A", "OUTPUT", "-j", "ACCEPT"]])
+    rendered = firewall.render_ruleset(model).split("\n")
+
+    assert ":qomui_implicit - [0:0]" in rendered
+    assert ":OUTPUT ACCEPT [0:0]" in rendered
+
+
+def test_update_rules_without_live_ruleset(monkeypatch):
+    restored = []
+    monkeypatch.setattr(firewall, "read_ruleset", lambda ipt="ip4": None)
+    monkeypatch.setattr(firewall, "restore_rules", lambda payload, ipt="ip4": restored.append(payload) or True)
+
+    rules = [["-P", "OUTPUT", "DROP"], ["-A", "OUTPUT", "-o", "lo", "-j", "ACCEPT"]]
+    assert firewall.update_rules(rules) is True
+    assert restored == [firewall.compile_restore(rules)]
+    assert firewall.ruleset["ip4"] is None
+
+
+def test_allow_temporary_batches_ipset(monkeypatch):
+    calls = []
+    monkeypatch.setattr(firewall, "engine", "iptables")
+    monkeypatch.setattr(firewall, "ipset_available", True)
+    monkeypatch.setattr(firewall, "check_ipv6", lambda: True)
+    monkeypatch.setattr(firewall, "run", lambda cmd, input=None, **kwargs: calls.append((cmd, input)))
+
+    assert firewall.allow_temporary(["192.0.2.1", "2001:db8::1", "vpn.example.com"], 900) is True
+    assert calls == [(["ipset", "restore", "-exist"],
+                      b"add qomui_allow4 192.0.2.1 timeout 900\nadd qomui_allow6 2001:db8::1 timeout 900\n")]
+
+
+def test_allow_temporary_without_ipset(monkeypatch):
+    monkeypatch.setattr(firewall, "engine", "iptables")
+    monkeypatch.setattr(firewall, "ipset_available", False)
+    assert firewall.allow_temporary(["192.0.2.1"], 900) is False
+
+
+def test_add_rule_uses_cached_model(monkeypatch):
+    calls = []
+    monkeypatch.setitem(firewall.ruleset, "ip4", firewall.parse_ruleset(LIVE))
+    monkeypatch.setattr(firewall, "read_ruleset", lambda ipt="ip4": calls.append("save"))
+    monkeypatch.setattr(firewall, "check_call", lambda cmd, **kwargs: calls.append(cmd))
+
+    assert firewall.add_rule(["-A", "OUTPUT", "-o", "lo", "-j", "ACCEPT"]) is True
+    assert calls == []
+
+    assert firewall.add_rule(["-A", "OUTPUT", "-o", "tun+", "-j", "ACCEPT"]) is True
+    assert calls == [["iptables", "--wait", "-A", "OUTPUT", "-o", "tun+", "-j", "ACCEPT"]]
+    assert firewall.rule_exists(["-A", "OUTPUT", "-o", "tun+", "-j", "ACCEPT"]) is True
+
+
+def test_compile_restore_declares_chains_after_delete():
+    rules = [
+        ["-F"], ["-X"],
+        ["-N", "qomui_custom"],
+        ["-A", "OUTPUT", "-j", "qomui_custom"],
+        ["-A", "qomui_custom", "-d", "192.168.1.0/24", "-j", "ACCEPT"],
+        ["-P", "OUTPUT", "DROP"],
+        ]
+    payload = firewall.compile_restore(rules).split("\n")
+    commands = payload[payload.index("*filter") + 1:payload.index("COMMIT")]
+
+    assert ":qomui_custom - [0:0]" not in commands
+    assert commands.index("-X") < commands.index("-N qomui_custom") < commands.index("-A OUTPUT -j qomui_custom")
+    assert commands[0] == ":OUTPUT DROP [0:0]"
+    assert ":qomui_kept - [0:0]" in firewall.compile_restore([["-N", "qomui_kept"]]).split("\n")
+
+    replayed = apply_payload(firewall.parse_ruleset(LIVE), "\n".join(payload))
+    assert "qomui_in" not in replayed["filter"]
+    assert keys(replayed["filter"]["qomui_custom"]["rules"]) == keys([["-d", "192.168.1.0/24", "-j", "ACCEPT"]])
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import stat
+
+import pytest
+
+from qomui import persist
+
+
+def test_write_json(tmp_path):
+    path = str(tmp_path / "config.json")
+    persist.write_json(path, {"firewall": 1, "resolvers": []})
+
+    with open(path, "r") as j:
+        assert json.load(j) == {"firewall": 1, "resolvers": []}
+    assert os.listdir(str(tmp_path)) == ["config.json"]
+
+
+def test_write_json_string_and_mode(tmp_path):
+    path = str(tmp_path / "credentials.json")
+    persist.write_json(path, '{"user": "x"}', mode=0o600)
+
+    with open(path, "r") as j:
+        assert j.read() == '{"user": "x"}'
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+
+def test_write_json_replaces_existing_file(tmp_path):
+    path = str(tmp_path / "server.json")
+    persist.write_json(path, {"a": 1})
+    inode = os.stat(path).st_ino
+    persist.write_json(path, {"b": 2})
+
+    with open(path, "r") as j:
+        assert json.load(j) == {"b": 2}
+    assert os.stat(path).st_ino != inode
+
+
+def test_write_json_failure_leaves_file_intact(tmp_path):
+    path = str(tmp_path / "server.json")
+    persist.write_json(path, {"a": 1})
+
+    with pytest.raises(TypeError):
+        persist.write_json(path, {"a": object()})
+
+    with open(path, "r") as j:
+        assert json.load(j) == {"a": 1}
+    assert os.listdir(str(tmp_path)) == ["server.json"]
+
+
+def test_json_file_coalesces_writes(tmp_path):
+    path = str(tmp_path / "bypass_apps.json")
+    f = persist.JsonFile(path, delay=60)
+    f.save({"n": 1})
+    f.save({"n": 2})
+
+    assert not os.path.exists(path)
+    assert f.load() == {"n": 2}
+
+    f.flush()
+    assert f.generation == 1
+    with open(path, "r") as j:
+        assert json.load(j) == {"n": 2}
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import socket
+import struct
+
+import pytest
+
+from qomui import resolver
+
+CNAME = 5
+
+
+def answer(name, rtype, ttl, rdata):
+    return name + struct.pack("!HHIH", rtype, 1, ttl, len(rdata)) + rdata
+
+
+def response(qid, host, qtype, answers, rcode=0):
+    question = resolver.build_query(qid, host, qtype)[12:]
+    header = struct.pack("!HHHHHH", qid, 0x8180 | rcode, 1, len(answers), 0, 0)
+    return header + question + b"".join(answers)
+
+
+def test_build_query_round_trip():
+    query = resolver.build_query(4242, "vpn.example.com", resolver.AAAA)
+    assert resolver.parse_response(query) == (4242, 0, "vpn.example.com", resolver.AAAA, [])
+
+
+def test_parse_response_follows_compression_pointers():
+    #offset 12 is the question name, the cname target is spelled out once
+    #in the first answer and referenced from the second one
+    target = b"\x04edge\xc0\x10"
+    target_offset = 12 + len("\x03vpn\x07example\x03com\x00") + 4 + 12
+    data = response(7, "vpn.example.com", resolver.A, [
+        answer(b"\xc0\x0c", CNAME, 300, target),
+        answer(struct.pack("!H", 0xC000 | target_offset), resolver.A, 60, socket.inet_aton("192.0.2.10")),
+        answer(struct.pack("!H", 0xC000 | target_offset), resolver.A, 30, socket.inet_aton("192.0.2.11")),
+        ])
+
+    qid, rcode, name, qtype, found = resolver.parse_response(data)
+
+    assert (qid, rcode, name, qtype) == (7, 0, "vpn.example.com", resolver.A)
+    assert found == [("192.0.2.10", 60), ("192.0.2.11", 30)]
+    assert resolver.read_name(data, target_offset) == ("edge.example.com", target_offset + len(target))
+
+
+def test_parse_response_ipv6_and_nxdomain():
+    ip = socket.inet_pton(socket.AF_INET6, "2001:db8::1")
+    data = response(9, "Vpn.Example.com", resolver.AAAA, [answer(b"\xc0\x0c", resolver.AAAA, 120, ip)])
+    assert resolver.parse_response(data)[2:] == ("vpn.example.com", resolver.AAAA, [("2001:db8::1", 120)])
+
+    data = response(10, "missing.example.com", resolver.A, [], rcode=3)
+    assert resolver.parse_response(data)[1] == 3
+
+
+def test_read_name_rejects_pointer_loops():
+    data = struct.pack("!HHHHHH", 1, 0x8180, 1, 0, 0, 0) + b"\xc0\x0c"
+    with pytest.raises(ValueError):
+        resolver.read_name(data, 12)
+
+
+def test_resolve_many_releases_waiters_when_lookup_fails(monkeypatch):
+    def fail(hosts):
+        raise OSError("network unreachable")
+
+    monkeypatch.setattr(resolver, "lookup", fail)
+
+    with pytest.raises(OSError):
+        resolver.resolve_many(["vpn.example.com"])
+
+    assert "vpn.example.com" not in resolver.inflight
+    assert resolver.resolve_many(["192.0.2.1"]) == {"192.0.2.1": ["192.0.2.1"]}
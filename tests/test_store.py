@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+from qomui import store
+
+SERVERS = {
+    "Mullvad-se1": {"name": "Mullvad-se1", "provider": "Mullvad", "country": "Sweden",
+                    "city": "Stockholm", "ip": "185.65.134.1", "tunnel": "OpenVPN",
+                    "favourite": "on", "latency": "23.4"},
+    "Mullvad-de1": {"name": "Mullvad-de1", "provider": "Mullvad", "country": "Germany",
+                    "city": "Berlin", "ip": "185.65.135.1", "tunnel": "OpenVPN"},
+    "custom": {"name": "custom", "provider": "Custom", "country": "Unknown",
+               "ip": "2001:db8::1", "tunnel": "WireGuard"},
+    }
+
+PROTOCOLS = {"Mullvad": {"protocol_1": {"protocol": "UDP", "port": "1196"}, "selected": "protocol_1"}}
+
+
+def server(name, country="Sweden", ip="185.65.134.9"):
+    return {"name": name, "provider": "Mullvad", "country": country, "ip": ip, "tunnel": "OpenVPN"}
+
+
+@pytest.fixture
+def homedir(tmp_path):
+    (tmp_path / "server.json").write_text(json.dumps(SERVERS))
+    (tmp_path / "protocol.json").write_text(json.dumps(PROTOCOLS))
+    return tmp_path
+
+
+@pytest.fixture
+def server_store(homedir):
+    s = store.ServerStore(homedir=str(homedir))
+    yield s
+    s.close()
+
+
+def test_migrate_imports_json_files(server_store):
+    servers = server_store.servers()
+
+    assert sorted(servers) == sorted(SERVERS)
+    assert servers["Mullvad-se1"]["favourite"] == "on"
+    assert servers["Mullvad-de1"]["favourite"] == "off"
+    assert servers["custom"]["ip"] == "2001:db8::1"
+    assert server_store.favourites() == ["Mullvad-se1"]
+    assert server_store.protocols() == PROTOCOLS
+    assert server_store.db.execute("PRAGMA user_version").fetchone()[0] == store.SCHEMA_VERSION
+
+
+def test_migrate_keeps_latency_out_of_the_store(server_store):
+    data = json.loads(server_store.db.execute(
+        "SELECT data FROM servers WHERE key = ?", ("Mullvad-se1",)).fetchone()[0])
+
+    assert "latency" not in data
+    assert "favourite" not in data
+    assert server_store.servers()["Mullvad-se1"].latency is None
+
+
+def test_migrate_runs_once(homedir, server_store):
+    server_store.delete_servers(["custom"])
+    server_store.close()
+
+    reopened = store.ServerStore(homedir=str(homedir))
+    try:
+        assert "custom" not in reopened.servers()
+    finally:
+        reopened.close()
+
+
+def test_migrate_without_json_files(tmp_path):
+    empty = store.ServerStore(homedir=str(tmp_path))
+    try:
+        assert empty.servers() == {}
+        assert empty.protocols() == {}
+    finally:
+        empty.close()
+
+
+def test_apply_import(server_store):
+    server_store.set_last_used("Mullvad-se1")
+    server_store.apply_import({
+        "provider": "Mullvad",
+        "validators": {"digest": "abc"},
+        "added": {"Mullvad-no1": server("Mullvad-no1", country="Norway")},
+        "changed": {"Mullvad-se1": server("Mullvad-se1", ip="185.65.134.2")},
+        "removed": ["Mullvad-de1"]
+        })
+
+    servers = server_store.servers()
+    assert sorted(servers) == ["Mullvad-no1", "Mullvad-se1", "custom"]
+    assert servers["Mullvad-se1"]["ip"] == "185.65.134.2"
+    assert servers["Mullvad-se1"]["favourite"] == "on"
+    assert server_store.last_used() == ["Mullvad-se1"]
+    assert server_store.validators("Mullvad") == {"digest": "abc"}
+
+    meta = [r[0] for r in server_store.db.execute("SELECT key FROM meta")]
+    assert "Mullvad-de1" not in meta
+
+
+def test_apply_import_unchanged_only_stores_validators(server_store):
+    server_store.apply_import({
+        "provider": "Mullvad",
+        "unchanged": "1",
+        "validators": {"digest": "def"}
+        })
+
+    assert sorted(server_store.servers()) == sorted(SERVERS)
+    assert server_store.validators("Mullvad") == {"digest": "def"}
+
+
+def test_apply_import_full_replaces_provider(server_store):
+    content = {
+        "provider": "Mullvad",
+        "full": "1",
+        "added": {"Mullvad-fi1": server("Mullvad-fi1", country="Finland")},
+        "changed": {},
+        "removed": []
+        }
+
+    server_store.apply_import(dict(content))
+    assert sorted(server_store.servers()) == ["Mullvad-de1", "Mullvad-fi1", "Mullvad-se1", "custom"]
+
+    server_store.apply_import(dict(content), replace=True)
+    assert sorted(server_store.servers()) == ["Mullvad-fi1", "custom"]
+    assert sorted(server_store.keys(provider="Mullvad")) == ["Mullvad-fi1"]